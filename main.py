@@ -1,61 +1,62 @@
 from pathlib import Path
+from typing import Optional
 import pandas as pd
 
-from src.clean_data import clean_transactions, clean_clients, merge_tables
-from src.analysis import run_analysis
-from src.utils import audit_df
-from src.generate_md_report import generate_md_report
-
-
-def main() -> None:
-    transactions_file = Path("data") / "transactions_data.xlsx"
-    clients_file = Path("data") / "clients_data.json"
-
-    output_dir = Path("analysis_output")
-    output_dir.mkdir(exist_ok=True)
-
-    # Load tables
-    transactions_raw = pd.read_excel(transactions_file)
-    clients_raw = pd.read_json(clients_file)
-
-    # Audit raw data
-    audit_df(
-        transactions_raw,
-        save_file_name=output_dir / "audit_raw_transactions.json",
-        str_value_counts_exclude_col=["transaction_id", "client_id"],
+from src.clean_data import clean_clients
+from src.analysis import save_results
+from src.cache import cached_read, source_hash
+from src.dimension import (
+    INDEX_DIR,
+    build_client_index,
+    load_client_index,
+    save_client_index,
+)
+from src.incremental import fold_batch, load_state, results_from_state, save_state
+from src.instrument import measure, save_run_metrics
+from src.stages import CLIENTS_FILE, OUTPUT_DIR, build_stages, run_stages
+
+
+def main(
+    compact: bool = False,
+    backend: str = "pandas",
+    max_workers: Optional[int] = None,
+    profile: bool = False,
+    use_cache: bool = True,
+    dry_run: bool = False,
+) -> None:
+    run_stages(
+        build_stages(compact=compact, backend=backend),
+        max_workers=max_workers,
+        profile=profile,
+        use_cache=use_cache,
+        dry_run=dry_run,
     )
-    audit_df(
-        clients_raw,
-        save_file_name=output_dir / "audit_raw_clients.json",
-        str_value_counts_exclude_col=["id"],
-    )
-
-    # Clean data
-    transactions = clean_transactions(transactions_raw)
-    clients = clean_clients(clients_raw)
 
-    # Audit clean data
-    audit_df(
-        transactions,
-        save_file_name=output_dir / "audit_transactions.json",
-        str_value_counts_exclude_col=["transaction_id", "client_id"],
-    )
-    audit_df(
-        clients,
-        save_file_name=output_dir / "audit_clients.json",
-        str_value_counts_exclude_col=["id"],
-    )
 
-    merged_df = merge_tables(transactions, clients)
-    analysis_results = run_analysis(
-        merged_df, save_file_name=output_dir / "analysis_results.json"
-    )
+def main_incremental(batch_files: list[Path]) -> None:
+    output_dir = OUTPUT_DIR
+    output_dir.mkdir(exist_ok=True)
 
-    generate_md_report(
-        analysis_results,
-        df=merged_df,
-        save_file_path=output_dir / "report.md",
+    # The client index is built once per version of the clients file
+    index_dir = INDEX_DIR / source_hash(CLIENTS_FILE, "client_index", {})[:16]
+    clients = load_client_index(index_dir)
+    if clients is None:
+        clients = build_client_index(
+            clean_clients(cached_read(CLIENTS_FILE, pd.read_json))
+        )
+        save_client_index(clients, index_dir)
+
+    # Only new batches are cleaned and folded into the persisted aggregates
+    state = load_state()
+    for batch_file in batch_files:
+        measure(f"fold_batch.{batch_file.name}", fold_batch, state, batch_file, clients)
+    save_state(state)
+
+    save_results(
+        results_from_state(state),
+        save_file_name=output_dir / "analysis_results.json",
     )
+    save_run_metrics(output_dir / "run_metrics.json")
 
 
 if __name__ == "__main__":
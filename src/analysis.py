@@ -1,132 +1,229 @@
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Literal, Optional
 import pandas as pd
-import numpy as np
-from sklearn.linear_model import LinearRegression
 import json
 
+from .cube import WINDOWS, DailyCube, window_partials
+from .features import ClientFeatures, build_features, segment_metrics
+from .forecast import (
+    FORECAST_KEYS,
+    forecast_from_monthly,
+    forecast_next_month_by,
+    monthly_totals,
+)
+from .instrument import measure
+from .utils import key_column
+
+
+@dataclass(frozen=True)
+class Metric:
+    # Group column, None for a single total over the window
+    by: str | None = None
+    agg: Literal["count", "sum", "mean", "share"] = "sum"
+    # "all" or a trailing window of cube.WINDOWS
+    window: Literal["all", "last_week", "last_month", "last_quarter"] = "all"
+    sort: bool = True
+    decimals: int | None = 2
+
+
+METRICS: dict[str, Metric] = {
+    "services_by_count": Metric(by="service", agg="count", decimals=None),
+    "services_by_transaction_amount": Metric(by="service"),
+    "avg_transaction_amount_by_city": Metric(by="city", agg="mean"),
+    "payment_method_percentage": Metric(by="payment_method", agg="share"),
+    "last_month_amount_by_service": Metric(by="service", window="last_month"),
+    "last_month_total_amount": Metric(window="last_month"),
+    "client_net_worth_category_total_amount": Metric(by="net_worth_category"),
+    "avg_transaction_amount_by_client_age": Metric(by="age", agg="mean", sort=False),
+}
+
+
+def group_partials(
+    df: pd.DataFrame,
+    metrics: dict[str, Metric],
+    cube: Optional[DailyCube] = None,
+) -> dict[tuple[str, str | None], pd.DataFrame | pd.Series]:
+    # Every (window, key) pair is grouped once with count and sum together,
+    # so metrics that share a key and a window share a single pass
+    keys = {m.by for m in metrics.values() if m.by is not None and m.window == "all"}
+    key_columns = {key: key_column(df, key) for key in keys}
+
+    groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series] = {}
+    for metric in metrics.values():
+        plan = (metric.window, metric.by)
+        if plan in groups or metric.window != "all":
+            continue
+        if metric.by is None:
+            groups[plan] = df["amount"].agg(["count", "sum"])
+        else:
+            groups[plan] = (
+                df["amount"]
+                .groupby(key_columns[metric.by], observed=True)
+                .agg(["count", "sum"])
+            )
+
+    # Windowed metrics are read from the daily cube when one is materialized;
+    # without it a window is a row mask, far cheaper than building the cube
+    # for one query
+    window_plans = list(
+        dict.fromkeys((m.window, m.by) for m in metrics.values() if m.window in WINDOWS)
+    )
+    if cube is not None:
+        groups.update(window_partials(cube, window_plans))
+    else:
+        dates = df["transaction_date"]
+        for window, by in window_plans:
+            rows = (dates >= dates.max() - WINDOWS[window]).to_numpy()
+            amounts = df["amount"][rows]
+            groups[(window, by)] = (
+                amounts.agg(["count", "sum"])
+                if by is None
+                else amounts.groupby(key_column(df, by)[rows], observed=True).agg(
+                    ["count", "sum"]
+                )
+            )
+
+    return groups
+
+
+def finalize_metrics(
+    groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series],
+    metrics: dict[str, Metric],
+) -> dict:
+    results = {}
+    for name, metric in metrics.items():
+        grouped = groups[(metric.window, metric.by)]
+
+        if metric.by is None:
+            value = float(grouped["sum"])
+            results[name] = round(value, metric.decimals)
+            continue
+
+        if metric.agg == "count":
+            value = grouped["count"].rename("count")
+        elif metric.agg == "share":
+            counts = grouped["count"].sort_values(ascending=False)
+            value = (counts / counts.sum() * 100).rename("count")
+        elif metric.agg == "mean":
+            value = (grouped["sum"] / grouped["count"]).rename("amount")
+        else:
+            value = grouped["sum"].rename("amount")
+
+        if metric.sort:
+            value = value.sort_values(ascending=False)
+        if metric.decimals is not None:
+            value = value.round(metric.decimals)
+        results[name] = value
+
+    return results
+
+
+def aggregate(df: pd.DataFrame, metrics: dict[str, Metric]) -> dict:
+    return finalize_metrics(group_partials(df, metrics), metrics)
+
 
 def services_by_count(df: pd.DataFrame) -> pd.Series:
-    return df["service"].value_counts()
+    return aggregate(df, {"m": METRICS["services_by_count"]})["m"]
 
 
 def avg_transaction_amount_by_city(df: pd.DataFrame) -> pd.Series:
-    return (
-        pd.Series(df.groupby("city")["amount"].mean())
-        .sort_values(ascending=False)
-        .round(2)
-    )
+    return aggregate(df, {"m": METRICS["avg_transaction_amount_by_city"]})["m"]
 
 
 def services_by_transaction_amount(df: pd.DataFrame) -> pd.Series:
-    return (
-        pd.Series(df.groupby("service")["amount"].sum())
-        .sort_values(ascending=False)
-        .round(2)
-    )
+    return aggregate(df, {"m": METRICS["services_by_transaction_amount"]})["m"]
 
 
 def payment_method_percentage(df: pd.DataFrame) -> pd.Series:
-    counts = df["payment_method"].value_counts()
-    return (counts / counts.sum() * 100).round(2)
+    return aggregate(df, {"m": METRICS["payment_method_percentage"]})["m"]
 
 
 def last_month_total_amount(df: pd.DataFrame) -> float:
-    month_start = df["transaction_date"].max() - pd.DateOffset(months=1)
-    last_month_df = df[df["transaction_date"] >= month_start]
-    return round(float(last_month_df["amount"].sum().item()), 2)
+    return aggregate(df, {"m": METRICS["last_month_total_amount"]})["m"]
 
 
 def last_month_amount_by_service(df: pd.DataFrame) -> pd.Series:
-    month_start = df["transaction_date"].max() - pd.DateOffset(months=1)
-    last_month_df = df[df["transaction_date"] >= month_start]
-    return (
-        pd.Series(last_month_df.groupby("service")["amount"].sum())
-        .sort_values(ascending=False)
-        .round(2)
-    )
-
-
-def categorize_client_net_worth(capital: float) -> str:
-    if capital < 100_000:
-        return "Низкий капитал"
-    elif capital <= 1_000_000:
-        return "Средний капитал"
-    else:
-        return "Высокий капитал"
+    return aggregate(df, {"m": METRICS["last_month_amount_by_service"]})["m"]
 
 
 def client_net_worth_category_total_amount(df: pd.DataFrame) -> pd.Series:
-    categories = df["net_worth"].apply(categorize_client_net_worth)
-    return (
-        pd.Series(df.groupby(categories)["amount"].sum())
-        .sort_values(ascending=False)
-        .round(2)
-    )
+    return aggregate(df, {"m": METRICS["client_net_worth_category_total_amount"]})["m"]
 
 
 def avg_transaction_amount_by_client_age(df: pd.DataFrame) -> pd.Series:
-    return pd.Series(df.groupby("age")["amount"].mean()).round(2)
-
-
-def forecast_next_month(df: pd.DataFrame) -> dict:
-    df["transaction_date"] = pd.to_datetime(df["transaction_date"])
-
-    monthly_df = (
-        df.set_index("transaction_date")
-        .resample("ME")
-        .agg(
-            count=("amount", "count"),
-            amount=("amount", "sum"),
-        )
-        .reset_index()
+    return aggregate(df, {"m": METRICS["avg_transaction_amount_by_client_age"]})["m"]
+
+
+# Client attributes the feature table is summarized by
+SEGMENT_KEYS = ("net_worth_category",)
+
+
+def result_keys(metrics: dict[str, Metric] = METRICS) -> list[str]:
+    # Keys of the run_analysis results, in order; every backend returns them
+    return [
+        *metrics,
+        "forecast_next_month",
+        *(f"forecast_next_month_by_{by}" for by in FORECAST_KEYS),
+        "monthly_totals",
+        *(f"client_segments_by_{by}" for by in SEGMENT_KEYS),
+    ]
+
+
+def run_analysis(
+    merged_df: pd.DataFrame,
+    cube: Optional[DailyCube] = None,
+    features: Optional[ClientFeatures] = None,
+    *,
+    save_file_name: Path,
+) -> dict:
+    # The pipeline passes the materialized cube and features; without them
+    # they are built from merged_df
+    if features is None:
+        features = measure("analysis.build_features", build_features, merged_df)
+    groups = measure(
+        "analysis.group_partials", group_partials, merged_df, METRICS, cube
     )
+    results = measure("analysis.finalize_metrics", finalize_metrics, groups, METRICS)
 
-    monthly_df["time_index"] = range(len(monthly_df))
-
-    X = monthly_df[["time_index"]].values
-
-    model_count = LinearRegression()
-    model_amount = LinearRegression()
+    # The monthly aggregate is shared by the forecasts, the forecast plot and
+    # the report; it is not written to the results file
+    monthly = measure("analysis.monthly_totals", monthly_totals, merged_df)
+    results["forecast_next_month"] = measure(
+        "analysis.forecast_next_month", forecast_from_monthly, monthly
+    )
+    for by in FORECAST_KEYS:
+        results[f"forecast_next_month_by_{by}"] = measure(
+            f"analysis.forecast_next_month_by_{by}",
+            forecast_next_month_by,
+            merged_df,
+            by,
+        )
+    results["monthly_totals"] = monthly
 
-    model_count.fit(X, monthly_df["count"])
-    model_amount.fit(X, monthly_df["amount"])
+    # Segment metrics count clients, so they come from the client features
+    for by in SEGMENT_KEYS:
+        results[f"client_segments_by_{by}"] = measure(
+            f"analysis.client_segments_by_{by}", segment_metrics, features, by
+        )
 
-    next_time = np.array([[monthly_df["time_index"].max() + 1]])
+    measure("analysis.save_results", save_results, results, save_file_name)
 
-    next_count = model_count.predict(next_time)[0]
-    next_amount = model_amount.predict(next_time)[0]
+    return results
 
-    return {
-        "count": int(round(next_count)),
-        "amount": float(round(next_amount)),
-    }
 
+def serializable_results(results: dict) -> dict:
+    # What the results file holds: Series as dicts, plain values as they are
+    serializable = {}
+    for k, v in results.items():
+        if isinstance(v, pd.Series):
+            serializable[k] = v.to_dict()
+        elif type(v) in [dict, int, float, str]:
+            serializable[k] = v
+    return serializable
 
-def run_analysis(merged_df: pd.DataFrame, save_file_name: Path) -> dict:
-    results = {
-        "services_by_count": services_by_count(merged_df),
-        "services_by_transaction_amount": services_by_transaction_amount(merged_df),
-        "avg_transaction_amount_by_city": avg_transaction_amount_by_city(merged_df),
-        "payment_method_percentage": payment_method_percentage(merged_df),
-        "last_month_amount_by_service": last_month_amount_by_service(merged_df),
-        "last_month_total_amount": last_month_total_amount(merged_df),
-        "client_net_worth_category_total_amount": client_net_worth_category_total_amount(
-            merged_df
-        ),
-        "avg_transaction_amount_by_client_age": avg_transaction_amount_by_client_age(
-            merged_df
-        ),
-        "forecast_next_month": forecast_next_month(merged_df),
-    }
 
+def save_results(results: dict, save_file_name: Path) -> None:
     with open(save_file_name, "w", encoding="utf-8") as f:
-        serializable = {}
-        for k, v in results.items():
-            if hasattr(v, "to_dict"):
-                serializable[k] = v.to_dict()
-            elif type(v) in [dict, int, float, str]:
-                serializable[k] = v
-        f.write(json.dumps(serializable, indent=2, ensure_ascii=False))
+        f.write(json.dumps(serializable_results(results), indent=2, ensure_ascii=False))
         print(f"Results saved: {save_file_name}")
-
-    return results
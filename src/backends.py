@@ -0,0 +1,576 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+import argparse
+import importlib.util
+import math
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .analysis import (
+    METRICS,
+    SEGMENT_KEYS,
+    Metric,
+    finalize_metrics,
+    group_partials,
+    result_keys,
+    save_results,
+)
+from .cache import cached_read, source_hash, source_id
+from .clean_data import (
+    CLIENT_DEFAULTS,
+    TRANSACTION_DEFAULTS,
+    clean_clients,
+    clean_transactions,
+    merge_tables,
+)
+from .cube import WINDOWS
+from .features import build_features, client_segments, segment_summary
+from .forecast import (
+    FORECAST_KEYS,
+    forecast_from_monthly,
+    forecast_groups,
+    monthly_totals,
+    widen_monthly,
+)
+from .instrument import measure
+from .memo import code_hash
+from .readers import read_excel_streaming, read_json_streaming
+from .utils import NET_WORTH_BANDS, Bands
+
+PARQUET_DIR = Path(".cache") / "parquet"
+
+# Date layouts the engines parse; anything else becomes a missing date, as
+# with pd.to_datetime(errors="coerce") on the source files
+DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S%.f",
+    "%Y-%m-%dT%H:%M:%S%.f",
+    "%Y-%m-%d",
+)
+
+# Engines add floats in another order, which moves sums in the last digits
+# and can flip a rounded cent
+PARITY_RTOL = 1e-7
+
+# Microseconds in a day, for whole days between timestamps in SQL
+DAY_US = 86_400_000_000
+
+# pd.DateOffset units of cube.WINDOWS in polars duration strings
+_POLARS_UNITS = {"days": "d", "weeks": "w", "months": "mo"}
+
+_READERS = {".xlsx": read_excel_streaming, ".json": read_json_streaming}
+
+
+@dataclass(frozen=True)
+class Aggregates:
+    # Count and sum per (window, key), as group_partials returns them
+    groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series]
+    # Monthly count and amount: the total, and per group of every forecast key
+    monthly: dict[str | None, pd.DataFrame]
+    # Client totals per segment of every segment key, see client_segments
+    segments: dict[str, pd.DataFrame]
+
+
+def as_parquet(path: Path, parquet_dir: Path = PARQUET_DIR) -> Path:
+    # The engines scan Parquet; other sources are converted once per version
+    if path.suffix == ".parquet":
+        return path
+    reader = _READERS[path.suffix]
+    key = source_hash(path, f"as_parquet:{code_hash(reader)}", {})
+    source = source_id(path, "as_parquet")
+    parquet_file = parquet_dir / f"{source}-{key[:16]}.parquet"
+    if parquet_file.exists():
+        return parquet_file
+
+    df = cached_read(path, reader)
+    # Mixed columns (Excel dates next to garbage strings) are kept as text
+    mixed = {col: "str" for col in df.columns if df[col].dtype == object}
+    parquet_dir.mkdir(parents=True, exist_ok=True)
+    for stale in parquet_dir.glob(f"{source}-*"):
+        stale.unlink()
+    pq.write_table(
+        pa.Table.from_pandas(df.astype(mixed), preserve_index=False), parquet_file
+    )
+    return parquet_file
+
+
+def _plans(metrics: dict[str, Metric]) -> list[tuple[str, str | None]]:
+    return list(dict.fromkeys((m.window, m.by) for m in metrics.values()))
+
+
+def _group_order(table: pd.DataFrame, by: str) -> pd.DataFrame:
+    # Groups in the order pandas groupby gives them, so ties keep their order
+    # once finalize_metrics sorts by value
+    if by == "net_worth_category":
+        table.index = pd.CategoricalIndex(
+            table.index, categories=NET_WORTH_BANDS.labels, ordered=True, name=by
+        )
+    return table.sort_index()
+
+
+def _monthly_table(long: pd.DataFrame, by: str | None) -> pd.DataFrame:
+    # Month rows (and a group column) -> the layout of forecast.monthly_totals
+    keys = ["month"] if by is None else ["month", by]
+    partials = long.assign(
+        month=pd.to_datetime(long["month"]).dt.to_period("M")
+    ).set_index(keys)[["count", "amount"]]
+    return widen_monthly(partials, by)
+
+
+def _pandas_aggregates(
+    transactions_file: Path, clients_file: Path, metrics: dict[str, Metric]
+) -> Aggregates:
+    merged_df = merge_tables(
+        clean_transactions(pd.read_parquet(transactions_file)),
+        clean_clients(pd.read_parquet(clients_file)),
+    )
+    features = build_features(merged_df)
+    return Aggregates(
+        group_partials(merged_df, metrics),
+        {by: monthly_totals(merged_df, by) for by in (None, *FORECAST_KEYS)},
+        {by: client_segments(features, by) for by in SEGMENT_KEYS},
+    )
+
+
+def _sql_literal(value: object) -> str:
+    if isinstance(value, (str, Path)):
+        return "'" + str(value).replace("'", "''") + "'"
+    return str(value)
+
+
+def _bands_sql(column: str, bands: Bands) -> str:
+    edge_in_lower = bands.edge_in_lower or (False,) * len(bands.edges)
+    cases = [f"WHEN {column} IS NULL THEN NULL"]
+    for edge, in_lower, label in reversed(
+        list(zip(bands.edges, edge_in_lower, bands.labels[1:]))
+    ):
+        op = ">" if in_lower else ">="
+        cases.append(f"WHEN {column} {op} {edge} THEN {_sql_literal(label)}")
+    return f"CASE {' '.join(cases)} ELSE {_sql_literal(bands.labels[0])} END"
+
+
+def _duckdb_aggregates(
+    transactions_file: Path, clients_file: Path, metrics: dict[str, Metric]
+) -> Aggregates:
+    import duckdb
+
+    transaction_defaults = ", ".join(
+        f"coalesce({col}, {_sql_literal(value)}) AS {col}"
+        for col, value in TRANSACTION_DEFAULTS.items()
+    )
+    client_defaults = ", ".join(
+        f"coalesce({col}, {_sql_literal(value)}) AS {col}"
+        for col, value in CLIENT_DEFAULTS.items()
+    )
+
+    # Same rules as clean_transactions: critical fields, valid dates, positive
+    # amounts, the first row of every transaction_id; rows without an id are
+    # all kept, as their synthetic ids are unique
+    transactions_sql = f"""
+        SELECT * EXCLUDE (file_row_number) REPLACE ({transaction_defaults})
+        FROM (
+            SELECT * REPLACE (TRY_CAST(transaction_date AS TIMESTAMP) AS transaction_date)
+            FROM read_parquet({_sql_literal(transactions_file)}, file_row_number = true)
+            WHERE client_id IS NOT NULL AND amount IS NOT NULL AND NOT isnan(amount)
+        )
+        WHERE transaction_date IS NOT NULL AND amount > 0
+        QUALIFY transaction_id IS NULL OR row_number() OVER (
+            PARTITION BY transaction_id ORDER BY file_row_number
+        ) = 1
+    """
+    clients_sql = f"""
+        SELECT *, {_bands_sql("net_worth", NET_WORTH_BANDS)} AS net_worth_category
+        FROM (
+            SELECT * REPLACE ({client_defaults})
+            FROM read_parquet({_sql_literal(clients_file)})
+            WHERE id IS NOT NULL
+        )
+    """
+    # Windows start at the last transaction's timestamp minus the window
+    last = "(SELECT max(transaction_date) FROM merged)"
+    windows = {
+        window: "transaction_date >= "
+        + last
+        + "".join(
+            f" - INTERVAL {n} {unit.removesuffix('s').upper()}"
+            for unit, n in offset.kwds.items()
+        )
+        for window, offset in WINDOWS.items()
+    }
+
+    # Tables past the memory limit spill to a temporary directory
+    with tempfile.TemporaryDirectory() as spill_dir:
+        con = duckdb.connect()
+        try:
+            con.execute(f"SET temp_directory = {_sql_literal(spill_dir)}")
+            con.execute(f"CREATE TEMP TABLE clients AS {clients_sql}")
+            duplicates = con.execute(
+                "SELECT count(*) - count(DISTINCT id) FROM clients"
+            ).fetchone()[0]
+            if duplicates:
+                raise ValueError("Client index: duplicate client ids")
+            con.execute(f"""
+                CREATE TEMP TABLE merged AS
+                SELECT t.*, c.* EXCLUDE (id)
+                FROM ({transactions_sql}) t JOIN clients c ON t.client_id = c.id
+                """)
+
+            groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series] = {}
+            for window, by in _plans(metrics):
+                where = [] if window == "all" else [windows[window]]
+                if by is None:
+                    groups[(window, by)] = (
+                        con.execute(
+                            "SELECT count(amount) AS count, sum(amount) AS sum "
+                            f"FROM merged {'WHERE ' + ' AND '.join(where) if where else ''}"
+                        )
+                        .df()
+                        .iloc[0]
+                    )
+                    continue
+                where.insert(0, f"{by} IS NOT NULL")
+                table = con.execute(
+                    f"SELECT {by}, count(amount) AS count, sum(amount) AS sum "
+                    f"FROM merged WHERE {' AND '.join(where)} GROUP BY {by}"
+                ).df()
+                groups[(window, by)] = _group_order(table.set_index(by), by)
+
+            monthly = {}
+            for by in (None, *FORECAST_KEYS):
+                key = "" if by is None else f", {by}"
+                monthly[by] = _monthly_table(
+                    con.execute(
+                        "SELECT date_trunc('month', transaction_date) AS month"
+                        f"{key}, count(amount) AS count, sum(amount) AS amount "
+                        f"FROM merged GROUP BY ALL"
+                    ).df(),
+                    by,
+                )
+
+            # Per client first, then per segment; recency and tenure are whole
+            # days, as Timedelta.days floors them
+            segments = {}
+            for by in SEGMENT_KEYS:
+                table = con.execute(f"""
+                    WITH per_client AS (
+                        SELECT any_value({by}) AS {by}, count(*) AS frequency,
+                            sum(amount) AS monetary,
+                            min(transaction_date) AS first_date,
+                            max(transaction_date) AS last_date
+                        FROM merged GROUP BY client_id
+                    ), as_of AS (SELECT max(last_date) AS as_of FROM per_client)
+                    SELECT {by}, count(*) AS clients, sum(monetary) AS revenue,
+                        sum(frequency) AS transactions,
+                        avg(frequency) AS avg_frequency,
+                        avg((epoch_us(as_of) - epoch_us(last_date)) // {DAY_US})
+                            AS avg_recency_days,
+                        avg((epoch_us(last_date) - epoch_us(first_date)) // {DAY_US})
+                            AS avg_tenure_days
+                    FROM per_client, as_of WHERE {by} IS NOT NULL GROUP BY {by}
+                    """).df()
+                segments[by] = _group_order(table.set_index(by), by)
+        finally:
+            con.close()
+
+    return Aggregates(groups, monthly, segments)
+
+
+def _polars_aggregates(
+    transactions_file: Path, clients_file: Path, metrics: dict[str, Metric]
+) -> Aggregates:
+    import polars as pl
+
+    def bands(column: pl.Expr, bands: Bands) -> pl.Expr:
+        edge_in_lower = bands.edge_in_lower or (False,) * len(bands.edges)
+        label = pl.lit(bands.labels[0])
+        for edge, in_lower, upper in zip(bands.edges, edge_in_lower, bands.labels[1:]):
+            passed = column > edge if in_lower else column >= edge
+            label = pl.when(passed).then(pl.lit(upper)).otherwise(label)
+        return pl.when(column.is_null()).then(None).otherwise(label)
+
+    transactions = pl.scan_parquet(transactions_file)
+    date = pl.col("transaction_date")
+    if transactions.collect_schema()["transaction_date"] == pl.String:
+        date = pl.coalesce(
+            [
+                date.str.strptime(pl.Datetime("us"), f, strict=False)
+                for f in DATE_FORMATS
+            ]
+        )
+    else:
+        date = date.cast(pl.Datetime("us"), strict=False)
+
+    # Same rules as clean_transactions, see _duckdb_aggregates
+    transactions = (
+        transactions.filter(
+            pl.col("client_id").is_not_null()
+            & pl.col("amount").is_not_null()
+            & pl.col("amount").is_not_nan()
+        )
+        .with_columns(date.alias("transaction_date"))
+        .filter(pl.col("transaction_date").is_not_null() & (pl.col("amount") > 0))
+        .filter(
+            pl.col("transaction_id").is_null()
+            | pl.col("transaction_id").is_first_distinct()
+        )
+        .with_columns(
+            pl.col(col).fill_null(value) for col, value in TRANSACTION_DEFAULTS.items()
+        )
+    )
+    clients = (
+        pl.scan_parquet(clients_file)
+        .filter(pl.col("id").is_not_null())
+        .with_columns(
+            pl.col(col).fill_null(value) for col, value in CLIENT_DEFAULTS.items()
+        )
+        .with_columns(
+            bands(pl.col("net_worth"), NET_WORTH_BANDS).alias("net_worth_category")
+        )
+    )
+    if clients.select(pl.col("id").is_duplicated().any()).collect().item():
+        raise ValueError("Client index: duplicate client ids")
+
+    def to_pandas(frame: pl.LazyFrame) -> pd.DataFrame:
+        return frame.collect(engine="streaming").to_pandas()
+
+    count_sum = [
+        pl.col("amount").count().cast(pl.Int64).alias("count"),
+        pl.col("amount").sum().alias("sum"),
+    ]
+    # Windows start at the last transaction's timestamp minus the window
+    last = pl.col("transaction_date").max()
+    windows = {
+        window: pl.col("transaction_date")
+        >= last.dt.offset_by(
+            "".join(f"-{n}{_POLARS_UNITS[unit]}" for unit, n in offset.kwds.items())
+        )
+        for window, offset in WINDOWS.items()
+    }
+
+    # The joined table is streamed to disk once and scanned by every aggregate
+    with tempfile.TemporaryDirectory() as spill_dir:
+        merged_file = Path(spill_dir) / "merged.parquet"
+        transactions.join(
+            clients, left_on="client_id", right_on="id", how="inner"
+        ).sink_parquet(merged_file)
+        merged = pl.scan_parquet(merged_file)
+
+        groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series] = {}
+        for window, by in _plans(metrics):
+            frame = merged if window == "all" else merged.filter(windows[window])
+            if by is None:
+                groups[(window, by)] = to_pandas(frame.select(count_sum)).iloc[0]
+                continue
+            table = to_pandas(
+                frame.filter(pl.col(by).is_not_null()).group_by(by).agg(count_sum)
+            )
+            groups[(window, by)] = _group_order(table.set_index(by), by)
+
+        monthly = {}
+        for by in (None, *FORECAST_KEYS):
+            keys = [pl.col("transaction_date").dt.truncate("1mo").alias("month")]
+            if by is not None:
+                keys.append(pl.col(by))
+            monthly[by] = _monthly_table(
+                to_pandas(
+                    merged.group_by(keys).agg(
+                        pl.col("amount").count().cast(pl.Int64).alias("count"),
+                        pl.col("amount").sum().alias("amount"),
+                    )
+                ),
+                by,
+            )
+
+        # Per client first, then per segment, see _duckdb_aggregates
+        segments = {}
+        for by in SEGMENT_KEYS:
+            per_client = merged.group_by("client_id").agg(
+                pl.col(by).first(),
+                pl.len().alias("frequency"),
+                pl.col("amount").sum().alias("monetary"),
+                pl.col("transaction_date").min().alias("first_date"),
+                pl.col("transaction_date").max().alias("last_date"),
+            )
+            last_date = pl.col("last_date")
+            table = to_pandas(
+                per_client.with_columns(
+                    (last_date.max() - last_date).dt.total_days().alias("recency"),
+                    (last_date - pl.col("first_date")).dt.total_days().alias("tenure"),
+                )
+                .filter(pl.col(by).is_not_null())
+                .group_by(by)
+                .agg(
+                    pl.len().cast(pl.Int64).alias("clients"),
+                    pl.col("monetary").sum().alias("revenue"),
+                    pl.col("frequency").sum().cast(pl.Int64).alias("transactions"),
+                    pl.col("frequency").mean().alias("avg_frequency"),
+                    pl.col("recency").mean().alias("avg_recency_days"),
+                    pl.col("tenure").mean().alias("avg_tenure_days"),
+                )
+            )
+            segments[by] = _group_order(table.set_index(by), by)
+
+    return Aggregates(groups, monthly, segments)
+
+
+def _sharded_aggregates(
+    transactions_file: Path, clients_file: Path, metrics: dict[str, Metric]
+) -> Aggregates:
+    # pandas on shards of the data in a process pool, see src/sharded.py
+    from .sharded import sharded_aggregates
+
+    return sharded_aggregates(transactions_file, clients_file, metrics)
+
+
+BACKENDS: dict[str, Callable[[Path, Path, dict[str, Metric]], Aggregates]] = {
+    "pandas": _pandas_aggregates,
+    "duckdb": _duckdb_aggregates,
+    "polars": _polars_aggregates,
+    "sharded": _sharded_aggregates,
+}
+
+# Backends built on pandas alone
+BUILTIN_BACKENDS = ("pandas", "sharded")
+
+
+def available_backends() -> list[str]:
+    # The engines are optional dependencies
+    return [
+        name
+        for name in BACKENDS
+        if name in BUILTIN_BACKENDS or importlib.util.find_spec(name) is not None
+    ]
+
+
+def analyze_files(
+    transactions_file: Path,
+    clients_file: Path,
+    backend: str = "pandas",
+    metrics: dict[str, Metric] = METRICS,
+) -> dict:
+    if backend not in available_backends():
+        raise ImportError(f"Backend {backend}: install the {backend} package")
+
+    aggregates = measure(
+        f"backend.{backend}.aggregates",
+        BACKENDS[backend],
+        as_parquet(transactions_file),
+        as_parquet(clients_file),
+        metrics,
+    )
+    return results_from_aggregates(aggregates, metrics)
+
+
+def results_from_aggregates(
+    aggregates: Aggregates, metrics: dict[str, Metric] = METRICS
+) -> dict:
+    # Results have the same keys and types as run_analysis
+    results = finalize_metrics(aggregates.groups, metrics)
+    results["forecast_next_month"] = forecast_from_monthly(aggregates.monthly[None])
+    for by in FORECAST_KEYS:
+        results[f"forecast_next_month_by_{by}"] = forecast_groups(
+            aggregates.monthly[by]
+        )
+    results["monthly_totals"] = aggregates.monthly[None]
+    for by in SEGMENT_KEYS:
+        results[f"client_segments_by_{by}"] = segment_summary(aggregates.segments[by])
+    return results
+
+
+def run_backend_analysis(
+    transactions_file: Path, clients_file: Path, backend: str, save_file_name: Path
+) -> dict:
+    results = analyze_files(transactions_file, clients_file, backend)
+    save_results(results, save_file_name)
+    return results
+
+
+def _mismatches(expected: object, actual: object, name: str) -> list[str]:
+    if isinstance(expected, pd.DataFrame):
+        if not (
+            expected.index.equals(actual.index)
+            and expected.columns.equals(actual.columns)
+        ):
+            return [f"{name}: labels differ"]
+        if not np.allclose(expected, actual, rtol=PARITY_RTOL, atol=0):
+            return [f"{name}: values differ"]
+        return []
+    if isinstance(expected, pd.Series):
+        expected, actual = expected.to_dict(), actual.to_dict()
+    if isinstance(expected, dict):
+        if list(expected) != list(actual):
+            missing = [str(key) for key in expected if key not in actual]
+            extra = [str(key) for key in actual if key not in expected]
+            return [
+                f"{name}: keys or their order differ"
+                + (f", missing {missing}" if missing else "")
+                + (f", extra {extra}" if extra else "")
+            ]
+        return [
+            mismatch
+            for key in expected
+            for mismatch in _mismatches(expected[key], actual[key], f"{name}.{key}")
+        ]
+    if not math.isclose(expected, actual, rel_tol=PARITY_RTOL):
+        return [f"{name}: {expected} != {actual}"]
+    return []
+
+
+def check_parity(
+    transactions_file: Path,
+    clients_file: Path,
+    backends: Optional[Sequence[str]] = None,
+) -> dict[str, list[str]]:
+    # Differences of every backend's results from the pandas path, which
+    # must itself have every key of run_analysis
+    expected = analyze_files(transactions_file, clients_file, "pandas")
+    if list(expected) != result_keys():
+        return {"pandas": ["results: keys differ from run_analysis"]}
+    return {
+        backend: _mismatches(
+            expected,
+            analyze_files(transactions_file, clients_file, backend),
+            "results",
+        )
+        for backend in backends or available_backends()
+        if backend != "pandas"
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.backends",
+        description="Check that every backend matches the pandas results",
+    )
+    parser.add_argument(
+        "--transactions", type=Path, default=Path("data") / "transactions_data.xlsx"
+    )
+    parser.add_argument(
+        "--clients", type=Path, default=Path("data") / "clients_data.json"
+    )
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS))
+    args = parser.parse_args(argv)
+
+    for backend in set(args.backend or BACKENDS) - set(available_backends()):
+        print(f"{backend}: not installed, skipped")
+    backends = [b for b in args.backend or BACKENDS if b in available_backends()]
+
+    failed = False
+    for backend, mismatches in check_parity(
+        args.transactions, args.clients, backends
+    ).items():
+        print(f"{backend}: {'OK' if not mismatches else 'MISMATCH'}")
+        for mismatch in mismatches:
+            print(f"  {mismatch}")
+        failed |= bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable
+import argparse
+import json
+import subprocess
+import sys
+import tracemalloc
+import pandas as pd
+
+from . import analysis, forecast, plot_analysis
+from .clean_data import clean_clients, clean_transactions, merge_tables
+from .generate_md_report import generate_md_report
+from .readers import read_excel_streaming, read_json_streaming
+from .synthetic import write_dataset
+from .utils import audit_df
+
+BASELINE_FILE = Path("benchmarks") / "baseline.json"
+DATA_DIR = Path("data") / "synthetic"
+
+# A stage regresses when it is slower or bigger than baseline * threshold;
+# stages under the noise floor are never reported
+THRESHOLDS = {"seconds": 1.3, "peak_bytes": 1.2}
+NOISE_FLOOR = {"seconds": 0.05, "peak_bytes": 1 << 20}
+
+ANALYSIS_FUNCTIONS = list(analysis.METRICS)
+
+_READERS = {".parquet": pd.read_parquet, ".xlsx": read_excel_streaming}
+
+# Commands other than report must start without these
+HEAVY_MODULES = ("matplotlib", "seaborn")
+STARTUP_RUNS = 5
+
+# Time to a CLI ready to run: imports, argument parsing and the stage graph.
+# Peak memory is the child's own VmHWM: ru_maxrss survives exec and would
+# report the parent's peak instead
+_STARTUP_SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+from src import cli
+from src.stages import build_stages
+cli.build_parser().parse_args(["analyze"])
+build_stages()
+seconds = time.perf_counter() - start
+heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+with open("/proc/self/status") as status:
+    peak = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:"))
+print(seconds, peak, ",".join(heavy))
+"""
+
+
+def parse_size(size: str) -> int:
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    suffix = size[-1].lower()
+    if suffix in multipliers:
+        return int(float(size[:-1]) * multipliers[suffix])
+    return int(size)
+
+
+def _measure(stats: dict, name: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+    # Peak is measured relative to what was already allocated before the stage
+    base, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+
+    stats[name] = {"seconds": round(seconds, 4), "peak_bytes": peak - base}
+    print(f"  {name}: {seconds:.3f}s, {(peak - base) / 2**20:.1f} MiB")
+    return result
+
+
+def benchmark_size(n_rows: int, data_dir: Path = DATA_DIR) -> dict:
+    transactions_file = data_dir / f"transactions_{n_rows}.parquet"
+    clients_file = data_dir / f"clients_{n_rows}.json"
+    if not (transactions_file.exists() and clients_file.exists()):
+        transactions_file, clients_file = write_dataset(n_rows, data_dir)
+
+    stats: dict = {}
+    print(f"Benchmark: {n_rows} rows")
+    tracemalloc.start()
+    try:
+        transactions_raw = _measure(
+            stats,
+            "load_transactions",
+            _READERS[transactions_file.suffix],
+            transactions_file,
+        )
+        clients_raw = _measure(stats, "load_clients", read_json_streaming, clients_file)
+
+        _measure(
+            stats,
+            "audit_raw_transactions",
+            audit_df,
+            transactions_raw,
+            str_value_counts_exclude_col=["transaction_id", "client_id"],
+        )
+        _measure(
+            stats,
+            "audit_raw_clients",
+            audit_df,
+            clients_raw,
+            str_value_counts_exclude_col=["id"],
+        )
+
+        transactions = _measure(
+            stats, "clean_transactions", clean_transactions, transactions_raw
+        )
+        clients = _measure(stats, "clean_clients", clean_clients, clients_raw)
+        del transactions_raw, clients_raw
+
+        merged_df = _measure(stats, "merge_tables", merge_tables, transactions, clients)
+        del transactions, clients
+
+        results = {
+            name: _measure(stats, name, getattr(analysis, name), merged_df)
+            for name in ANALYSIS_FUNCTIONS
+        }
+        monthly = _measure(stats, "monthly_totals", forecast.monthly_totals, merged_df)
+        results["forecast_next_month"] = _measure(
+            stats, "forecast_next_month", forecast.forecast_from_monthly, monthly
+        )
+        for by in forecast.FORECAST_KEYS:
+            results[f"forecast_next_month_by_{by}"] = _measure(
+                stats,
+                f"forecast_next_month_by_{by}",
+                forecast.forecast_next_month_by,
+                merged_df,
+                by,
+            )
+        results["monthly_totals"] = monthly
+
+        with TemporaryDirectory() as tmp_dir:
+            plots_dir = Path(tmp_dir) / "plots"
+            plots_dir.mkdir()
+            for name, func, data in [
+                (
+                    "plot_services_by_transaction_amount",
+                    plot_analysis.plot_services_by_transaction_amount,
+                    results["services_by_transaction_amount"],
+                ),
+                (
+                    "plot_client_net_worth_category_total_amount",
+                    plot_analysis.plot_client_net_worth_category_total_amount,
+                    results["client_net_worth_category_total_amount"],
+                ),
+                (
+                    "plot_payment_method_pie",
+                    plot_analysis.plot_payment_method_pie,
+                    results["payment_method_percentage"],
+                ),
+                (
+                    "plot_avg_transaction_by_age",
+                    plot_analysis.plot_avg_transaction_by_age,
+                    results["avg_transaction_amount_by_client_age"],
+                ),
+                (
+                    "plot_last_month_amount_by_service",
+                    plot_analysis.plot_last_month_amount_by_service,
+                    results["last_month_amount_by_service"],
+                ),
+                (
+                    "plot_amount_distribution",
+                    plot_analysis.plot_amount_distribution,
+                    merged_df["amount"],
+                ),
+            ]:
+                _measure(stats, name, func, data, plots_dir)
+            _measure(
+                stats,
+                "plot_forecast",
+                plot_analysis.plot_forecast,
+                monthly,
+                results["forecast_next_month"],
+                plots_dir,
+            )
+
+            _measure(
+                stats,
+                "generate_md_report",
+                generate_md_report,
+                results,
+                df=merged_df,
+                save_file_path=Path(tmp_dir) / "report.md",
+                plot_workers=1,
+            )
+    finally:
+        tracemalloc.stop()
+
+    return stats
+
+
+def benchmark_startup(runs: int = STARTUP_RUNS) -> tuple[dict, list[str]]:
+    # Best of several runs in a fresh interpreter, so module caches of this
+    # process don't hide import costs
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _STARTUP_SCRIPT],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        samples.append((float(out[0]), int(out[1]), out[2] if len(out) > 2 else ""))
+
+    seconds, peak, heavy = min(samples)
+    print(f"Startup: {seconds:.3f}s, {peak / 2**20:.1f} MiB RSS")
+    return {"cli": {"seconds": round(seconds, 4), "peak_bytes": peak}}, [
+        m for m in heavy.split(",") if m
+    ]
+
+
+def run_benchmarks(sizes: list[int], data_dir: Path = DATA_DIR) -> dict:
+    return {str(n_rows): benchmark_size(n_rows, data_dir) for n_rows in sizes}
+
+
+def find_regressions(results: dict, baseline: dict) -> list[str]:
+    thresholds = baseline.get("thresholds", THRESHOLDS)
+    regressions = []
+    for size, stages in results.items():
+        for stage, stats in stages.items():
+            base = baseline.get("sizes", {}).get(size, {}).get(stage)
+            if base is None:
+                continue
+            for measure, threshold in thresholds.items():
+                limit = max(base[measure] * threshold, NOISE_FLOOR[measure])
+                if stats[measure] > limit:
+                    regressions.append(
+                        f"{size} rows, {stage}: {measure} {stats[measure]} > "
+                        f"{base[measure]} * {threshold}"
+                    )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages")
+    parser.add_argument("--sizes", nargs="+", default=["1M", "10M", "50M"])
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument(
+        "--startup", action="store_true", help="only run the startup check"
+    )
+    args = parser.parse_args()
+
+    # Startup runs before the heavy stages so they can't skew its timing
+    startup, heavy_modules = benchmark_startup()
+    results = {"startup": startup}
+    if not args.startup:
+        results.update(
+            run_benchmarks([parse_size(s) for s in args.sizes], args.data_dir)
+        )
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {"thresholds": THRESHOLDS, "sizes": {}}
+        if args.baseline.exists():
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline["sizes"].update(results)
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline saved: {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, nothing to compare")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        regressions = find_regressions(results, json.load(f))
+    regressions += [f"startup imports {module}" for module in heavy_modules]
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
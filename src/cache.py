@@ -0,0 +1,117 @@
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+import hashlib
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .memo import code_hash
+
+CACHE_DIR = Path(".cache") / "raw"
+
+# Suffix of the helper column that keeps non-datetime values of a mixed column
+_RAW_SUFFIX = "__raw"
+
+_stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+
+
+def source_hash(path: Path, reader_name: str, options: dict) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(reader_name.encode())
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def source_id(path: Path, reader_name: str) -> str:
+    # Entries are named by the resolved path and the reader, so a new version
+    # of a source only replaces the entries of that file read that way, not
+    # those of another file with the same name in a different directory
+    return hashlib.sha256(f"{path.resolve()}:{reader_name}".encode()).hexdigest()[:16]
+
+
+def _is_mixed_datetime(series: pd.Series) -> bool:
+    if series.dtype != object:
+        return False
+    try:
+        pa.array(series, from_pandas=True)
+        return False
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return True
+
+
+def _encode(df: pd.DataFrame) -> pa.Table:
+    # Excel columns with both dates and garbage strings (e.g. "INVALID_DATE")
+    # are stored as a timestamp column plus a string column with the rest
+    df = df.copy()
+    mixed_cols = [col for col in df.columns if _is_mixed_datetime(df[col])]
+    for col in mixed_cols:
+        is_str = df[col].map(lambda x: isinstance(x, str))
+        df[col + _RAW_SUFFIX] = df[col].where(is_str).astype("str")
+        df[col] = pd.to_datetime(df[col].where(~is_str))
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"mixed_cols"] = json.dumps(mixed_cols).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def _decode(table: pa.Table) -> pd.DataFrame:
+    mixed_cols = json.loads((table.schema.metadata or {}).get(b"mixed_cols", b"[]"))
+    df = table.to_pandas()
+    for col in mixed_cols:
+        raw = df.pop(col + _RAW_SUFFIX)
+        df[col] = df[col].astype(object).where(raw.isna(), raw.astype(object))
+    return df
+
+
+def cached_read(
+    path: Path,
+    reader: Callable[..., pd.DataFrame],
+    cache_dir: Path = CACHE_DIR,
+    **options,
+) -> pd.DataFrame:
+    # The reader's code and constants are part of the key: editing the dtypes
+    # or the parser gives a new entry instead of the old parse
+    key = source_hash(path, f"{reader.__name__}:{code_hash(reader)}", options)
+    source = source_id(path, reader.__name__)
+    cache_file = cache_dir / f"{source}-{key[:16]}.arrow"
+    meta_file = cache_file.with_suffix(".json")
+
+    if cache_file.exists() and meta_file.exists():
+        start = perf_counter()
+        # Uncompressed IPC files are memory-mapped, numeric buffers are not copied
+        df = _decode(feather.read_table(cache_file, memory_map=True))
+        elapsed = perf_counter() - start
+
+        with open(meta_file, encoding="utf-8") as f:
+            parse_seconds = json.load(f)["parse_seconds"]
+        _stats["hits"] += 1
+        _stats["saved_seconds"] += max(parse_seconds - elapsed, 0.0)
+        return df
+
+    start = perf_counter()
+    df = reader(path, **options)
+    parse_seconds = perf_counter() - start
+    _stats["misses"] += 1
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Remove entries of previous versions of the same source file
+    for stale in cache_dir.glob(f"{source}-*"):
+        stale.unlink()
+    feather.write_feather(_encode(df), cache_file, compression="uncompressed")
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump({"source": str(path), "parse_seconds": parse_seconds}, f)
+
+    return df
+
+
+def cache_stats() -> str:
+    return (
+        f"Cache: {_stats['hits']} hits, {_stats['misses']} misses, "
+        f"{_stats['saved_seconds']:.2f}s saved"
+    )
@@ -1,62 +1,128 @@
-import uuid
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Sequence
+import tempfile
 import pandas as pd
 
+from .dedup import DedupIndex, hash_ids, synthetic_ids
+from .dimension import CLIENT_COLUMNS, ClientIndex, build_client_index, lookup
+from .validation import (
+    CLIENT_RULES,
+    TRANSACTION_RULES,
+    row_rules,
+    violations,
+    write_quarantine,
+)
+
+# Values that stand in for missing fields after the critical ones are checked
+TRANSACTION_DEFAULTS = {
+    "payment_method": "Неизвестно",
+    "service": "Неизвестная услуга",
+    "city": "Неизвестный город",
+    "consultant": "Неизвестный консультант",
+}
+CLIENT_DEFAULTS = {"gender": "Неизвестно", "net_worth": 0}
+
+
+def _prepare_transactions(
+    df: pd.DataFrame, occurrences: Optional[dict[int, int]] = None
+) -> pd.DataFrame:
+    # Standardize date format; invalid dates become missing
+    df = df.assign(
+        transaction_date=pd.to_datetime(df["transaction_date"], errors="coerce")
+    )
 
-def clean_transactions(raw_df: pd.DataFrame) -> pd.DataFrame:
-    df = raw_df.copy()
+    # Fill missing transaction_id with a synthetic id derived from the row, so
+    # rows without an id are kept apart and get the same id on every run
+    missing = df["transaction_id"].isna() & df[
+        ["client_id", "amount", "transaction_date"]
+    ].notna().all(axis=1)
+    if missing.any():
+        df.loc[missing, "transaction_id"] = synthetic_ids(df.loc[missing], occurrences)
+    return df
 
-    # Drop rows with missing critical fields
-    df = df.dropna(subset=["client_id", "amount"])
 
-    # Standardize date format and handle invalid dates
-    df["transaction_date"] = pd.to_datetime(df["transaction_date"], errors="coerce")
-    df = df.dropna(subset=["transaction_date"])
+def _fill_transaction_defaults(df: pd.DataFrame) -> pd.DataFrame:
+    # Fill missing values in categorical fields
+    return df.fillna(TRANSACTION_DEFAULTS)
 
-    # Fill missing transaction_id with uuid
-    df["transaction_id"] = df["transaction_id"].fillna(str(uuid.uuid4()))
 
-    # Remove transactions with non-positive amounts
-    df = df.loc[df["amount"] > 0]
+def clean_transactions(
+    raw_df: pd.DataFrame,
+    quarantine_file: Optional[Path] = None,
+    occurrences: Optional[dict[int, int]] = None,
+) -> pd.DataFrame:
+    # Batches of one feed pass the occurrence counts of id-less rows on, so
+    # their synthetic ids are those of one clean of all the batches' rows
+    df = _prepare_transactions(raw_df, occurrences)
 
-    # Drop duplicates
-    df = df.drop_duplicates(subset=["transaction_id"])
+    # Every rule, duplicates included, goes into one bitmask per row; the
+    # clean table is taken once by it and rejected rows can be quarantined
+    bits = violations(df, TRANSACTION_RULES)
+    if quarantine_file is not None:
+        write_quarantine(raw_df, bits, TRANSACTION_RULES, quarantine_file)
 
-    # Fill missing values in categorical fields
-    df["payment_method"] = df["payment_method"].fillna("Неизвестно")
-    df["service"] = df["service"].fillna("Неизвестная услуга")
-    df["city"] = df["city"].fillna("Неизвестный город")
-    df["consultant"] = df["consultant"].fillna("Неизвестный консультант")
+    df = _fill_transaction_defaults(df.loc[bits == 0])
 
     df = df.reset_index(drop=True)
 
     return df
 
 
-def clean_clients(raw_df: pd.DataFrame) -> pd.DataFrame:
-    df = raw_df.copy()
+def iter_clean_transactions(
+    raw_chunks: Iterable[pd.DataFrame],
+) -> Iterator[pd.DataFrame]:
+    # Ids yielded so far live in an on-disk dedup index, so memory stays bounded
+    # however many chunks there are. Identical id-less rows are numbered over
+    # all chunks, so their synthetic ids match those of clean_transactions
+    occurrences: dict[int, int] = {}
+    with tempfile.TemporaryDirectory() as index_dir:
+        seen = DedupIndex(Path(index_dir))
+        for raw_chunk in raw_chunks:
+            df = _prepare_transactions(raw_chunk, occurrences)
+            df = df.loc[violations(df, row_rules(TRANSACTION_RULES)) == 0]
+
+            # Drop ids repeated within the chunk or seen in previous chunks
+            df = df.loc[seen.add(hash_ids(df["transaction_id"]))]
+            seen.flush()
 
-    # Drop rows with missing critical fields
-    df = df.dropna(subset=["id"])
+            yield _fill_transaction_defaults(df)
+
+
+def clean_transactions_chunked(raw_chunks: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat(iter_clean_transactions(raw_chunks), ignore_index=True)
+
+
+def clean_clients(
+    raw_df: pd.DataFrame, quarantine_file: Optional[Path] = None
+) -> pd.DataFrame:
+    bits = violations(raw_df, CLIENT_RULES)
+    if quarantine_file is not None:
+        write_quarantine(raw_df, bits, CLIENT_RULES, quarantine_file)
 
     # Fill missing values
-    df["gender"] = df["gender"].fillna("Неизвестно")
-    df["net_worth"] = df["net_worth"].fillna(0)
+    df = raw_df.loc[bits == 0].fillna(CLIENT_DEFAULTS)
 
     df = df.reset_index(drop=True)
 
     return df
 
 
-def merge_tables(transactions: pd.DataFrame, clients: pd.DataFrame) -> pd.DataFrame:
-    merged_df = transactions.merge(
-        clients, left_on="client_id", right_on="id", how="left", indicator=True
-    )
+def merge_tables(
+    transactions: pd.DataFrame,
+    clients: pd.DataFrame | ClientIndex,
+    columns: Sequence[str] = CLIENT_COLUMNS,
+) -> pd.DataFrame:
+    index = clients if isinstance(clients, ClientIndex) else build_client_index(clients)
+    rows = lookup(index, transactions["client_id"])
+    matched = rows >= 0
 
-    # Remove unmatched transactions
-    unmatched_count = (merged_df["_merge"] != "both").sum()
+    # Unmatched transactions are only counted, never materialized
+    unmatched_count = (~matched).sum()
     if unmatched_count > 0:
         print(f"Merge: {unmatched_count} unmatched transactions found.")
-    merged_df = merged_df.loc[merged_df["_merge"] == "both"]
-    merged_df = merged_df.drop(columns="_merge")
 
-    return merged_df
+    # Only the client columns in use are pulled from the index
+    merged_df = transactions.loc[matched]
+    client_columns = index.table[list(columns)].take(rows[matched])
+    client_columns.index = merged_df.index
+    return pd.concat([merged_df, client_columns], axis=1)
@@ -0,0 +1,97 @@
+from pathlib import Path
+import argparse
+import sys
+
+# Stages each command runs, with everything they depend on; the modules
+# behind them are imported only once a command is chosen
+COMMANDS = {
+    "audit": ("audit_raw_transactions", "audit_raw_clients"),
+    "clean": ("audit_transactions", "audit_clients"),
+    "analyze": ("run_analysis",),
+    "report": ("generate_md_report",),
+    "segments": ("generate_segment_reports",),
+    "run": None,
+}
+
+# Names of src.backends.BACKENDS, kept here so parsing imports no engine code
+BACKENDS = ("pandas", "duckdb", "polars", "sharded")
+
+# src.segment_reports.SEGMENT_REPORT_KEYS, the segments command's default
+SEGMENT_REPORT_KEYS = ("city", "service", "consultant")
+
+COMMAND_HELP = {
+    "audit": "audit raw tables",
+    "clean": "clean tables and audit the result",
+    "analyze": "write analysis_results.json",
+    "report": "write report.md with plots",
+    "segments": "write a report per city, service and consultant with an index",
+    "run": "run every stage",
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.cli", description="Financial transactions analysis"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in COMMANDS:
+        subparser = subparsers.add_parser(command, help=COMMAND_HELP[command])
+        subparser.add_argument(
+            "--transactions", type=Path, default=Path("data") / "transactions_data.xlsx"
+        )
+        subparser.add_argument(
+            "--clients", type=Path, default=Path("data") / "clients_data.json"
+        )
+        subparser.add_argument(
+            "--output-dir", type=Path, default=Path("analysis_output")
+        )
+        subparser.add_argument("--compact", action="store_true")
+        subparser.add_argument(
+            "--backend",
+            choices=BACKENDS,
+            default="pandas",
+            help="engine for the analysis: duckdb and polars scan Parquet out of core, "
+            "sharded splits the data by client across worker processes",
+        )
+        subparser.add_argument("--workers", type=int, default=None)
+        subparser.add_argument(
+            "--segment-keys",
+            nargs="+",
+            default=SEGMENT_REPORT_KEYS if command == "segments" else (),
+            help="keys with a report per value, e.g. city service consultant",
+        )
+        subparser.add_argument("--profile", action="store_true")
+        subparser.add_argument("--no-cache", action="store_true")
+        subparser.add_argument(
+            "--dry-run", action="store_true", help="list stages that would rerun"
+        )
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    from .stages import build_stages, run_stages
+
+    stages = build_stages(
+        args.transactions,
+        args.clients,
+        args.output_dir,
+        compact=args.compact,
+        backend=args.backend,
+        segment_keys=args.segment_keys,
+    )
+    run_stages(
+        stages,
+        output_dir=args.output_dir,
+        targets=COMMANDS[args.command],
+        max_workers=args.workers,
+        profile=args.profile,
+        use_cache=not args.no_cache,
+        dry_run=args.dry_run,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
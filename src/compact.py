@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Optional
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+CATEGORICAL_COLS = ["service", "city", "payment_method", "consultant", "gender"]
+UUID_COLS = ["transaction_id", "client_id", "id"]
+
+# Join columns that duplicate another column after merge_tables
+REDUNDANT_COLS = {"id": "client_id"}
+
+UUID_DTYPE = pd.ArrowDtype(pa.binary(16))
+
+_HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_UUID_HEX_POSITIONS = np.array(
+    [i for i in range(36) if i not in (8, 13, 18, 23)], dtype=np.intp
+)
+
+
+def encode_uuid(series: pd.Series) -> pd.Series:
+    valid = series.notna().to_numpy()
+    hex_str = series.str.replace("-", "", regex=False).str.lower()
+    if not hex_str.dropna().str.fullmatch("[0-9a-f]{32}").all():
+        raise ValueError(f"{series.name}: not a UUID column")
+
+    raw = hex_str.fillna("0" * 32).to_numpy(dtype="S32")
+    digits = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(-1, 32)
+    nibbles = np.searchsorted(_HEX_DIGITS, digits).astype(np.uint8)
+    packed = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+
+    array = pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(16),
+        len(series),
+        [pa.array(valid).buffers()[1], pa.py_buffer(packed.tobytes())],
+    )
+    return pd.Series(array, index=series.index, name=series.name, dtype=UUID_DTYPE)
+
+
+def format_uuids(packed: np.ndarray) -> np.ndarray:
+    # (n, 16) uint8 -> n canonical 36-character UUID strings
+    chars = np.full((len(packed), 36), ord("-"), dtype=np.uint8)
+    chars[:, _UUID_HEX_POSITIONS[0::2]] = _HEX_DIGITS[packed >> 4]
+    chars[:, _UUID_HEX_POSITIONS[1::2]] = _HEX_DIGITS[packed & 0x0F]
+    return chars.view("S36").ravel().astype(str)
+
+
+def decode_uuid(series: pd.Series) -> pd.Series:
+    array = pa.chunked_array(pa.array(series)).combine_chunks()
+    packed = np.frombuffer(
+        array.buffers()[1],
+        dtype=np.uint8,
+        count=len(array) * 16,
+        offset=array.offset * 16,
+    ).reshape(-1, 16)
+
+    decoded = pd.Series(
+        format_uuids(packed), index=series.index, name=series.name
+    ).astype("str")
+    return decoded.where(series.notna())
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    redundant = [
+        col
+        for col, kept in REDUNDANT_COLS.items()
+        if col in df.columns and kept in df.columns
+    ]
+    df = df.drop(columns=redundant)
+
+    converted = {}
+    for col in df.columns:
+        if col in CATEGORICAL_COLS and df[col].dtype == "str":
+            converted[col] = df[col].astype("category")
+        elif col in UUID_COLS and df[col].dtype == "str":
+            try:
+                converted[col] = encode_uuid(df[col])
+            except ValueError:
+                # Non-UUID keys fall back to integer codes plus a dictionary
+                converted[col] = df[col].astype("category")
+    return df.assign(**converted)
+
+
+def expand_frame(df: pd.DataFrame) -> pd.DataFrame:
+    converted = {}
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and col in (
+            CATEGORICAL_COLS + UUID_COLS
+        ):
+            converted[col] = df[col].astype("str")
+        elif df[col].dtype == UUID_DTYPE:
+            converted[col] = decode_uuid(df[col])
+    return df.assign(**converted)
+
+
+def memory_report(
+    frames: dict[str, tuple[pd.DataFrame, pd.DataFrame]],
+    save_file_name: Optional[Path] = None,
+) -> dict:
+    report = {}
+    for name, (before, after) in frames.items():
+        bytes_before = before.memory_usage(deep=True, index=False)
+        bytes_after = after.memory_usage(deep=True, index=False)
+        report[name] = {
+            "bytes_before_by_col": {k: int(v) for k, v in bytes_before.items()},
+            "bytes_after_by_col": {k: int(v) for k, v in bytes_after.items()},
+            "bytes_before": int(bytes_before.sum()),
+            "bytes_after": int(bytes_after.sum()),
+        }
+
+    if save_file_name is not None:
+        with open(save_file_name, "w", encoding="utf-8") as f:
+            f.write(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f"Memory report saved: {save_file_name}")
+
+    return report
@@ -0,0 +1,230 @@
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Optional, Sequence
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .utils import NET_WORTH_BANDS, key_column
+
+# Keys of the daily cube; any roll-up over a subset of them is a query
+CUBE_KEYS = ("service", "city", "payment_method", "net_worth_category")
+
+CUBE_FILE = Path(".cache") / "cube" / "daily_cube.arrow"
+
+# Trailing windows ending on the last transaction, cut at its timestamp
+WINDOWS = {
+    "last_week": pd.DateOffset(weeks=1),
+    "last_month": pd.DateOffset(months=1),
+    "last_quarter": pd.DateOffset(months=3),
+}
+
+
+@dataclass(frozen=True)
+class DailyCube:
+    # Count and sum of amount per day and key combination, sorted by day
+    table: pd.DataFrame
+    # Rows from the earliest day a window can start on: a window's first day
+    # is partial, and its rows past the cutoff are summed from here
+    tail: pd.DataFrame
+
+
+def _categorize(table: pd.DataFrame) -> pd.DataFrame:
+    # Keys are categories in the order a groupby on the merged table gives:
+    # sorted labels, net worth bands from low to high
+    dtypes = {
+        key: pd.CategoricalDtype(sorted(table[key].dropna().unique()))
+        for key in CUBE_KEYS
+    }
+    dtypes["net_worth_category"] = pd.CategoricalDtype(
+        NET_WORTH_BANDS.labels, ordered=True
+    )
+    return table.astype(dtypes)
+
+
+def _rollup(table: pd.DataFrame) -> pd.DataFrame:
+    return (
+        table.groupby(["date", *CUBE_KEYS], observed=True, dropna=False)[
+            ["count", "amount"]
+        ]
+        .sum()
+        .reset_index()
+    )
+
+
+def _trim(tail: pd.DataFrame) -> pd.DataFrame:
+    # Later data only moves the last transaction forward, so rows before the
+    # first day of the longest window are never needed again
+    if tail.empty:
+        return tail
+    last = tail["transaction_date"].max()
+    first_day = min(last - offset for offset in WINDOWS.values()).normalize()
+    return tail.loc[tail["transaction_date"] >= first_day].reset_index(drop=True)
+
+
+def build_cube(df: pd.DataFrame) -> DailyCube:
+    day = df["transaction_date"].dt.normalize().rename("date")
+    keys = [key_column(df, key).rename(key) for key in CUBE_KEYS]
+    table = (
+        df["amount"]
+        .groupby([day, *keys], observed=True, dropna=False)
+        .agg(count="count", amount="sum")
+        .reset_index()
+    )
+    tail = pd.concat([df["transaction_date"], *keys, df["amount"]], axis=1).reset_index(
+        drop=True
+    )
+    return DailyCube(_categorize(table), _categorize(_trim(tail)))
+
+
+def update_cube(cube: DailyCube, new: DailyCube) -> DailyCube:
+    # Days and key combinations present in both are summed
+    as_object = {key: object for key in CUBE_KEYS}
+    table = pd.concat(
+        [cube.table.astype(as_object), new.table.astype(as_object)],
+        ignore_index=True,
+    )
+    tail = pd.concat(
+        [cube.tail.astype(as_object), new.tail.astype(as_object)], ignore_index=True
+    )
+    return DailyCube(_rollup(_categorize(table)), _categorize(_trim(tail)))
+
+
+def window_range(cube: DailyCube, window: str) -> tuple[pd.Timestamp, pd.Timestamp]:
+    # From the last transaction's timestamp back by the window
+    last = cube.tail["transaction_date"].max()
+    return last - WINDOWS[window], last
+
+
+def query(
+    cube: DailyCube,
+    start: Optional[pd.Timestamp | str] = None,
+    end: Optional[pd.Timestamp | str] = None,
+    by: Sequence[str] = (),
+    where: Optional[dict[str, object]] = None,
+) -> pd.DataFrame | pd.Series:
+    # Count and amount over the days from start to end, both included, per
+    # group of the by keys; a single total without them
+    dates = cube.table["date"].to_numpy()
+    lo = 0
+    hi = len(dates)
+    if start is not None:
+        lo = np.searchsorted(dates, pd.Timestamp(start).normalize().to_datetime64())
+    if end is not None:
+        hi = np.searchsorted(
+            dates, pd.Timestamp(end).normalize().to_datetime64(), side="right"
+        )
+    rows = cube.table.iloc[lo:hi]
+    for key, value in (where or {}).items():
+        rows = rows.loc[rows[key] == value]
+
+    if not by:
+        return rows[["count", "amount"]].sum()
+    return rows.groupby(list(by), observed=True)[["count", "amount"]].sum()
+
+
+def window_query(
+    cube: DailyCube, window: str, by: Sequence[str] = ()
+) -> pd.DataFrame | pd.Series:
+    # Whole days after the window's first day come from the cube; rows of the
+    # first day past the cutoff come from the tail
+    start, end = window_range(cube, window)
+    next_day = start.normalize() + pd.Timedelta(days=1)
+    days = query(cube, next_day, end, by=by)
+
+    dates = cube.tail["transaction_date"]
+    rows = cube.tail.loc[(dates >= start) & (dates < next_day)].astype(
+        {key: cube.table[key].dtype for key in by}
+    )
+    if not by:
+        first_day = pd.Series(
+            {"count": rows["amount"].count(), "amount": rows["amount"].sum()}
+        )
+        return days + first_day
+    first_day = rows.groupby(list(by), observed=True)["amount"].agg(
+        count="count", amount="sum"
+    )
+    total = days.add(first_day, fill_value=0)
+    return total.astype({"count": "int64"})
+
+
+def window_partials(
+    cube: DailyCube, plans: Sequence[tuple[str, str | None]]
+) -> dict[tuple[str, str | None], pd.DataFrame | pd.Series]:
+    # Count/sum pairs per (window, key) in the layout of group_partials
+    return {
+        (window, by): window_query(cube, window, by=() if by is None else (by,)).rename(
+            {"amount": "sum"}, axis=0 if by is None else 1
+        )
+        for window, by in plans
+    }
+
+
+def tail_file(save_file_name: Path = CUBE_FILE) -> Path:
+    return save_file_name.with_name(f"{save_file_name.stem}_tail.arrow")
+
+
+def save_cube(cube: DailyCube, save_file_name: Path = CUBE_FILE) -> None:
+    save_file_name.parent.mkdir(parents=True, exist_ok=True)
+    for df, path in (
+        (cube.table, save_file_name),
+        (cube.tail, tail_file(save_file_name)),
+    ):
+        feather.write_feather(
+            pa.Table.from_pandas(df, preserve_index=False),
+            path,
+            compression="uncompressed",
+        )
+    print(f"Daily cube saved: {save_file_name}")
+
+
+def load_cube(save_file_name: Path = CUBE_FILE) -> Optional[DailyCube]:
+    if not (save_file_name.exists() and tail_file(save_file_name).exists()):
+        return None
+    return DailyCube(
+        feather.read_feather(save_file_name),
+        feather.read_feather(tail_file(save_file_name)),
+    )
+
+
+def materialize_cube(
+    merged_df: pd.DataFrame, save_file_name: Path = CUBE_FILE
+) -> DailyCube:
+    cube = build_cube(merged_df)
+    save_cube(cube, save_file_name)
+    return cube
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.cube", description="Query the daily cube"
+    )
+    parser.add_argument("--cube", type=Path, default=CUBE_FILE)
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    parser.add_argument("--window", choices=list(WINDOWS))
+    parser.add_argument("--by", nargs="*", choices=CUBE_KEYS, default=[])
+    args = parser.parse_args(argv)
+
+    cube = load_cube(args.cube)
+    if cube is None:
+        print(f"No cube at {args.cube}, run the analysis first")
+        return 1
+
+    begin = perf_counter()
+    if args.window is not None:
+        result = window_query(cube, args.window, by=args.by)
+    else:
+        result = query(cube, args.start, args.end, by=args.by)
+    elapsed = perf_counter() - begin
+    print(result.to_string())
+    print(f"Query: {elapsed * 1000:.1f} ms over {len(cube.table)} cube rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+from pathlib import Path
+from typing import Iterator, Optional
+import json
+import math
+import numpy as np
+import pandas as pd
+
+from .compact import format_uuids
+
+DEDUP_DIR = Path(".cache") / "dedup"
+
+# Fields that identify a transaction without a transaction_id
+SYNTHETIC_ID_FIELDS = (
+    "client_id",
+    "transaction_date",
+    "service",
+    "amount",
+    "payment_method",
+    "city",
+    "consultant",
+)
+
+# Sorted runs of ids kept on disk before they are merged into one
+MAX_SEGMENTS = 16
+# Segments are merged one key range (top bits of the hash) at a time, so
+# merging never loads the whole set
+MERGE_BITS = 8
+
+
+def hash_ids(ids: pd.Series | np.ndarray) -> np.ndarray:
+    # 64-bit ids: a false duplicate among n ids has probability ~n^2 / 2^65
+    values = ids.to_numpy(dtype=object) if isinstance(ids, pd.Series) else ids
+    return pd.util.hash_array(values, categorize=False)
+
+
+def synthetic_ids(
+    df: pd.DataFrame, occurrences: Optional[dict[int, int]] = None
+) -> np.ndarray:
+    # UUID-formatted ids from the row's fields and its occurrence number among
+    # identical rows, so the same rows get the same ids on every run and
+    # identical rows still get distinct ids. For chunks of one table, the
+    # occurrences dict carries the count of every row hash to the next chunk
+    fields = df[list(SYNTHETIC_ID_FIELDS)]
+    occurrence = fields.groupby(
+        list(fields.columns), dropna=False, sort=False
+    ).cumcount()
+    if occurrences is not None:
+        row_hashes = pd.util.hash_pandas_object(fields, index=False).to_numpy()
+        unique, inverse, counts = np.unique(
+            row_hashes, return_inverse=True, return_counts=True
+        )
+        seen = np.array([occurrences.get(int(h), 0) for h in unique], dtype=np.int64)
+        occurrence = occurrence + seen[inverse]
+        for h, count in zip(unique.tolist(), (seen + counts).tolist()):
+            occurrences[h] = count
+    keyed = fields.assign(occurrence=occurrence)
+
+    # Two independently keyed 64-bit hashes make the 128 bits of a UUID
+    halves = [
+        pd.util.hash_pandas_object(keyed, index=False, hash_key=key).to_numpy()
+        for key in ("aton-synthetic-1", "aton-synthetic-2")
+    ]
+    packed = np.column_stack(halves).astype(">u8").view(np.uint8).reshape(-1, 16)
+    # Version 4 and RFC 4122 variant bits, like the ids in the source data
+    packed[:, 6] = (packed[:, 6] & 0x0F) | 0x40
+    packed[:, 8] = (packed[:, 8] & 0x3F) | 0x80
+    return format_uuids(packed)
+
+
+class BloomFilter:
+    # Blocked Bloom filter: all bits of an id fall in one 64-bit word, so an
+    # insert or a lookup touches one word instead of n_hashes bytes.
+    # Blocking costs accuracy, made up for with half again as many bits
+    def __init__(self, words: np.ndarray, n_hashes: int) -> None:
+        self.words = words
+        self.n_words = np.uint64(len(words))
+        self.n_hashes = n_hashes
+
+    @staticmethod
+    def size(capacity: int, false_positive_rate: float) -> tuple[int, int]:
+        n_bits = -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        n_hashes = max(1, round(n_bits / capacity * math.log(2)))
+        return math.ceil(n_bits * 1.5 / 64), n_hashes
+
+    def _locate(self, hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Word from the hash, bits within it from a remix of the same 64 bits
+        word = (hashes % self.n_words).astype(np.intp)
+        mixed = (hashes ^ (hashes >> np.uint64(33))) * np.uint64(0xFF51AFD7ED558CCD)
+        mask = np.zeros(len(hashes), dtype=np.uint64)
+        for i in range(self.n_hashes):
+            mask |= np.uint64(1) << ((mixed >> np.uint64(6 * i)) & np.uint64(63))
+        return word, mask
+
+    def add(self, hashes: np.ndarray) -> None:
+        word, mask = self._locate(hashes)
+        np.bitwise_or.at(self.words, word, mask)
+
+    def might_contain(self, hashes: np.ndarray) -> np.ndarray:
+        word, mask = self._locate(hashes)
+        return (self.words[word] & mask) == mask
+
+
+class DedupIndex:
+    # On-disk set of seen transaction id hashes: a memory-mapped Bloom filter
+    # answers most lookups of new ids, the rest search sorted segment files.
+    # Inserts stay pending in memory until flush(), so a batch is either
+    # fully recorded or not at all
+    def __init__(
+        self,
+        index_dir: Path = DEDUP_DIR,
+        capacity: int = 10_000_000,
+        false_positive_rate: float = 0.01,
+    ) -> None:
+        self.index_dir = index_dir
+        self.false_positive_rate = false_positive_rate
+        (index_dir / "segments").mkdir(parents=True, exist_ok=True)
+
+        meta_file = index_dir / "meta.json"
+        if meta_file.exists():
+            with open(meta_file, encoding="utf-8") as f:
+                meta = json.load(f)
+        else:
+            meta = {"count": 0, "capacity": capacity, "next_segment": 0}
+        self.count = meta["count"]
+        self.capacity = meta["capacity"]
+        self.next_segment = meta["next_segment"]
+
+        self.bloom = self._open_bloom(self.capacity)
+        self.pending = np.empty(0, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return self.count + len(self.pending)
+
+    def _open_bloom(self, capacity: int) -> BloomFilter:
+        n_words, n_hashes = BloomFilter.size(capacity, self.false_positive_rate)
+        bloom_file = self.index_dir / f"bloom_{capacity}.npy"
+        if bloom_file.exists():
+            words = np.lib.format.open_memmap(bloom_file, mode="r+")
+        else:
+            words = np.lib.format.open_memmap(
+                bloom_file, mode="w+", dtype=np.uint64, shape=(n_words,)
+            )
+        return BloomFilter(words, n_hashes)
+
+    def _segments(self) -> list[Path]:
+        return sorted((self.index_dir / "segments").glob("*.npy"))
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(hashes), dtype=bool)
+        candidates = np.flatnonzero(self.bloom.might_contain(hashes))
+        if len(candidates) == 0:
+            return found
+
+        values = hashes[candidates]
+        hits = contains_sorted(self.pending, values)
+        for segment_file in self._segments():
+            segment = np.load(segment_file, mmap_mode="r")
+            hits |= contains_sorted(segment, values)
+        found[candidates] = hits
+        return found
+
+    def add(self, hashes: np.ndarray) -> np.ndarray:
+        # Marks the first occurrence of every hash not seen before as new and
+        # records it; repeats within the batch are not new
+        is_new = ~pd.Series(hashes).duplicated().to_numpy()
+        is_new[is_new] = ~self.contains(hashes[is_new])
+
+        # New hashes are in neither the segments nor pending, so pending stays
+        # a sorted set without deduplicating it again
+        new = hashes[is_new]
+        self.bloom.add(new)
+        self.pending = np.sort(np.concatenate([self.pending, new]))
+        return is_new
+
+    def flush(self) -> None:
+        if len(self.pending) > 0:
+            segment_file = (
+                self.index_dir / "segments" / f"segment_{self.next_segment:08d}.npy"
+            )
+            np.save(segment_file, self.pending)
+            self.next_segment += 1
+            self.count += len(self.pending)
+            self.pending = np.empty(0, dtype=np.uint64)
+
+        if len(self._segments()) > MAX_SEGMENTS:
+            self._merge_segments()
+        if self.count > self.capacity:
+            self._grow()
+        self.bloom.words.flush()
+
+        # Replaced in one step, so a crash never leaves half a meta file
+        meta_file = self.index_dir / "meta.json"
+        with open(meta_file.with_suffix(".json.tmp"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "count": self.count,
+                    "capacity": self.capacity,
+                    "next_segment": self.next_segment,
+                },
+                f,
+                indent=2,
+            )
+        meta_file.with_suffix(".json.tmp").replace(meta_file)
+
+    def _iter_ranges(self, segment_files: list[Path]) -> Iterator[np.ndarray]:
+        # Every segment sliced to the same key range, one range at a time
+        segments = [np.load(path, mmap_mode="r") for path in segment_files]
+        bounds = [
+            np.searchsorted(segment, _range_starts()).tolist() + [len(segment)]
+            for segment in segments
+        ]
+        for i in range(1 << MERGE_BITS):
+            parts = [
+                np.asarray(segment[bound[i] : bound[i + 1]])
+                for segment, bound in zip(segments, bounds)
+            ]
+            yield np.sort(np.concatenate(parts))
+
+    def _merge_segments(self) -> None:
+        segment_files = self._segments()
+        merged_file = (
+            self.index_dir / "segments" / f"segment_{self.next_segment:08d}.npy"
+        )
+        self.next_segment += 1
+
+        # Segments hold no duplicates between them, so the merge has count ids
+        total = 0
+        out = np.lib.format.open_memmap(
+            merged_file.with_suffix(".tmp"),
+            mode="w+",
+            dtype=np.uint64,
+            shape=(self.count,),
+        )
+        for part in self._iter_ranges(segment_files):
+            out[total : total + len(part)] = part
+            total += len(part)
+        out.flush()
+        del out
+
+        merged_file.with_suffix(".tmp").replace(merged_file)
+        for path in segment_files:
+            path.unlink()
+
+    def _grow(self) -> None:
+        old_file = self.index_dir / f"bloom_{self.capacity}.npy"
+        self.capacity = max(self.capacity * 2, self.count * 2)
+        self.bloom = self._open_bloom(self.capacity)
+        for part in self._iter_ranges(self._segments()):
+            self.bloom.add(part)
+        old_file.unlink(missing_ok=True)
+
+
+def _range_starts() -> np.ndarray:
+    return np.arange(1 << MERGE_BITS, dtype=np.uint64) << np.uint64(64 - MERGE_BITS)
+
+
+def contains_sorted(sorted_values: np.ndarray, values: np.ndarray) -> np.ndarray:
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    idx = np.searchsorted(sorted_values, values).clip(max=len(sorted_values) - 1)
+    return sorted_values[idx] == values
@@ -0,0 +1,68 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+from .utils import NET_WORTH_BANDS, bucketize
+
+# Client columns the analyses and the report read after the join
+CLIENT_COLUMNS = ("age", "gender", "net_worth", "net_worth_category")
+
+INDEX_DIR = Path(".cache") / "clients"
+
+
+@dataclass(frozen=True)
+class ClientIndex:
+    # Client rows; a client's row position is its position in ids
+    table: pd.DataFrame
+    ids: pa.Array
+    id_col: str = "id"
+
+
+def _arrow_ids(ids: pd.Series) -> pa.Array:
+    array = pa.array(ids)
+    # Categorical ids (compact mode fallback) are looked up by value
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    return array
+
+
+def build_client_index(clients: pd.DataFrame, id_col: str = "id") -> ClientIndex:
+    if clients[id_col].duplicated().any():
+        raise ValueError("Client index: duplicate client ids")
+
+    # Client-level bands are computed once per client, not once per transaction
+    table = clients.assign(
+        net_worth_category=bucketize(clients["net_worth"], NET_WORTH_BANDS)
+    ).reset_index(drop=True)
+    return ClientIndex(table, _arrow_ids(table[id_col]), id_col)
+
+
+def lookup(index: ClientIndex, client_ids: pd.Series) -> np.ndarray:
+    # Row of every client id in the index, -1 where there is none
+    rows = pc.index_in(_arrow_ids(client_ids), value_set=index.ids)
+    return rows.fill_null(-1).to_numpy()
+
+
+def save_client_index(index: ClientIndex, index_dir: Path = INDEX_DIR) -> None:
+    index_dir.mkdir(parents=True, exist_ok=True)
+    feather.write_feather(
+        pa.Table.from_pandas(index.table, preserve_index=False),
+        index_dir / "clients.arrow",
+        compression="uncompressed",
+    )
+    print(f"Client index saved: {index_dir}")
+
+
+def load_client_index(
+    index_dir: Path = INDEX_DIR, id_col: str = "id"
+) -> Optional[ClientIndex]:
+    index_file = index_dir / "clients.arrow"
+    if not index_file.exists():
+        return None
+    table = feather.read_feather(index_file, memory_map=True)
+    return ClientIndex(table, _arrow_ids(table[id_col]), id_col)
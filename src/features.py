@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .compact import expand_frame
+from .dimension import CLIENT_COLUMNS
+from .utils import key_column
+
+FEATURES_FILE = Path(".cache") / "features" / "client_features.arrow"
+
+# Keys whose most frequent value per client is a feature
+FAVOURITE_KEYS = ("service", "payment_method")
+
+# Columns that add up or take the extreme over batches of transactions
+_STATE_AGG = {
+    "frequency": "sum",
+    "monetary": "sum",
+    "first_date": "min",
+    "last_date": "max",
+}
+
+
+@dataclass(frozen=True)
+class ClientFeatures:
+    # One row per client, sorted by client_id: transactions, their total, the
+    # first and last transaction date and the client's attributes
+    table: pd.DataFrame
+    # Transactions per client and value of each favourite key
+    counts: dict[str, pd.DataFrame]
+
+
+def _empty(df: pd.DataFrame) -> ClientFeatures:
+    table = pd.DataFrame(
+        {
+            "client_id": pd.Series(dtype="str"),
+            "frequency": pd.Series(dtype="int64"),
+            "monetary": pd.Series(dtype="float64"),
+            "first_date": pd.Series(dtype=df["transaction_date"].dtype),
+            "last_date": pd.Series(dtype=df["transaction_date"].dtype),
+            **{col: key_column(df, col).iloc[:0] for col in CLIENT_COLUMNS},
+        }
+    )
+    counts = {
+        key: pd.DataFrame(
+            {
+                "client_id": pd.Series(dtype="str"),
+                "value": pd.Series(dtype="str"),
+                "count": pd.Series(dtype="int64"),
+            }
+        )
+        for key in FAVOURITE_KEYS
+    }
+    return ClientFeatures(table, counts)
+
+
+def build_features(df: pd.DataFrame) -> ClientFeatures:
+    if df.empty:
+        return _empty(df)
+
+    # One stable sort by client; every feature is a reduction over the runs
+    # of equal clients, with no Python code per client
+    ids = expand_frame(df[["client_id"]])["client_id"]
+    codes, clients = pd.factorize(ids, sort=True)
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1))
+
+    dates = df["transaction_date"].to_numpy()[order]
+    table = pd.DataFrame(
+        {
+            "client_id": pd.Series(clients, dtype="str"),
+            "frequency": np.diff(np.append(starts, len(order))),
+            "monetary": np.add.reduceat(
+                df["amount"].to_numpy(dtype=float)[order], starts
+            ),
+            "first_date": np.minimum.reduceat(dates, starts),
+            "last_date": np.maximum.reduceat(dates, starts),
+        }
+    )
+    # Attributes are the same on every transaction of a client
+    for col in CLIENT_COLUMNS:
+        table[col] = key_column(df, col).take(order[starts]).reset_index(drop=True)
+
+    # Pairs of client and value, counted in one integer sort per key
+    counts = {}
+    for key in FAVOURITE_KEYS:
+        value_codes, values = pd.factorize(df[key], sort=True)
+        value_codes = value_codes[order]
+        known = value_codes >= 0
+        pairs, pair_counts = np.unique(
+            sorted_codes[known].astype(np.int64) * len(values) + value_codes[known],
+            return_counts=True,
+        )
+        counts[key] = pd.DataFrame(
+            {
+                "client_id": pd.Series(clients[pairs // len(values)], dtype="str"),
+                "value": pd.Series(
+                    np.asarray(values)[pairs % len(values)], dtype="str"
+                ),
+                "count": pair_counts,
+            }
+        )
+    return ClientFeatures(table, counts)
+
+
+def update_features(features: ClientFeatures, new: ClientFeatures) -> ClientFeatures:
+    # Totals add up, dates take the extreme, attributes come from the newest
+    # batch; favourite counts add up per client and value
+    table = (
+        pd.concat([features.table, new.table], ignore_index=True)
+        .groupby("client_id", sort=True)
+        .agg(
+            {
+                **_STATE_AGG,
+                **{col: "last" for col in CLIENT_COLUMNS},
+            }
+        )
+        .reset_index()
+    )
+    counts = {
+        key: pd.concat([features.counts[key], new.counts[key]], ignore_index=True)
+        .groupby(["client_id", "value"], sort=True)["count"]
+        .sum()
+        .reset_index()
+        for key in FAVOURITE_KEYS
+    }
+    return ClientFeatures(table, counts)
+
+
+def _favourite(counts: pd.DataFrame) -> pd.Series:
+    # The most frequent value per client, ties go to the first value by name
+    top = counts.sort_values(
+        ["client_id", "count", "value"], ascending=[True, False, True]
+    ).drop_duplicates("client_id")
+    return top.set_index("client_id")["value"].astype("category")
+
+
+def client_features(
+    features: ClientFeatures, as_of: Optional[pd.Timestamp] = None
+) -> pd.DataFrame:
+    # The feature table indexed by client_id; recency and tenure are counted
+    # in days up to the last transaction of all clients
+    table = features.table.set_index("client_id")
+    as_of = table["last_date"].max() if as_of is None else as_of
+    table["avg_ticket"] = table["monetary"] / table["frequency"]
+    table["recency_days"] = (as_of - table["last_date"]).dt.days
+    table["tenure_days"] = (table["last_date"] - table["first_date"]).dt.days
+    for key in FAVOURITE_KEYS:
+        table[f"favourite_{key}"] = _favourite(features.counts[key]).reindex(
+            table.index
+        )
+    return table
+
+
+def counts_files(save_file_name: Path = FEATURES_FILE) -> tuple[Path, ...]:
+    # Favourite counts are kept next to the feature table
+    return tuple(
+        save_file_name.with_name(f"favourite_{key}_counts.arrow")
+        for key in FAVOURITE_KEYS
+    )
+
+
+def _write(df: pd.DataFrame, path: Path) -> None:
+    feather.write_feather(
+        pa.Table.from_pandas(df, preserve_index=False), path, compression="zstd"
+    )
+
+
+def save_features(
+    features: ClientFeatures, save_file_name: Path = FEATURES_FILE
+) -> None:
+    # The feature table is materialized, the counts are what it is updated from
+    save_file_name.parent.mkdir(parents=True, exist_ok=True)
+    _write(client_features(features).reset_index(), save_file_name)
+    for key, path in zip(FAVOURITE_KEYS, counts_files(save_file_name)):
+        _write(features.counts[key], path)
+    print(f"Client features saved: {save_file_name}")
+
+
+def load_features(save_file_name: Path = FEATURES_FILE) -> Optional[ClientFeatures]:
+    if not save_file_name.exists():
+        return None
+    table = feather.read_feather(save_file_name)
+    return ClientFeatures(
+        table[["client_id", *_STATE_AGG, *CLIENT_COLUMNS]],
+        {
+            key: feather.read_feather(path)
+            for key, path in zip(FAVOURITE_KEYS, counts_files(save_file_name))
+        },
+    )
+
+
+def materialize_features(
+    merged_df: pd.DataFrame, save_file_name: Path = FEATURES_FILE
+) -> ClientFeatures:
+    features = build_features(merged_df)
+    save_features(features, save_file_name)
+    return features
+
+
+def client_segments(
+    features: ClientFeatures, by: str = "net_worth_category"
+) -> pd.DataFrame:
+    # Client-level totals per segment: clients, their revenue and how often
+    # and how recently they buy; the engines compute the same table
+    table = client_features(features)
+    grouped = table.groupby(by, observed=True)
+    return pd.DataFrame(
+        {
+            "clients": grouped.size(),
+            "revenue": grouped["monetary"].sum(),
+            "transactions": grouped["frequency"].sum(),
+            "avg_frequency": grouped["frequency"].mean(),
+            "avg_recency_days": grouped["recency_days"].mean(),
+            "avg_tenure_days": grouped["tenure_days"].mean(),
+        }
+    )
+
+
+def segment_summary(segments: pd.DataFrame) -> dict[str, dict]:
+    # The client_segments table in the layout of the results file
+    segments = segments.assign(
+        avg_ticket=segments["revenue"] / segments["transactions"]
+    )
+    return {
+        str(segment): {
+            name: (int(value) if name in ("clients", "transactions") else float(value))
+            for name, value in row.items()
+        }
+        for segment, row in segments.iterrows()
+    }
+
+
+def segment_metrics(
+    features: ClientFeatures, by: str = "net_worth_category"
+) -> dict[str, dict]:
+    return segment_summary(client_segments(features, by))
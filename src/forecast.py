@@ -0,0 +1,72 @@
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+# Group keys with a next-month forecast per group
+FORECAST_KEYS = ("service", "city", "consultant")
+
+
+def fill_months(grouped: pd.DataFrame) -> pd.DataFrame:
+    # Months without transactions are kept with zeros, as resample("ME") does
+    months = pd.period_range(grouped.index.min(), grouped.index.max(), freq="M")
+    return grouped.reindex(months, fill_value=0)
+
+
+def monthly_partials(df: pd.DataFrame, by: Optional[str] = None) -> pd.DataFrame:
+    # Count and amount per month (and group); partials of the same months
+    # from different parts of the data add up
+    month = df["transaction_date"].dt.to_period("M")
+    keys = [month] if by is None else [month, df[by]]
+    return df["amount"].groupby(keys, observed=True).agg(count="count", amount="sum")
+
+
+def widen_monthly(partials: pd.DataFrame, by: Optional[str] = None) -> pd.DataFrame:
+    # One row per month; with a key, count and amount columns per group
+    if by is None:
+        return fill_months(partials)
+    return fill_months(partials.unstack(fill_value=0))
+
+
+def monthly_totals(df: pd.DataFrame, by: Optional[str] = None) -> pd.DataFrame:
+    return widen_monthly(monthly_partials(df, by), by)
+
+
+def linear_trend_next(y: np.ndarray) -> np.ndarray:
+    # Least squares line through (0..n-1, y) for every column of y at once,
+    # evaluated at the next month n
+    n = len(y)
+    x = np.arange(n, dtype=float)
+    x_centered = x - x.mean()
+    y_mean = y.mean(axis=0)
+    sxx = x_centered @ x_centered
+    slope = x_centered @ (y - y_mean) / sxx if sxx else np.zeros_like(y_mean)
+    return y_mean + slope * (n - x.mean())
+
+
+def forecast_from_monthly(monthly_df: pd.DataFrame) -> dict:
+    next_count, next_amount = linear_trend_next(
+        monthly_df[["count", "amount"]].to_numpy(dtype=float)
+    )
+    return {
+        "count": int(round(next_count)),
+        "amount": float(round(next_amount)),
+    }
+
+
+def forecast_groups(monthly_by: pd.DataFrame) -> dict[str, dict]:
+    next_count = linear_trend_next(monthly_by["count"].to_numpy(dtype=float))
+    next_amount = linear_trend_next(monthly_by["amount"].to_numpy(dtype=float))
+    return {
+        str(group): {"count": int(round(count)), "amount": float(round(amount))}
+        for group, count, amount in zip(
+            monthly_by["count"].columns, next_count, next_amount
+        )
+    }
+
+
+def forecast_next_month(df: pd.DataFrame) -> dict:
+    return forecast_from_monthly(monthly_totals(df))
+
+
+def forecast_next_month_by(df: pd.DataFrame, by: str) -> dict[str, dict]:
+    return forecast_groups(monthly_totals(df, by))
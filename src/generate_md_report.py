@@ -1,26 +1,43 @@
 import os
 from pathlib import Path
+from typing import Optional
 import pandas as pd
 from datetime import datetime
 
-from .plot_analysis import plot_analysis
+from .instrument import measure_stage
 
 
 def _table(data: pd.Series | pd.DataFrame, fmt: str = "{:,.0f}") -> str:
     return data.apply(lambda x: fmt.format(x)).to_markdown()
 
 
-def generate_md_report(
-    results: dict[str, pd.Series],
-    df: pd.DataFrame,
+def _forecast_table(forecasts: dict[str, dict], index_name: str) -> str:
+    table = pd.DataFrame.from_dict(forecasts, orient="index").rename_axis(index_name)
+    table = table.sort_values("amount", ascending=False)
+    return pd.DataFrame(
+        {
+            "count": table["count"].map("{:,.0f}".format),
+            "amount": table["amount"].map("${:,.0f}".format),
+        }
+    ).to_markdown()
+
+
+REPORT_TITLE = "Анализ финансовых транзакций"
+
+
+def timestamp() -> str:
+    return datetime.now().strftime("%d.%m.%Y %H:%M")
+
+
+def render_report(
+    results: dict,
+    plots: dict[str, Path],
     save_file_path: Path,
+    title: str = REPORT_TITLE,
+    generated: Optional[str] = None,
 ) -> str:
-    plots_path = Path(save_file_path.parent / "plots")
-    os.makedirs(plots_path, exist_ok=True)
-    plots = plot_analysis(results, df, plots_path)
-
-    report = f"""# Анализ финансовых транзакций
-{datetime.now().strftime("%d.%m.%Y %H:%M")}
+    return f"""# {title}
+{timestamp() if generated is None else generated}
 
 ## Топ-5 услуг по количеству транзакций
 {_table(results["services_by_count"].head(5))}
@@ -56,8 +73,28 @@ def generate_md_report(
 Прогноз выручки: ${results["forecast_next_month"]["amount"]:,.0f}
 
 ![Forecast next month]({plots["forecast_next_month"].relative_to(save_file_path.parent)})
+
+### Прогноз выручки по услугам
+{_forecast_table(results["forecast_next_month_by_service"], "Услуга")}
 """
-    with open(save_file_path, "w", encoding="utf-8") as f:
-        f.write(report)
-        print(f"Report generated: {save_file_path}")
+
+
+def generate_md_report(
+    results: dict[str, pd.Series],
+    df: pd.DataFrame,
+    save_file_path: Path,
+    plot_workers: Optional[int] = None,
+) -> str:
+    # matplotlib and seaborn are only imported when a report is built
+    from .plot_analysis import plot_analysis
+
+    plots_path = Path(save_file_path.parent / "plots")
+    os.makedirs(plots_path, exist_ok=True)
+    plots = plot_analysis(results, df, plots_path, max_workers=plot_workers)
+
+    with measure_stage("report.render"):
+        report = render_report(results, plots, save_file_path)
+        with open(save_file_path, "w", encoding="utf-8") as f:
+            f.write(report)
+            print(f"Report generated: {save_file_path}")
     return report
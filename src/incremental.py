@@ -0,0 +1,414 @@
+from pathlib import Path
+from typing import Optional
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .analysis import (
+    METRICS,
+    SEGMENT_KEYS,
+    Metric,
+    finalize_metrics,
+    group_partials,
+    run_analysis,
+    serializable_results,
+)
+from .cache import source_hash
+from .clean_data import clean_clients, clean_transactions, merge_tables
+from .cube import WINDOWS, DailyCube, build_cube, update_cube, window_partials
+from .dedup import DedupIndex, hash_ids
+from .dimension import ClientIndex
+from .features import (
+    build_features,
+    load_features,
+    save_features,
+    segment_metrics,
+    update_features,
+)
+from .forecast import (
+    FORECAST_KEYS,
+    fill_months,
+    forecast_from_monthly,
+    forecast_groups,
+    monthly_partials,
+    widen_monthly,
+)
+from .readers import read_excel_streaming, read_json_streaming
+
+STATE_DIR = Path(".cache") / "incremental"
+
+# Folded sums add in another order than one pass over all rows
+PARITY_RTOL = 1e-9
+
+_READERS = {".xlsx": read_excel_streaming, ".json": read_json_streaming}
+
+
+def _empty_state(state_dir: Path) -> dict:
+    return {
+        "batches": [],
+        "partials": {},
+        "monthly": None,
+        "monthly_by": {},
+        "cube": None,
+        "features": None,
+        "seen_ids": DedupIndex(state_dir / "dedup"),
+        # Identical id-less rows seen so far, by row hash; see synthetic_ids
+        "occurrences": {},
+    }
+
+
+def _partial_file(state_dir: Path, by: str) -> Path:
+    return state_dir / f"partial_{by}.arrow"
+
+
+def _monthly_file(state_dir: Path, by: str) -> Path:
+    return state_dir / f"monthly_{by}.arrow"
+
+
+def _write(df: pd.DataFrame, path: Path) -> None:
+    feather.write_feather(
+        pa.Table.from_pandas(df, preserve_index=False),
+        path,
+        compression="uncompressed",
+    )
+
+
+def _features_file(state_dir: Path) -> Path:
+    return state_dir / "client_features.arrow"
+
+
+def _occurrences_file(state_dir: Path) -> Path:
+    return state_dir / "occurrences.arrow"
+
+
+def _stale(meta: dict, data_dir: Path, seen_ids: DedupIndex) -> Optional[str]:
+    # Why saved state can't be folded into, if it can't
+    if not (data_dir / "cube.arrow").exists():
+        # State saved before the daily cube kept only the raw rows of the last
+        # month, which can't answer other windows; batches are folded again
+        return "predates the daily cube"
+    if not (data_dir / "cube_tail.arrow").exists():
+        # The cube's tail holds the rows a window's partial first day is
+        # summed from; without it windows can't be cut at the timestamp
+        return "predates the cube tail"
+    if not _features_file(data_dir).exists():
+        # Client features can't be derived from the aggregates either
+        return "predates client features"
+    if not _occurrences_file(data_dir).exists():
+        # Synthetic ids were numbered per batch, so an id-less row repeated
+        # in a later batch was taken for a duplicate of the earlier one
+        return "predates synthetic id counts across batches"
+    if "monthly_keys" not in meta:
+        # Forecasts per key need monthly partials per key, which older state
+        # did not keep
+        return "predates monthly partials per key"
+    if meta.get("seen_ids", len(seen_ids)) != len(seen_ids):
+        # Ids are flushed before state.json is replaced: a save interrupted
+        # in between left ids of a batch the aggregates don't include
+        return "has seen ids of an interrupted save"
+    return None
+
+
+def load_state(state_dir: Path = STATE_DIR) -> dict:
+    meta_file = state_dir / "state.json"
+    if not meta_file.exists():
+        # Ids recorded without a registered batch belong to no state
+        shutil.rmtree(state_dir / "dedup", ignore_errors=True)
+        return _empty_state(state_dir)
+
+    with open(meta_file, encoding="utf-8") as f:
+        meta = json.load(f)
+    # State saved before snapshots kept its files next to state.json
+    data_dir = state_dir / meta.get("snapshot", "")
+
+    state = _empty_state(state_dir)
+    reason = _stale(meta, data_dir, state["seen_ids"])
+    if reason is not None:
+        print(f"Incremental state {reason}, rebuilt: {state_dir}")
+        meta_file.unlink()
+        return load_state(state_dir)
+
+    state["batches"] = meta["batches"]
+    for by in meta["partial_keys"]:
+        state["partials"][by] = feather.read_feather(
+            _partial_file(data_dir, by)
+        ).set_index(by)
+
+    monthly = feather.read_feather(data_dir / "monthly.arrow")
+    monthly["month"] = monthly["month"].dt.to_period("M")
+    state["monthly"] = monthly.set_index("month")
+    for by in meta["monthly_keys"]:
+        monthly_by = feather.read_feather(_monthly_file(data_dir, by))
+        monthly_by["month"] = monthly_by["month"].dt.to_period("M")
+        state["monthly_by"][by] = monthly_by.set_index(["month", by])
+
+    state["cube"] = DailyCube(
+        feather.read_feather(data_dir / "cube.arrow"),
+        feather.read_feather(data_dir / "cube_tail.arrow"),
+    )
+    state["features"] = load_features(_features_file(data_dir))
+    occurrences = feather.read_feather(_occurrences_file(data_dir))
+    state["occurrences"] = dict(
+        zip(occurrences["hash"].tolist(), occurrences["count"].tolist())
+    )
+
+    # State saved before the dedup index kept seen ids in one sorted array
+    legacy_ids = state_dir / "seen_ids.npy"
+    if legacy_ids.exists() and len(state["seen_ids"]) == 0:
+        state["seen_ids"].add(np.load(legacy_ids))
+        state["seen_ids"].flush()
+        legacy_ids.unlink()
+    return state
+
+
+def save_state(state: dict, state_dir: Path = STATE_DIR) -> None:
+    # Every save writes a new snapshot directory and then replaces state.json,
+    # which names it: an interrupted save leaves the previous state whole
+    state_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_dir = Path(tempfile.mkdtemp(prefix="snapshot_", dir=state_dir))
+
+    for by, partial in state["partials"].items():
+        _write(partial.reset_index(), _partial_file(snapshot_dir, by))
+
+    monthly = state["monthly"].reset_index()
+    monthly["month"] = monthly["month"].dt.to_timestamp()
+    _write(monthly, snapshot_dir / "monthly.arrow")
+    for by, monthly_by in state["monthly_by"].items():
+        monthly_by = monthly_by.reset_index()
+        monthly_by["month"] = monthly_by["month"].dt.to_timestamp()
+        _write(monthly_by, _monthly_file(snapshot_dir, by))
+
+    _write(state["cube"].table, snapshot_dir / "cube.arrow")
+    _write(state["cube"].tail, snapshot_dir / "cube_tail.arrow")
+    save_features(state["features"], _features_file(snapshot_dir))
+    _write(
+        pd.DataFrame(
+            {
+                "hash": np.fromiter(state["occurrences"], dtype=np.uint64),
+                "count": np.fromiter(state["occurrences"].values(), dtype=np.int64),
+            }
+        ),
+        _occurrences_file(snapshot_dir),
+    )
+    state["seen_ids"].flush()
+
+    meta_file = state_dir / "state.json"
+    tmp_file = meta_file.with_suffix(".json.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "batches": state["batches"],
+                "partial_keys": list(state["partials"]),
+                "monthly_keys": list(state["monthly_by"]),
+                "snapshot": snapshot_dir.name,
+                "seen_ids": len(state["seen_ids"]),
+            },
+            f,
+            indent=2,
+        )
+    os.replace(tmp_file, meta_file)
+
+    # Earlier snapshots, and the files of state saved before snapshots
+    for path in state_dir.iterdir():
+        if path.name in (snapshot_dir.name, meta_file.name, "dedup"):
+            continue
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
+def _add(old: pd.DataFrame | None, new: pd.DataFrame) -> pd.DataFrame:
+    if old is None:
+        return new
+    combined = pd.concat([old, new])
+    return combined.groupby(
+        level=list(range(combined.index.nlevels)), observed=True
+    ).sum()
+
+
+def _history_metrics(metrics: dict[str, Metric]) -> dict[str, Metric]:
+    return {name: m for name, m in metrics.items() if m.window == "all"}
+
+
+def _window_metrics(metrics: dict[str, Metric]) -> dict[str, Metric]:
+    return {name: m for name, m in metrics.items() if m.window in WINDOWS}
+
+
+def fold_batch(
+    state: dict,
+    batch_file: Path,
+    clients: pd.DataFrame | ClientIndex,
+    metrics: dict[str, Metric] = METRICS,
+) -> bool:
+    batch_key = source_hash(batch_file, "fold_batch", {})
+    if batch_key in state["batches"]:
+        print(f"Batch already included, skipped: {batch_file}")
+        return False
+
+    transactions = clean_transactions(
+        _READERS[batch_file.suffix](batch_file), occurrences=state["occurrences"]
+    )
+
+    # transaction_id deduplication spans every batch folded so far
+    transactions = transactions.loc[
+        state["seen_ids"].add(hash_ids(transactions["transaction_id"]))
+    ]
+
+    merged_df = merge_tables(transactions, clients)
+
+    # Metrics over the whole history are plain count/sum pairs per key
+    for (_, by), partial in group_partials(
+        merged_df, _history_metrics(metrics)
+    ).items():
+        if by is not None:
+            state["partials"][by] = _add(state["partials"].get(by), partial)
+
+    monthly = (
+        merged_df["amount"]
+        .groupby(merged_df["transaction_date"].dt.to_period("M"))
+        .agg(count="count", amount="sum")
+    )
+    monthly.index.name = "month"
+    state["monthly"] = _add(state["monthly"], monthly)
+    for by in FORECAST_KEYS:
+        state["monthly_by"][by] = _add(
+            state["monthly_by"].get(by),
+            monthly_partials(merged_df, by).rename_axis(["month", by]),
+        )
+
+    # Window metrics are read from the daily cube, which folds like the partials
+    cube = build_cube(merged_df)
+    state["cube"] = cube if state["cube"] is None else update_cube(state["cube"], cube)
+
+    # Client features fold per client the same way
+    features = build_features(merged_df)
+    state["features"] = (
+        features
+        if state["features"] is None
+        else update_features(state["features"], features)
+    )
+
+    state["batches"].append(batch_key)
+    return True
+
+
+def results_from_state(state: dict, metrics: dict[str, Metric] = METRICS) -> dict:
+    groups = {("all", by): partial for by, partial in state["partials"].items()}
+    groups.update(
+        window_partials(
+            state["cube"],
+            list(
+                dict.fromkeys(
+                    (m.window, m.by) for m in _window_metrics(metrics).values()
+                )
+            ),
+        )
+    )
+
+    results = finalize_metrics(groups, metrics)
+    monthly = fill_months(state["monthly"])
+    results["forecast_next_month"] = forecast_from_monthly(monthly)
+    # The same batched forecast as a full run, over the folded partials
+    for by, partials in state["monthly_by"].items():
+        results[f"forecast_next_month_by_{by}"] = forecast_groups(
+            widen_monthly(partials, by)
+        )
+    results["monthly_totals"] = monthly
+    for by in SEGMENT_KEYS:
+        results[f"client_segments_by_{by}"] = segment_metrics(state["features"], by)
+    return results
+
+
+def _mismatches(expected: object, actual: object, name: str) -> list[str]:
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if list(expected) != list(actual):
+            return [f"{name}: keys or their order differ"]
+        return [
+            mismatch
+            for key in expected
+            for mismatch in _mismatches(expected[key], actual[key], f"{name}.{key}")
+        ]
+    if isinstance(expected, float) and isinstance(actual, (int, float)):
+        if math.isclose(expected, actual, rel_tol=PARITY_RTOL) or (
+            math.isnan(expected) and math.isnan(actual)
+        ):
+            return []
+    elif expected == actual:
+        return []
+    return [f"{name}: {actual!r} instead of {expected!r}"]
+
+
+def check_parity(
+    batch_files: list[Path], clients: pd.DataFrame | ClientIndex
+) -> list[str]:
+    # Batches folded with a save and a load between them, overlapping ones
+    # included, must give the results of one clean of all their rows
+    with tempfile.TemporaryDirectory() as tmp:
+        state_dir = Path(tmp) / "state"
+        for batch_file in batch_files:
+            state = load_state(state_dir)
+            fold_batch(state, batch_file, clients)
+            save_state(state, state_dir)
+        folded = results_from_state(load_state(state_dir))
+
+        raw = pd.concat(
+            [_READERS[path.suffix](path) for path in batch_files], ignore_index=True
+        )
+        full = run_analysis(
+            merge_tables(clean_transactions(raw), clients),
+            save_file_name=Path(tmp) / "analysis_results.json",
+        )
+    return _mismatches(
+        serializable_results(full), serializable_results(folded), "results"
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.incremental",
+        description="Check that overlapping batches folded one by one match a full run",
+    )
+    parser.add_argument(
+        "--transactions", type=Path, default=Path("data") / "transactions_data.xlsx"
+    )
+    parser.add_argument(
+        "--clients", type=Path, default=Path("data") / "clients_data.json"
+    )
+    parser.add_argument("--batches", type=int, default=3)
+    parser.add_argument(
+        "--overlap", type=int, default=1000, help="rows each batch repeats"
+    )
+    args = parser.parse_args(argv)
+
+    raw = read_excel_streaming(args.transactions)
+    clients = clean_clients(read_json_streaming(args.clients))
+    step = len(raw) // args.batches
+    with tempfile.TemporaryDirectory() as tmp:
+        # A re-delivered feed: every batch starts with the last rows of the
+        # one before it
+        batch_files = []
+        for i in range(args.batches):
+            start = max(i * step - args.overlap, 0)
+            end = len(raw) if i == args.batches - 1 else (i + 1) * step
+            batch_file = Path(tmp) / f"batch_{i}.xlsx"
+            raw.iloc[start:end].to_excel(batch_file, index=False)
+            batch_files.append(batch_file)
+        mismatches = check_parity(batch_files, clients)
+
+    print(f"incremental: {'OK' if not mismatches else 'MISMATCH'}")
+    for mismatch in mismatches:
+        print(f"  {mismatch}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, process_time
+from typing import Any, Callable, Iterator, Optional
+import cProfile
+import json
+import multiprocessing
+import threading
+import tracemalloc
+import pandas as pd
+
+_records: list[dict] = []
+_lock = threading.Lock()
+_open: list[dict] = []
+_local = threading.local()
+_profile_dir: Optional[Path] = None
+
+# Workers start from a clean server process, not as forks of a parent that
+# holds the data, the pipeline's threads and their locks
+_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def enable_profiling(profile_dir: Optional[Path]) -> None:
+    # Per-stage cProfile and tracemalloc dumps; stages must then run one at a time
+    global _profile_dir
+    _profile_dir = profile_dir
+    if profile_dir is not None:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+
+def count_rows(obj: Any) -> Optional[int]:
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        counts = [n for n in map(count_rows, obj) if n is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _status_bytes(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _rss() -> Optional[int]:
+    return _status_bytes("VmRSS")
+
+
+def _peak_rss() -> Optional[int]:
+    return _status_bytes("VmHWM")
+
+
+def _reset_peak_rss() -> None:
+    # The high-water mark is process-wide: open stages keep what it reached so
+    # far before it is reset, so overlapping stages each see their own maximum
+    peak = _peak_rss()
+    for record in _open:
+        record["peak_rss_bytes"] = max(record["peak_rss_bytes"] or 0, peak or 0)
+    # Linux resets VmHWM when "5" is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def add_record(record: dict) -> None:
+    with _lock:
+        _records.append(record)
+
+
+@contextmanager
+def measure_stage(name: str, rows_in: Optional[int] = None) -> Iterator[dict]:
+    # peak_rss_delta_bytes is how far RSS rose above its value at the stage
+    # start, cpu_seconds is process CPU time, so threads the stage's libraries
+    # start are counted. Both are process-wide: with stages running
+    # concurrently they include the other stages' work, so per-stage numbers
+    # need max_workers=1. peak_alloc_bytes (tracemalloc, only when profiling)
+    # is per stage as well, since profiled stages run one at a time
+    record: dict = {"stage": name, "rows_in": rows_in, "rows_out": None}
+
+    # Only the outermost stage of a thread is profiled, nested stages are
+    # included in its dump
+    profiler = None
+    if _profile_dir is not None and not getattr(_local, "profiling", False):
+        _local.profiling = True
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+
+    with _lock:
+        record["peak_rss_bytes"] = None
+        _reset_peak_rss()
+        _open.append(record)
+        rss_start = _rss()
+
+    wall_start, cpu_start = perf_counter(), process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = round(perf_counter() - wall_start, 4)
+        record["cpu_seconds"] = round(process_time() - cpu_start, 4)
+
+        with _lock:
+            _open.remove(record)
+            peak = max(record.pop("peak_rss_bytes") or 0, _peak_rss() or 0)
+            record["peak_rss_delta_bytes"] = (
+                max(peak - rss_start, 0) if peak and rss_start is not None else None
+            )
+
+        if profiler is not None:
+            profiler.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            _local.profiling = False
+            record["peak_alloc_bytes"] = peak
+
+            profiler.dump_stats(_profile_dir / f"{name}.prof")
+            with open(
+                _profile_dir / f"{name}.tracemalloc.txt", "w", encoding="utf-8"
+            ) as f:
+                for stat in snapshot.statistics("lineno")[:25]:
+                    f.write(f"{stat}\n")
+
+        add_record(record)
+
+
+def measure(name: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+    with measure_stage(name, rows_in=count_rows(args)) as record:
+        result = func(*args, **kwargs)
+        record["rows_out"] = count_rows(result)
+    return result
+
+
+def measured_call(
+    name: str, func: Callable[..., Any], *args, **kwargs
+) -> tuple[Any, dict]:
+    # For worker processes: the record is returned instead of kept locally
+    with measure_stage(name, rows_in=count_rows(args)) as record:
+        result = func(*args, **kwargs)
+        record["rows_out"] = count_rows(result)
+    with _lock:
+        _records.remove(record)
+    return result, record
+
+
+def process_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(_START_METHOD),
+    )
+
+
+def save_run_metrics(save_file_name: Path) -> list[dict]:
+    with _lock:
+        records = list(_records)
+        _records.clear()
+
+    with open(save_file_name, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"stages": records}, indent=2, ensure_ascii=False))
+    print(f"Run metrics saved: {save_file_name}")
+
+    return records
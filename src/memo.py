@@ -0,0 +1,280 @@
+from pathlib import Path
+from types import CodeType
+from typing import Any, Callable, Optional
+import dis
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pickle
+
+STAGE_CACHE_DIR = Path(".cache") / "stages"
+MAX_CACHE_BYTES = 2 << 30
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def outputs_hash(paths: tuple[Path, ...]) -> dict[str, Optional[str]]:
+    # Content of every declared output; a directory stands for all files in
+    # it, for outputs whose names depend on the data (a report per segment)
+    hashes: dict[str, Optional[str]] = {}
+    for path in paths:
+        if path.is_dir():
+            digest = hashlib.sha256()
+            for file in sorted(p for p in path.rglob("*") if p.is_file()):
+                digest.update(f"{file.relative_to(path)}={file_hash(file)}".encode())
+            hashes[str(path)] = digest.hexdigest()
+        else:
+            hashes[str(path)] = file_hash(path) if path.exists() else None
+    return hashes
+
+
+def _in_project(obj: Any) -> bool:
+    file = getattr(inspect.getmodule(obj), "__file__", None)
+    if file is None:
+        return False
+    path = Path(file).resolve()
+    return path.is_relative_to(PROJECT_ROOT) and "site-packages" not in path.parts
+
+
+def _names(code: CodeType) -> set[str]:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _names(const)
+    return names
+
+
+def _imports(code: CodeType, package: Optional[str]) -> list[Any]:
+    # Functions importing lazily reach project objects through import
+    # statements in their body rather than through module globals
+    objects: list[Any] = []
+    module = None
+    consts: list[Any] = []
+    for instruction in dis.get_instructions(code):
+        if instruction.opname == "LOAD_CONST":
+            consts.append(instruction.argval)
+        elif instruction.opname == "IMPORT_NAME":
+            level = consts[-2] if len(consts) >= 2 else 0
+            name = "." * level + instruction.argval
+            module = importlib.import_module(name, package) if level else None
+        elif instruction.opname == "IMPORT_FROM" and module is not None:
+            objects.append(getattr(module, instruction.argval, None))
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            objects += _imports(const, package)
+    return objects
+
+
+def _stable_repr(value: Any) -> str:
+    if isinstance(value, Path) and value.is_absolute():
+        # Paths in the checkout are hashed relative to it, so moving or
+        # cloning the project elsewhere keeps the keys
+        if value.is_relative_to(PROJECT_ROOT):
+            return repr(value.relative_to(PROJECT_ROOT).as_posix())
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(map(_stable_repr, value)))
+    if isinstance(value, dict):
+        return repr({k: _stable_repr(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return repr([_stable_repr(v) for v in value])
+    if inspect.isfunction(value) or inspect.isclass(value) or inspect.isbuiltin(value):
+        # The default repr of a function holds its address
+        return f"{value.__module__}.{value.__qualname__}"
+    return repr(value)
+
+
+def _callables(value: Any) -> list[Any]:
+    # Functions and classes held by a constant or a default argument
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [obj for item in value for obj in _callables(item)]
+    return []
+
+
+def code_hash(func: Callable[..., Any]) -> str:
+    # A stage's code is its own source plus every project function, class and
+    # UPPER_CASE constant it reaches through global names, so editing a helper,
+    # a band edge or the plot style invalidates the stages that use it
+    digest = hashlib.sha256()
+    seen: set[int] = set()
+    stack: list[Any] = [func]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        if inspect.ismodule(obj) or not (
+            inspect.isfunction(obj) or inspect.isclass(obj)
+        ):
+            continue
+        if not _in_project(obj):
+            continue
+        digest.update(inspect.getsource(obj).encode())
+
+        # Methods generated by dataclass live in the dataclasses module scope
+        functions = (
+            [obj]
+            if inspect.isfunction(obj)
+            else [
+                value
+                for value in vars(obj).values()
+                if inspect.isfunction(value)
+                and value.__globals__.get("__name__") == obj.__module__
+            ]
+        )
+        for function in functions:
+            stack += _imports(function.__code__, function.__globals__["__package__"])
+            # Default arguments are evaluated once, their names are not globals
+            defaults = (
+                *(function.__defaults__ or ()),
+                *(function.__kwdefaults__ or {}).values(),
+            )
+            digest.update(_stable_repr(defaults).encode())
+            stack += _callables(defaults)
+            scope = function.__globals__
+            for name in sorted(_names(function.__code__)):
+                value = scope.get(name)
+                if inspect.ismodule(value) and _in_project(value):
+                    # module.attr: the attribute name is in co_names as well
+                    stack += [
+                        getattr(value, attr)
+                        for attr in sorted(_names(function.__code__))
+                        if hasattr(value, attr)
+                    ]
+                elif inspect.isfunction(value) or inspect.isclass(value):
+                    stack.append(value)
+                elif name.isupper() and name in scope:
+                    # Module constants; other globals are runtime state
+                    digest.update(f"{name}={_stable_repr(value)}".encode())
+                    stack += _callables(value)
+    return digest.hexdigest()
+
+
+def _canonical(obj: Any) -> Any:
+    # Functions passed as parameters are hashed by their code, so editing a
+    # reader or the constants it uses changes the stage's key
+    if callable(obj):
+        name = f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', obj)}"
+        return f"{name}:{code_hash(obj)}"
+    return str(obj)
+
+
+def params_hash(func: Callable[..., Any], kwargs: dict) -> str:
+    # Values captured by a closure are parameters as well
+    cells = [cell.cell_contents for cell in getattr(func, "__closure__", None) or []]
+    return _sha256(
+        json.dumps(
+            {"kwargs": kwargs, "closure": cells}, sort_keys=True, default=_canonical
+        ).encode()
+    )
+
+
+def stage_key(parts: dict) -> str:
+    return _sha256(json.dumps(parts, sort_keys=True).encode())
+
+
+def _entry_files(key: str, cache_dir: Path) -> tuple[Path, Path]:
+    return cache_dir / f"{key}.pkl", cache_dir / f"{key}.json"
+
+
+def load_entry(key: str, cache_dir: Path = STAGE_CACHE_DIR) -> Optional[dict]:
+    data_file, meta_file = _entry_files(key, cache_dir)
+    if not (data_file.exists() and meta_file.exists()):
+        return None
+    with open(meta_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_entry(key: str, cache_dir: Path = STAGE_CACHE_DIR) -> Any:
+    data_file, _ = _entry_files(key, cache_dir)
+    # mtime is the LRU clock
+    os.utime(data_file)
+    with open(data_file, "rb") as f:
+        return pickle.load(f)
+
+
+def write_entry(
+    key: str, result: Any, meta: dict, cache_dir: Path = STAGE_CACHE_DIR
+) -> str:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    data_file, meta_file = _entry_files(key, cache_dir)
+
+    data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    output_hash = _sha256(data)
+    data_file.write_bytes(data)
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump({**meta, "output_hash": output_hash, "bytes": len(data)}, f)
+    return output_hash
+
+
+def evict(
+    cache_dir: Path = STAGE_CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES
+) -> list[str]:
+    if not cache_dir.exists():
+        return []
+    entries = sorted(cache_dir.glob("*.pkl"), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in entries)
+
+    evicted = []
+    for data_file in entries:
+        if total <= max_bytes:
+            break
+        total -= data_file.stat().st_size
+        data_file.unlink()
+        data_file.with_suffix(".json").unlink(missing_ok=True)
+        evicted.append(data_file.stem)
+    return evicted
+
+
+def _last_parts_file(name: str, cache_dir: Path) -> Path:
+    return cache_dir / "last" / f"{name}.json"
+
+
+def save_last_parts(name: str, parts: dict, cache_dir: Path = STAGE_CACHE_DIR) -> None:
+    path = _last_parts_file(name, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(parts, f, indent=2)
+
+
+def rerun_reason(name: str, parts: dict, cache_dir: Path = STAGE_CACHE_DIR) -> str:
+    path = _last_parts_file(name, cache_dir)
+    if not path.exists():
+        return "never run"
+    with open(path, encoding="utf-8") as f:
+        last = json.load(f)
+
+    reasons = []
+    if last.get("code") != parts["code"]:
+        reasons.append("code changed")
+    if last.get("params") != parts["params"]:
+        reasons.append("parameters changed")
+    reasons += [
+        f"input {file} changed"
+        for file, digest in parts["files"].items()
+        if last.get("files", {}).get(file) != digest
+    ]
+    reasons += [
+        f"output of {dep} changed"
+        for dep, digest in parts["deps"].items()
+        if last.get("deps", {}).get(dep) != digest
+    ]
+    return ", ".join(reasons) or "evicted from cache"
@@ -0,0 +1,171 @@
+from typing import Iterable, Literal, Sequence
+import numpy as np
+import pandas as pd
+
+from .sketches import GroupedBottomKSample, GroupedMoments
+
+# Groupings the transactions audit checks amounts within: an amount normal
+# for one service can be an outlier for another
+TRANSACTION_OUTLIER_GROUPS = (
+    ("service",),
+    ("city",),
+    ("consultant",),
+    ("service", "city", "consultant"),
+)
+
+# Groups with fewer values get no bounds, their rows are never flagged
+MIN_GROUP_ROWS = 30
+
+# Values kept per group by the approximate variant
+GROUP_SAMPLE_SIZE = 1_000
+
+
+def _bounds_table(
+    rows: pd.Series, lower: pd.Series, upper: pd.Series, min_rows: int
+) -> pd.DataFrame:
+    table = pd.DataFrame({"rows": rows, "lower_bound": lower, "upper_bound": upper})
+    table["rows"] = table["rows"].astype("int64")
+    small = table["rows"] < min_rows
+    table.loc[small, ["lower_bound", "upper_bound"]] = np.nan
+    return table
+
+
+def group_bounds(
+    df: pd.DataFrame,
+    column: str,
+    by: Sequence[str],
+    method: Literal["iqr", "zscore"] = "iqr",
+    zscore_threshold: float = 3.0,
+    zscore_ddof: int = 0,
+    min_rows: int = MIN_GROUP_ROWS,
+) -> pd.DataFrame:
+    # Bounds of every group in one grouped pass, with the rules of
+    # detect_outliers: a z-score above the threshold is a value outside
+    # mean -/+ threshold * std
+    grouped = df.groupby(list(by), observed=True)[column]
+    if method == "iqr":
+        quartiles = grouped.quantile([0.25, 0.75]).unstack()
+        q1, q3 = quartiles[0.25], quartiles[0.75]
+        lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+    else:
+        std = grouped.std(ddof=zscore_ddof)
+        std = std.where(std > 0)
+        lower = grouped.mean() - zscore_threshold * std
+        upper = grouped.mean() + zscore_threshold * std
+    return _bounds_table(grouped.count(), lower, upper, min_rows)
+
+
+def _group_positions(
+    df: pd.DataFrame, by: Sequence[str], bounds: pd.DataFrame
+) -> np.ndarray:
+    # Row of the bounds table for every row of df, -1 for unknown groups
+    keys = (
+        pd.MultiIndex.from_frame(df[list(by)]) if len(by) > 1 else pd.Index(df[by[0]])
+    )
+    return bounds.index.get_indexer(keys)
+
+
+def flag_outliers(
+    df: pd.DataFrame, column: str, by: Sequence[str], bounds: pd.DataFrame
+) -> np.ndarray:
+    # Bounds are broadcast to the rows by their group's position in the bounds
+    # table; rows of groups without bounds are not flagged
+    positions = _group_positions(df, by, bounds)
+    lower = np.append(bounds["lower_bound"].to_numpy(dtype=float), np.nan)
+    upper = np.append(bounds["upper_bound"].to_numpy(dtype=float), np.nan)
+    values = df[column].to_numpy(dtype=float, na_value=np.nan)
+    return (values < lower[positions]) | (values > upper[positions])
+
+
+def grouped_outliers(
+    df: pd.DataFrame,
+    column: str,
+    by: Sequence[str],
+    method: Literal["iqr", "zscore"] = "iqr",
+    zscore_threshold: float = 3.0,
+    min_rows: int = MIN_GROUP_ROWS,
+) -> pd.DataFrame:
+    # Bounds per group and the number of flagged rows in it
+    bounds = group_bounds(
+        df, column, by, method, zscore_threshold=zscore_threshold, min_rows=min_rows
+    )
+    flagged = flag_outliers(df, column, by, bounds)
+    bounds["count"] = np.bincount(
+        _group_positions(df, by, bounds)[flagged], minlength=len(bounds)
+    )
+    return bounds
+
+
+def grouped_outliers_approx(
+    chunks: Iterable[pd.DataFrame],
+    column: str,
+    by: Sequence[str],
+    method: Literal["iqr", "zscore"] = "iqr",
+    zscore_threshold: float = 3.0,
+    min_rows: int = MIN_GROUP_ROWS,
+    sample_size: int = GROUP_SAMPLE_SIZE,
+) -> pd.DataFrame:
+    # One pass over the chunks: a sample of every group for quartiles and the
+    # flagged share, exact moments for z-scores. Counts are the sample share
+    # times the group size, exact for groups that fit in the sample
+    sample = GroupedBottomKSample(list(by), sample_size)
+    moments = GroupedMoments(list(by))
+    for chunk in chunks:
+        values = chunk[column].to_numpy(dtype=float, na_value=np.nan)
+        sample.update(chunk, values)
+        moments.update(chunk, values)
+    return grouped_outliers_from_sketches(
+        sample, moments, method, zscore_threshold, min_rows
+    )
+
+
+def grouped_outliers_from_sketches(
+    sample: GroupedBottomKSample,
+    moments: GroupedMoments,
+    method: Literal["iqr", "zscore"] = "iqr",
+    zscore_threshold: float = 3.0,
+    min_rows: int = MIN_GROUP_ROWS,
+) -> pd.DataFrame:
+    if method == "iqr":
+        quartiles = sample.quantiles([0.25, 0.75])
+        q1, q3 = quartiles[0.25], quartiles[0.75]
+        lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+    else:
+        std = moments.std(ddof=0)
+        std = std.where(std > 0)
+        lower = moments.stats["mean"] - zscore_threshold * std
+        upper = moments.stats["mean"] + zscore_threshold * std
+    bounds = _bounds_table(sample.n, lower, upper, min_rows)
+
+    flagged = flag_outliers(sample.rows, "value", sample.by, bounds)
+    share = (
+        pd.Series(flagged, index=sample.rows.index)
+        .groupby([sample.rows[col] for col in sample.by], observed=True)
+        .mean()
+    )
+    bounds["count"] = (
+        (share.reindex(bounds.index).fillna(0) * bounds["rows"]).round().astype("int64")
+    )
+    return bounds
+
+
+def outlier_summary(table: pd.DataFrame) -> dict:
+    # Totals and the groups that have bounds, in the layout of the audit JSON
+    rows = int(table["rows"].sum())
+    count = int(table["count"].sum())
+    checked = table.loc[table["lower_bound"].notna()]
+    return {
+        "groups": len(table),
+        "groups_with_bounds": len(checked),
+        "count": count,
+        "percentage": count / rows if rows > 0 else 0.0,
+        "by_group": {
+            (" / ".join(map(str, key)) if isinstance(key, tuple) else str(key)): {
+                "rows": int(group["rows"]),
+                "lower_bound": float(group["lower_bound"]),
+                "upper_bound": float(group["upper_bound"]),
+                "count": int(group["count"]),
+            }
+            for key, group in checked.iterrows()
+        },
+    }
@@ -0,0 +1,232 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Optional, Sequence
+
+from .instrument import count_rows, measure_stage
+from .memo import (
+    MAX_CACHE_BYTES,
+    code_hash,
+    evict,
+    file_hash,
+    load_entry,
+    outputs_hash,
+    params_hash,
+    read_entry,
+    rerun_reason,
+    save_last_parts,
+    stage_key,
+    write_entry,
+)
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    func: Callable[..., Any]
+    # Outputs of these stages are passed to func positionally, in this order
+    deps: tuple[str, ...] = ()
+    kwargs: dict = field(default_factory=dict)
+    # Files read by func: their content is part of the cache key
+    files: tuple[Path, ...] = ()
+    # Files or directories written by func: a cached result is only reused
+    # while they exist unchanged since the stage wrote them
+    outputs: tuple[Path, ...] = ()
+
+
+def _check_graph(stages: list[Stage]) -> None:
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Pipeline: duplicate stage names")
+    for stage in stages:
+        missing = set(stage.deps) - set(names)
+        if missing:
+            raise ValueError(f"Pipeline: {stage.name} depends on unknown {missing}")
+
+
+def select(stages: list[Stage], targets: Optional[Sequence[str]]) -> list[Stage]:
+    # The targets and everything they depend on, in the original order
+    if targets is None:
+        return stages
+    by_name = {stage.name: stage for stage in stages}
+    unknown = set(targets) - set(by_name)
+    if unknown:
+        raise ValueError(f"Pipeline: unknown targets {unknown}")
+
+    needed: set[str] = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack += by_name[name].deps
+    return [stage for stage in stages if stage.name in needed]
+
+
+def _topological(stages: list[Stage]) -> list[Stage]:
+    done: set[str] = set()
+    ordered: list[Stage] = []
+    pending = list(stages)
+    while pending:
+        ready = [s for s in pending if set(s.deps) <= done]
+        if not ready:
+            raise ValueError("Pipeline: dependency cycle")
+        for stage in ready:
+            pending.remove(stage)
+            ordered.append(stage)
+            done.add(stage.name)
+    return ordered
+
+
+def _key_parts(stage: Stage, output_hashes: dict[str, str]) -> dict:
+    return {
+        "stage": stage.name,
+        "code": code_hash(stage.func),
+        "params": params_hash(stage.func, stage.kwargs),
+        "files": {str(path): file_hash(path) for path in stage.files},
+        "deps": {dep: output_hashes[dep] for dep in stage.deps},
+    }
+
+
+def _cached_entry(stage: Stage, key: str, cache_dir: Path) -> Optional[dict]:
+    if not all(path.exists() for path in stage.outputs):
+        return None
+    entry = load_entry(key, cache_dir)
+    if entry is None or entry.get("outputs") != outputs_hash(stage.outputs):
+        return None
+    return entry
+
+
+def explain(
+    stages: list[Stage], cache_dir: Path, targets: Optional[Sequence[str]] = None
+) -> dict[str, Optional[str]]:
+    # Why each stage would rerun, None for stages served from the cache
+    _check_graph(stages)
+    stages = select(stages, targets)
+    reasons: dict[str, Optional[str]] = {}
+    output_hashes: dict[str, str] = {}
+
+    for stage in _topological(stages):
+        rerun_deps = [dep for dep in stage.deps if dep not in output_hashes]
+        if rerun_deps:
+            reasons[stage.name] = (
+                f"depends on {', '.join(rerun_deps)} "
+                "(reused if their output does not change)"
+            )
+            continue
+
+        parts = _key_parts(stage, output_hashes)
+        entry = _cached_entry(stage, stage_key(parts), cache_dir)
+        if entry is None:
+            missing = [str(path) for path in stage.outputs if not path.exists()]
+            stored = load_entry(stage_key(parts), cache_dir)
+            if missing:
+                reasons[stage.name] = f"output {', '.join(missing)} missing"
+            elif stored is not None:
+                changed = [
+                    path
+                    for path, digest in outputs_hash(stage.outputs).items()
+                    if (stored.get("outputs") or {}).get(path) != digest
+                ]
+                reasons[stage.name] = f"output {', '.join(changed)} changed"
+            else:
+                reasons[stage.name] = rerun_reason(stage.name, parts, cache_dir)
+        else:
+            reasons[stage.name] = None
+            output_hashes[stage.name] = entry["output_hash"]
+
+    return reasons
+
+
+def critical_path(
+    stages: list[Stage], durations: dict[str, float]
+) -> tuple[list[str], float]:
+    by_name = {stage.name: stage for stage in stages}
+    cost: dict[str, float] = {}
+    previous: dict[str, Optional[str]] = {}
+
+    def visit(name: str) -> float:
+        if name not in cost:
+            deps = by_name[name].deps
+            slowest = max(deps, key=visit, default=None)
+            previous[name] = slowest
+            cost[name] = durations[name] + (cost[slowest] if slowest else 0.0)
+        return cost[name]
+
+    last = max(by_name, key=visit)
+    path = [last]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return path[::-1], cost[last]
+
+
+def run_pipeline(
+    stages: list[Stage],
+    max_workers: Optional[int] = None,
+    cache_dir: Optional[Path] = None,
+    max_cache_bytes: int = MAX_CACHE_BYTES,
+    targets: Optional[Sequence[str]] = None,
+) -> dict[str, Any]:
+    _check_graph(stages)
+    stages = select(stages, targets)
+    outputs: dict[str, Any] = {}
+    output_hashes: dict[str, str] = {}
+    durations: dict[str, float] = {}
+    pending = list(stages)
+    start = perf_counter()
+
+    def run(stage: Stage) -> Any:
+        args = [outputs[dep] for dep in stage.deps]
+        with measure_stage(stage.name, rows_in=count_rows(args)) as record:
+            if cache_dir is None:
+                result = stage.func(*args, **stage.kwargs)
+            else:
+                # Keys chain through the hashes of dependency outputs, so a
+                # stage that reruns with an unchanged result keeps its
+                # dependants cached
+                parts = _key_parts(stage, output_hashes)
+                key = stage_key(parts)
+                entry = _cached_entry(stage, key, cache_dir)
+                record["cached"] = entry is not None
+                if entry is not None:
+                    result = read_entry(key, cache_dir)
+                    output_hashes[stage.name] = entry["output_hash"]
+                else:
+                    result = stage.func(*args, **stage.kwargs)
+                    output_hashes[stage.name] = write_entry(
+                        key,
+                        result,
+                        {"stage": stage.name, "outputs": outputs_hash(stage.outputs)},
+                        cache_dir,
+                    )
+                save_last_parts(stage.name, parts, cache_dir)
+            record["rows_out"] = count_rows(result)
+        durations[stage.name] = record["wall_seconds"]
+        return result
+
+    # Stages are submitted as soon as all their dependencies are done
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running: dict[Future, Stage] = {}
+        while pending or running:
+            ready = [s for s in pending if all(dep in outputs for dep in s.deps)]
+            for stage in ready:
+                pending.remove(stage)
+                running[pool.submit(run, stage)] = stage
+            if not running:
+                raise ValueError("Pipeline: dependency cycle")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                outputs[running.pop(future).name] = future.result()
+
+    wall = perf_counter() - start
+    if cache_dir is not None:
+        evict(cache_dir, max_cache_bytes)
+    path, path_seconds = critical_path(stages, durations)
+    print(
+        f"Pipeline: {wall:.2f}s wall, {sum(durations.values()):.2f}s in stages, "
+        f"critical path {path_seconds:.2f}s: {' -> '.join(path)}"
+    )
+
+    return outputs
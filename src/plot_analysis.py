@@ -1,16 +1,49 @@
-import os
 from pathlib import Path
+from typing import Callable, Optional
+from matplotlib.figure import Figure
+import hashlib
+import json
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
-sns.set_style("dark")
-sns.set_palette("muted")
-plt.style.use("dark_background")
+from .instrument import add_record, measure, measured_call, process_pool
+from .memo import code_hash, file_hash
 
+STYLE = {"seaborn_style": "dark", "palette": "muted", "mpl_style": "dark_background"}
 
-def plot_payment_method_pie(data: pd.Series, save_dir_path: Path) -> Path:
-    fig, ax = plt.subplots(figsize=(10, 6))
+sns.set_style(STYLE["seaborn_style"])
+sns.set_palette(STYLE["palette"])
+plt.style.use(STYLE["mpl_style"])
+
+# Input hash of every figure rendered into a plots directory
+HASHES_FILE_NAME = ".plot_hashes.json"
+
+
+def _subplots(fig: Optional[Figure], figsize: tuple[float, float], *grid: int):
+    # A figure passed in is cleared and drawn again, so bulk rendering does
+    # not create and tear down a figure per file
+    if fig is None:
+        fig = plt.figure(figsize=figsize)
+    else:
+        fig.clear()
+        fig.set_size_inches(figsize)
+    return fig, fig.subplots(*grid)
+
+
+def _save(fig: Figure, file_path: Path, keep: bool) -> Path:
+    fig.tight_layout()
+    fig.savefig(file_path)
+    if not keep:
+        plt.close(fig)
+    return file_path
+
+
+def plot_payment_method_pie(
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
+) -> Path:
+    keep = fig is not None
+    fig, ax = _subplots(fig, (10, 6))
     ax.pie(
         data,
         labels=list(data.index),
@@ -19,15 +52,14 @@ def plot_payment_method_pie(data: pd.Series, save_dir_path: Path) -> Path:
         startangle=140,
     )
     ax.set_title("Доля транзакций по способам оплаты")
-    fig.tight_layout()
-    file_path = save_dir_path / "payment_method_pie.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "payment_method_pie.png", keep)
 
 
-def plot_services_by_transaction_amount(data: pd.Series, save_dir_path: Path) -> Path:
-    fig, ax = plt.subplots(figsize=(10, 5))
+def plot_services_by_transaction_amount(
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
+) -> Path:
+    keep = fig is not None
+    fig, ax = _subplots(fig, (10, 5))
     bars = ax.barh(
         data.index,
         data / 1e6,
@@ -37,17 +69,14 @@ def plot_services_by_transaction_amount(data: pd.Series, save_dir_path: Path) ->
     ax.set_xlabel("Выручка (млн. $)")
     ax.set_ylabel("Услуга")
     ax.set_title("Выручка по услугам")
-    fig.tight_layout()
-    file_path = save_dir_path / "services_by_transaction_amount.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "services_by_transaction_amount.png", keep)
 
 
 def plot_client_net_worth_category_total_amount(
-    data: pd.Series, save_dir_path: Path
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
 ) -> Path:
-    fig, ax = plt.subplots(figsize=(10, 8))
+    keep = fig is not None
+    fig, ax = _subplots(fig, (10, 8))
     bars = ax.bar(
         data.index,
         data / 1e6,
@@ -57,15 +86,16 @@ def plot_client_net_worth_category_total_amount(
     ax.set_xlabel("Категория активов")
     ax.set_ylabel("Сумма транзакций (млн. $)")
     ax.set_title("Выручка по категориям клиентов")
-    fig.tight_layout()
-    file_path = save_dir_path / "client_net_worth_category_total_amount.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(
+        fig, save_dir_path / "client_net_worth_category_total_amount.png", keep
+    )
 
 
-def plot_avg_transaction_by_age(data: pd.Series, save_dir_path: Path) -> Path:
-    fig, ax = plt.subplots(figsize=(11, 5))
+def plot_avg_transaction_by_age(
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
+) -> Path:
+    keep = fig is not None
+    fig, ax = _subplots(fig, (11, 5))
     smoothed = pd.Series(
         data.sort_index().rolling(3, min_periods=1, center=True).mean()
     )
@@ -74,15 +104,14 @@ def plot_avg_transaction_by_age(data: pd.Series, save_dir_path: Path) -> Path:
     ax.set_xlabel("Возраст клиента")
     ax.set_ylabel("Средняя сумма транзакции (тыс. $)")
     ax.set_title("Средняя сумма транзакции по возрасту клиента")
-    fig.tight_layout()
-    file_path = save_dir_path / "avg_transaction_amount_by_client_age.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "avg_transaction_amount_by_client_age.png", keep)
 
 
-def plot_last_month_amount_by_service(data: pd.Series, save_dir_path: Path) -> Path:
-    fig, ax = plt.subplots(figsize=(10, 5))
+def plot_last_month_amount_by_service(
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
+) -> Path:
+    keep = fig is not None
+    fig, ax = _subplots(fig, (10, 5))
     bars = ax.barh(
         data.index,
         data / 1e6,
@@ -92,40 +121,37 @@ def plot_last_month_amount_by_service(data: pd.Series, save_dir_path: Path) -> P
     ax.set_xlabel("Выручка (млн. $)")
     ax.set_ylabel("Услуга")
     ax.set_title("Выручка по услугам за последний месяц")
-    fig.tight_layout()
-    file_path = save_dir_path / "last_month_amount_by_service.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "last_month_amount_by_service.png", keep)
 
 
-def plot_amount_distribution(data: pd.Series, save_dir_path: Path) -> Path:
-    fig, ax = plt.subplots(figsize=(10, 5))
+def plot_amount_distribution(
+    data: pd.Series, save_dir_path: Path, fig: Optional[Figure] = None
+) -> Path:
+    keep = fig is not None
+    fig, ax = _subplots(fig, (10, 5))
     sns.histplot(data / 1e3, bins=40, kde=True, color="lightgreen", ax=ax)
     ax.set_xlabel("Сумма транзакции (тыс. $)")
     ax.set_ylabel("Количество транзакций")
     ax.set_title("Распределение сумм транзакций")
-    fig.tight_layout()
-    file_path = save_dir_path / "amount_distribution.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "amount_distribution.png", keep)
 
 
-def plot_forecast(df: pd.DataFrame, preds: dict, save_dir_path: Path) -> Path:
-    monthly_df = (
-        df.set_index("transaction_date")
-        .resample("ME")
-        .agg(
-            count=("amount", "count"),
-            amount=("amount", "sum"),
-        )
-        .reset_index()
+def plot_forecast(
+    monthly: pd.DataFrame,
+    preds: dict,
+    save_dir_path: Path,
+    fig: Optional[Figure] = None,
+) -> Path:
+    # Bars are placed at month ends, as resample("ME") labels them
+    monthly_df = monthly.rename_axis("transaction_date").reset_index()
+    monthly_df["transaction_date"] = (
+        monthly_df["transaction_date"].dt.to_timestamp(how="end").dt.normalize()
     )
     next_month = monthly_df["transaction_date"].max() + pd.DateOffset(months=1)
     all_dates = list(monthly_df["transaction_date"]) + [next_month]
 
-    fig, axes = plt.subplots(1, 2, figsize=(8, 5))
+    keep = fig is not None
+    fig, axes = _subplots(fig, (8, 5), 1, 2)
     for ax, target, label in zip(
         axes,
         ["count", "amount"],
@@ -145,37 +171,130 @@ def plot_forecast(df: pd.DataFrame, preds: dict, save_dir_path: Path) -> Path:
         fig.autofmt_xdate()
 
     fig.suptitle("Прогноз на следующий месяц")
-    fig.tight_layout()
-    file_path = save_dir_path / "forecast_next_month.png"
-    fig.savefig(file_path)
-    plt.close(fig)
-    return file_path
+    return _save(fig, save_dir_path / "forecast_next_month.png", keep)
 
 
-def plot_analysis(
-    analysis_results: dict, df: pd.DataFrame, save_dir_path: Path
-) -> dict[str, Path]:
+def _input_hash(func: Callable, args: tuple) -> str:
+    # The plot function's code with its helpers and constants, so editing how
+    # a figure is drawn renders it again
+    digest = hashlib.sha256(code_hash(func).encode())
+    digest.update(json.dumps(STYLE, sort_keys=True).encode())
+    for arg in args:
+        if isinstance(arg, (pd.Series, pd.DataFrame)):
+            digest.update(pd.util.hash_pandas_object(arg).to_numpy().tobytes())
+            names = arg.columns if isinstance(arg, pd.DataFrame) else [arg.name]
+            digest.update(json.dumps([str(n) for n in names]).encode())
+        else:
+            digest.update(json.dumps(arg, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def plot_tasks(
+    analysis_results: dict, amounts: pd.Series
+) -> dict[str, tuple[Callable[..., Path], tuple]]:
+    # Plot function and its data for every figure of the report
     return {
-        "services_by_transaction_amount": plot_services_by_transaction_amount(
-            analysis_results["services_by_transaction_amount"], save_dir_path
+        "services_by_transaction_amount": (
+            plot_services_by_transaction_amount,
+            (analysis_results["services_by_transaction_amount"],),
         ),
-        "client_net_worth_category_total_amount": plot_client_net_worth_category_total_amount(
-            analysis_results["client_net_worth_category_total_amount"],
-            save_dir_path,
+        "client_net_worth_category_total_amount": (
+            plot_client_net_worth_category_total_amount,
+            (analysis_results["client_net_worth_category_total_amount"],),
         ),
-        "payment_method_pie": plot_payment_method_pie(
-            analysis_results["payment_method_percentage"], save_dir_path
+        "payment_method_pie": (
+            plot_payment_method_pie,
+            (analysis_results["payment_method_percentage"],),
         ),
-        "avg_transaction_amount_by_client_age": plot_avg_transaction_by_age(
-            analysis_results["avg_transaction_amount_by_client_age"], save_dir_path
+        "avg_transaction_amount_by_client_age": (
+            plot_avg_transaction_by_age,
+            (analysis_results["avg_transaction_amount_by_client_age"],),
         ),
-        "last_month_amount_by_service": plot_last_month_amount_by_service(
-            analysis_results["last_month_amount_by_service"], save_dir_path
+        "last_month_amount_by_service": (
+            plot_last_month_amount_by_service,
+            (analysis_results["last_month_amount_by_service"],),
         ),
-        "amount_distribution": plot_amount_distribution(
-            pd.Series(df["amount"]), save_dir_path
+        "amount_distribution": (
+            plot_amount_distribution,
+            (amounts,),
         ),
-        "forecast_next_month": plot_forecast(
-            df, analysis_results["forecast_next_month"], save_dir_path
+        "forecast_next_month": (
+            plot_forecast,
+            (
+                analysis_results["monthly_totals"],
+                analysis_results["forecast_next_month"],
+            ),
         ),
     }
+
+
+def plot_analysis(
+    analysis_results: dict,
+    df: pd.DataFrame,
+    save_dir_path: Path,
+    max_workers: Optional[int] = None,
+) -> dict[str, Path]:
+    tasks = plot_tasks(analysis_results, pd.Series(df["amount"]))
+
+    hashes_file = save_dir_path / HASHES_FILE_NAME
+    old_hashes = {}
+    if hashes_file.exists():
+        with open(hashes_file, encoding="utf-8") as f:
+            old_hashes = json.load(f)
+
+    # Figures whose inputs and style did not change are reused from disk, as
+    # long as the file is still the one that was rendered
+    hashes = {name: _input_hash(func, args) for name, (func, args) in tasks.items()}
+    plots = {
+        name: save_dir_path / old_hashes[name]["file"]
+        for name in tasks
+        if name in old_hashes
+        and old_hashes[name]["hash"] == hashes[name]
+        and (save_dir_path / old_hashes[name]["file"]).exists()
+        and file_hash(save_dir_path / old_hashes[name]["file"])
+        == old_hashes[name].get("file_hash")
+    }
+    pending = {name: task for name, task in tasks.items() if name not in plots}
+
+    if max_workers == 1 or len(pending) <= 1:
+        for name, (func, args) in pending.items():
+            plots[name] = measure(f"plot.{name}", func, *args, save_dir_path)
+    elif pending:
+        with process_pool(max_workers) as pool:
+            futures = {
+                name: pool.submit(
+                    measured_call, f"plot.{name}", func, *args, save_dir_path
+                )
+                for name, (func, args) in pending.items()
+            }
+            for name, future in futures.items():
+                plots[name], record = future.result()
+                add_record(record)
+
+    with open(hashes_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                name: {
+                    "hash": hashes[name],
+                    "file": plots[name].name,
+                    "file_hash": file_hash(plots[name]),
+                }
+                for name in tasks
+            },
+            f,
+            indent=2,
+        )
+
+    return {name: plots[name] for name in tasks}
+
+
+def render_figures(
+    func: Callable[..., Path], jobs: list[tuple[tuple, Path]]
+) -> list[Path]:
+    # One figure of a kind drawn for many segments, each job is the data and
+    # the directory of one segment
+    fig = plt.figure()
+    try:
+        return [func(*args, save_dir_path, fig) for args, save_dir_path in jobs]
+    finally:
+        plt.close(fig)
@@ -0,0 +1,345 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Optional, Sequence
+import argparse
+import hashlib
+import os
+import re
+import sys
+import numpy as np
+import pandas as pd
+
+from .analysis import METRICS, Metric, finalize_metrics, run_analysis
+from .cube import WINDOWS
+from .forecast import (
+    FORECAST_KEYS,
+    fill_months,
+    forecast_from_monthly,
+    forecast_groups,
+)
+from .generate_md_report import (
+    REPORT_TITLE,
+    generate_md_report,
+    render_report,
+    timestamp,
+)
+from .instrument import (
+    add_record,
+    measure,
+    measure_stage,
+    measured_call,
+    process_pool,
+)
+from .utils import key_column
+
+# Keys with a report for every value
+SEGMENT_REPORT_KEYS = ("city", "service", "consultant")
+
+SEGMENT_TITLES = {"city": "Город", "service": "Услуга", "consultant": "Консультант"}
+
+SEGMENTS_DIR_NAME = "segments"
+
+
+def _slug(value: str) -> str:
+    # A short hash of the raw value keeps "A/B" and "A B" apart
+    readable = re.sub(r"[^\w-]+", "_", value).strip("_") or "_"
+    return f"{readable}-{hashlib.sha256(value.encode()).hexdigest()[:8]}"
+
+
+def _by_segment(grouped: pd.DataFrame | pd.Series) -> dict[str, pd.DataFrame]:
+    # Rows of a table grouped by segment first, split per segment
+    return {
+        str(value): part.droplevel(0) if part.index.nlevels > 1 else part
+        for value, part in grouped.groupby(level=0, observed=True)
+    }
+
+
+def _window_mask(dates: pd.Series, segment: pd.Series, window: str) -> np.ndarray:
+    # Windows end on the last transaction of each segment, as the cube of a
+    # single segment's rows would have them
+    last = dates.groupby(segment, observed=True).max()
+    start = (last - WINDOWS[window]).reindex(segment).to_numpy()
+    return dates.to_numpy() >= start
+
+
+def segment_results(
+    df: pd.DataFrame, by: str, metrics: dict[str, Metric] = METRICS
+) -> dict[str, dict]:
+    # run_analysis for every value of a key at once: each metric, the monthly
+    # totals and the forecasts are one grouped pass with the segment as the
+    # outer key, then split per segment
+    segment = key_column(df, by).rename("segment")
+    month = df["transaction_date"].dt.to_period("M").rename("month")
+    values = [str(value) for value in segment.dropna().unique()]
+
+    groups: dict[tuple[str, str | None], dict[str, pd.DataFrame]] = {}
+    for metric in metrics.values():
+        plan = (metric.window, metric.by)
+        if plan in groups:
+            continue
+        keys = [segment]
+        if metric.by is not None:
+            keys.append(key_column(df, metric.by).rename(metric.by))
+        amounts = df["amount"]
+        if metric.window != "all":
+            rows = _window_mask(df["transaction_date"], segment, metric.window)
+            amounts, keys = amounts[rows], [key[rows] for key in keys]
+        grouped = amounts.groupby(keys, observed=True).agg(["count", "sum"])
+        groups[plan] = _by_segment(grouped)
+
+    monthly = _by_segment(
+        df["amount"]
+        .groupby([segment, month], observed=True)
+        .agg(count="count", amount="sum")
+    )
+    monthly_by = {
+        key: _by_segment(
+            df["amount"]
+            .groupby([segment, month, key_column(df, key).rename(key)], observed=True)
+            .agg(count="count", amount="sum")
+        )
+        for key in FORECAST_KEYS
+    }
+
+    results = {}
+    for value in values:
+        segment_groups = {}
+        for (window, metric_by), parts in groups.items():
+            if value in parts:
+                part = parts[value]
+                segment_groups[(window, metric_by)] = (
+                    part.iloc[0] if metric_by is None else part
+                )
+            else:
+                # No rows of the segment in the window
+                segment_groups[(window, metric_by)] = (
+                    pd.Series({"count": 0, "sum": 0.0})
+                    if metric_by is None
+                    else pd.DataFrame({"count": [], "sum": []})
+                )
+        value_results = finalize_metrics(segment_groups, metrics)
+        monthly_totals = fill_months(monthly[value])
+        value_results["forecast_next_month"] = forecast_from_monthly(monthly_totals)
+        for key in FORECAST_KEYS:
+            value_results[f"forecast_next_month_by_{key}"] = forecast_groups(
+                fill_months(monthly_by[key][value].unstack(fill_value=0))
+            )
+        value_results["monthly_totals"] = monthly_totals
+        results[value] = value_results
+    return results
+
+
+def _render_figures(
+    jobs: dict[Callable[..., Path], list[tuple[tuple, Path]]],
+    max_workers: Optional[int] = None,
+) -> dict[Callable[..., Path], list[Path]]:
+    # Jobs of a kind are split into one chunk per worker; a worker draws its
+    # chunk on a single reused figure
+    from .plot_analysis import render_figures
+
+    workers = max_workers or os.cpu_count() or 1
+    if workers == 1:
+        return {
+            func: measure(f"segment_plots.{func.__name__}", render_figures, func, chunk)
+            for func, chunk in jobs.items()
+        }
+
+    chunks = [
+        (func, [func_jobs[i] for i in positions])
+        for func, func_jobs in jobs.items()
+        for positions in np.array_split(np.arange(len(func_jobs)), workers)
+        if len(positions)
+    ]
+    paths: dict[Callable[..., Path], list[Path]] = {func: [] for func in jobs}
+    with process_pool(workers) as pool:
+        futures = [
+            (
+                func,
+                pool.submit(
+                    measured_call,
+                    f"segment_plots.{func.__name__}",
+                    render_figures,
+                    func,
+                    chunk,
+                ),
+            )
+            for func, chunk in chunks
+        ]
+        # Chunks of a kind are collected in submission order
+        for func, future in futures:
+            chunk_paths, record = future.result()
+            paths[func].extend(chunk_paths)
+            add_record(record)
+    return paths
+
+
+def _index(
+    totals: dict[str, pd.DataFrame], reports: dict[str, dict[str, Path]], generated: str
+) -> str:
+    sections = []
+    for by, table in totals.items():
+        links = [f"[{value}]({by}/{reports[by][value].name})" for value in table.index]
+        table = pd.DataFrame(
+            {
+                SEGMENT_TITLES.get(by, by): links,
+                "Транзакции": table["count"].map("{:,.0f}".format).to_numpy(),
+                "Выручка": table["sum"].map("${:,.0f}".format).to_numpy(),
+            }
+        )
+        sections.append(
+            f"## {SEGMENT_TITLES.get(by, by)}\n{table.to_markdown(index=False)}\n"
+        )
+    return f"# Отчёты по сегментам\n{generated}\n\n" + "\n".join(sections)
+
+
+def generate_segment_reports(
+    merged_df: pd.DataFrame,
+    output_dir: Path,
+    keys: Sequence[str] = SEGMENT_REPORT_KEYS,
+    max_workers: Optional[int] = None,
+) -> Path:
+    # matplotlib and seaborn are only imported when reports are built
+    from .plot_analysis import plot_tasks
+
+    segments_dir = output_dir / SEGMENTS_DIR_NAME
+    generated = timestamp()
+
+    pages = []
+    jobs: dict[Callable[..., Path], list[tuple[tuple, Path]]] = {}
+    totals = {}
+    for by in keys:
+        results = measure(f"segments.{by}", segment_results, merged_df, by)
+        segment = key_column(merged_df, by)
+        amounts = {
+            str(value): part
+            for value, part in merged_df["amount"].groupby(segment, observed=True)
+        }
+        totals[by] = (
+            merged_df["amount"]
+            .groupby(segment, observed=True)
+            .agg(["count", "sum"])
+            .sort_values("sum", ascending=False)
+            .rename(index=str)
+        )
+        for value, value_results in results.items():
+            report_path = segments_dir / by / f"{_slug(value)}.md"
+            plots_dir = segments_dir / by / "plots" / _slug(value)
+            plots_dir.mkdir(parents=True, exist_ok=True)
+            names = []
+            for name, (func, args) in plot_tasks(value_results, amounts[value]).items():
+                names.append((name, func, len(jobs.setdefault(func, []))))
+                jobs[func].append((args, plots_dir))
+            pages.append((by, value, value_results, report_path, names))
+
+    paths = _render_figures(jobs, max_workers)
+
+    reports: dict[str, dict[str, Path]] = {by: {} for by in keys}
+    with measure_stage("segments.render"):
+        for by, value, results, report_path, names in pages:
+            plots = {name: paths[func][i] for name, func, i in names}
+            report = render_report(
+                results,
+                plots,
+                report_path,
+                title=f"{REPORT_TITLE}: {SEGMENT_TITLES.get(by, by).lower()} {value}",
+                generated=generated,
+            )
+            with open(report_path, "w", encoding="utf-8") as f:
+                f.write(report)
+            reports[by][value] = report_path
+
+    index_path = segments_dir / "index.md"
+    with open(index_path, "w", encoding="utf-8") as f:
+        f.write(_index(totals, reports, generated))
+    print(f"Segment reports generated: {index_path} ({len(pages)} reports)")
+    return index_path
+
+
+def segment_reports_loop(
+    merged_df: pd.DataFrame,
+    output_dir: Path,
+    keys: Sequence[str] = SEGMENT_REPORT_KEYS,
+) -> int:
+    # The baseline: the analysis and the report of main() on every
+    # segment's rows
+    reports = 0
+    for by in keys:
+        segment = key_column(merged_df, by)
+        for value in segment.dropna().unique():
+            df = merged_df.loc[(segment == value).to_numpy()]
+            segment_dir = output_dir / by / _slug(str(value))
+            segment_dir.mkdir(parents=True, exist_ok=True)
+            results = run_analysis(
+                df, save_file_name=segment_dir / "analysis_results.json"
+            )
+            generate_md_report(results, df, segment_dir / "report.md")
+            reports += 1
+    return reports
+
+
+def _body(report: str) -> str:
+    # Everything below the title and the timestamp
+    return report.split("\n", 2)[2]
+
+
+def compare_segment_reports(
+    merged_df: pd.DataFrame,
+    keys: Sequence[str] = SEGMENT_REPORT_KEYS,
+    max_workers: Optional[int] = None,
+) -> dict[str, float]:
+    with TemporaryDirectory() as tmp:
+        batch_dir, loop_dir = Path(tmp) / "batch", Path(tmp) / "loop"
+
+        start = perf_counter()
+        generate_segment_reports(merged_df, batch_dir, keys, max_workers)
+        batch_s = perf_counter() - start
+
+        start = perf_counter()
+        reports = segment_reports_loop(merged_df, loop_dir, keys)
+        loop_s = perf_counter() - start
+
+        # Both modes must write the same reports
+        for report in (loop_dir).glob("*/*/report.md"):
+            by, slug = report.parts[-3], report.parts[-2]
+            batch_report = batch_dir / SEGMENTS_DIR_NAME / by / f"{slug}.md"
+            expected = _body(report.read_text(encoding="utf-8"))
+            got = _body(batch_report.read_text(encoding="utf-8"))
+            if got.replace(f"plots/{slug}/", "plots/") != expected:
+                raise AssertionError(f"Segment report differs: {by}/{slug}")
+
+    print(
+        f"{reports} segment reports: batch {batch_s:.2f}s, "
+        f"loop {loop_s:.2f}s ({loop_s / batch_s:.1f}x)"
+    )
+    return {"reports": reports, "batch_s": batch_s, "loop_s": loop_s}
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m src.segment_reports",
+        description="Time batch segment reports against a report per segment",
+    )
+    parser.add_argument(
+        "--transactions", type=Path, default=Path("data") / "transactions_data.xlsx"
+    )
+    parser.add_argument(
+        "--clients", type=Path, default=Path("data") / "clients_data.json"
+    )
+    parser.add_argument("--keys", nargs="+", default=list(SEGMENT_REPORT_KEYS))
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from .clean_data import clean_clients, clean_transactions, merge_tables
+    from .readers import read_excel_streaming, read_json_streaming
+
+    merged_df = merge_tables(
+        clean_transactions(read_excel_streaming(args.transactions)),
+        clean_clients(read_json_streaming(args.clients)),
+    )
+    compare_segment_reports(merged_df, args.keys, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import reduce
+from pathlib import Path
+from typing import Optional
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .analysis import METRICS, SEGMENT_KEYS, Metric, group_partials, save_results
+from .backends import Aggregates, as_parquet, results_from_aggregates
+from .clean_data import clean_clients, clean_transactions, merge_tables
+from .cube import WINDOWS, DailyCube, build_cube, update_cube, window_partials
+from .dedup import hash_ids
+from .features import ClientFeatures, build_features, client_segments, update_features
+from .forecast import FORECAST_KEYS, monthly_partials, widen_monthly
+from .instrument import add_record, measure, measured_call, process_pool
+
+SHARD_DIR = Path(".cache") / "shards"
+
+# Two shards per core even out shards that came out larger than the rest
+N_SHARDS = 2 * (os.cpu_count() or 1)
+
+# Rows read from the source at a time while partitioning
+PARTITION_BATCH_ROWS = 1_000_000
+
+# Position of a transaction in the source file, which decides which of its
+# duplicates in different shards is kept
+ROW_COL = "_row"
+
+
+@dataclass(frozen=True)
+class ShardPartials:
+    # Count/sum pairs of the metrics over the whole history
+    groups: dict[tuple[str, str | None], pd.DataFrame | pd.Series]
+    # Daily cube for the windowed metrics
+    cube: DailyCube
+    # Monthly count and amount, the total and per forecast key
+    monthly: dict[str | None, pd.DataFrame]
+    # Features of the shard's clients; shards split by client, so no client
+    # is in two shards
+    features: ClientFeatures
+
+
+# Files a shard step reads and writes; any machine that sees shard_dir can
+# run any step for any shard
+def _file(shard_dir: Path, kind: str, shard: int, suffix: str = ".parquet") -> Path:
+    return shard_dir / f"{kind}_{shard:04d}{suffix}"
+
+
+def shard_of(ids: pd.Series, n_shards: int) -> np.ndarray:
+    return (hash_ids(ids) % np.uint64(n_shards)).astype(np.intp)
+
+
+def partition(
+    transactions_file: Path, clients_file: Path, shard_dir: Path, n_shards: int
+) -> None:
+    # Transactions and clients are split by client id, so every join happens
+    # inside one shard
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    for kind, path, id_col in (
+        ("transactions", transactions_file, "client_id"),
+        ("clients", clients_file, "id"),
+    ):
+        source = pq.ParquetFile(as_parquet(path))
+        schema = source.schema_arrow
+        if kind == "transactions":
+            schema = schema.append(pa.field(ROW_COL, pa.int64()))
+
+        # Every shard gets a file, empty ones included
+        writers = [
+            pq.ParquetWriter(_file(shard_dir, kind, shard), schema)
+            for shard in range(n_shards)
+        ]
+        try:
+            offset = 0
+            for batch in source.iter_batches(batch_size=PARTITION_BATCH_ROWS):
+                df = batch.to_pandas()
+                if kind == "transactions":
+                    df[ROW_COL] = np.arange(offset, offset + len(df))
+                    offset += len(df)
+                shards = shard_of(df[id_col], n_shards)
+                for shard, writer in enumerate(writers):
+                    writer.write_table(
+                        pa.Table.from_pandas(
+                            df.loc[shards == shard], schema=schema, preserve_index=False
+                        )
+                    )
+        finally:
+            for writer in writers:
+                writer.close()
+
+    with open(shard_dir / "shards.json", "w", encoding="utf-8") as f:
+        json.dump({"n_shards": n_shards}, f, indent=2)
+
+
+def clean_shard(shard_dir: Path, shard: int) -> None:
+    # Duplicates inside the shard are dropped here; the ids of the kept rows
+    # go to exchange() to find duplicates across shards
+    transactions = clean_transactions(
+        pd.read_parquet(_file(shard_dir, "transactions", shard))
+    )
+    transactions.to_parquet(_file(shard_dir, "clean", shard), index=False)
+    np.save(
+        _file(shard_dir, "ids", shard, ".npy"),
+        np.stack(
+            [
+                hash_ids(transactions["transaction_id"]),
+                transactions[ROW_COL].to_numpy(dtype=np.uint64),
+            ]
+        ),
+    )
+
+
+def exchange(shard_dir: Path, n_shards: int) -> None:
+    # A transaction_id kept in several shards stays only where it comes first
+    # in the source, as drop_duplicates on the whole table would keep it
+    ids = [np.load(_file(shard_dir, "ids", shard, ".npy")) for shard in range(n_shards)]
+    hashes = np.concatenate([shard_ids[0] for shard_ids in ids])
+    rows = np.concatenate([shard_ids[1] for shard_ids in ids])
+    shards = np.repeat(np.arange(n_shards), [shard_ids.shape[1] for shard_ids in ids])
+
+    order = np.lexsort((rows, hashes))
+    repeated = np.zeros(len(order), dtype=bool)
+    repeated[1:] = hashes[order][1:] == hashes[order][:-1]
+    dropped = order[repeated]
+    for shard in range(n_shards):
+        np.save(
+            _file(shard_dir, "drop", shard, ".npy"),
+            np.sort(rows[dropped[shards[dropped] == shard]]),
+        )
+
+
+def aggregate_shard(
+    shard_dir: Path, shard: int, metrics: dict[str, Metric] = METRICS
+) -> None:
+    transactions = pd.read_parquet(_file(shard_dir, "clean", shard))
+    dropped = np.load(_file(shard_dir, "drop", shard, ".npy"))
+    transactions = transactions.loc[
+        ~np.isin(transactions[ROW_COL].to_numpy(dtype=np.uint64), dropped)
+    ].drop(columns=ROW_COL)
+    clients = clean_clients(pd.read_parquet(_file(shard_dir, "clients", shard)))
+    merged_df = merge_tables(transactions, clients)
+
+    history = {name: m for name, m in metrics.items() if m.window == "all"}
+    partials = ShardPartials(
+        groups=group_partials(merged_df, history),
+        cube=build_cube(merged_df),
+        monthly={by: monthly_partials(merged_df, by) for by in (None, *FORECAST_KEYS)},
+        features=build_features(merged_df),
+    )
+    with open(_file(shard_dir, "partial", shard, ".pkl"), "wb") as f:
+        pickle.dump(partials, f)
+
+
+def _add(parts: list[pd.DataFrame | pd.Series]) -> pd.DataFrame | pd.Series:
+    combined = pd.concat(parts)
+    return combined.groupby(
+        level=list(range(combined.index.nlevels)), observed=True
+    ).sum()
+
+
+def combine(
+    shard_dir: Path, n_shards: int, metrics: dict[str, Metric] = METRICS
+) -> Aggregates:
+    # Counts and sums add up across shards; means, shares and forecasts are
+    # computed from the totals, so the results equal a single-process run
+    parts = []
+    for shard in range(n_shards):
+        with open(_file(shard_dir, "partial", shard, ".pkl"), "rb") as f:
+            parts.append(pickle.load(f))
+
+    groups = {plan: _add([p.groups[plan] for p in parts]) for plan in parts[0].groups}
+    cube = reduce(update_cube, [p.cube for p in parts])
+    groups.update(
+        window_partials(
+            cube,
+            list(
+                dict.fromkeys(
+                    (m.window, m.by) for m in metrics.values() if m.window in WINDOWS
+                )
+            ),
+        )
+    )
+    monthly = {
+        by: widen_monthly(_add([p.monthly[by] for p in parts]), by)
+        for by in (None, *FORECAST_KEYS)
+    }
+    # Recency is counted up to the last transaction of all shards
+    features = reduce(update_features, [p.features for p in parts])
+    segments = {by: client_segments(features, by) for by in SEGMENT_KEYS}
+    return Aggregates(groups, monthly, segments)
+
+
+def _run_shards(
+    pool: ProcessPoolExecutor, name: str, func, shard_dir: Path, n_shards: int
+) -> None:
+    futures = [
+        pool.submit(measured_call, f"shard.{name}.{shard}", func, shard_dir, shard)
+        for shard in range(n_shards)
+    ]
+    for future in futures:
+        _, record = future.result()
+        add_record(record)
+
+
+def sharded_aggregates(
+    transactions_file: Path,
+    clients_file: Path,
+    metrics: dict[str, Metric] = METRICS,
+    n_shards: int = N_SHARDS,
+    max_workers: Optional[int] = None,
+    shard_dir: Optional[Path] = None,
+) -> Aggregates:
+    # Without a shard directory the shard files only live for this run
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shard_dir = Path(tmp_dir) if shard_dir is None else shard_dir
+        measure(
+            "shard.partition",
+            partition,
+            transactions_file,
+            clients_file,
+            shard_dir,
+            n_shards,
+        )
+        with process_pool(max_workers) as pool:
+            _run_shards(pool, "clean", clean_shard, shard_dir, n_shards)
+            measure("shard.exchange", exchange, shard_dir, n_shards)
+            _run_shards(pool, "aggregate", aggregate_shard, shard_dir, n_shards)
+        return measure("shard.combine", combine, shard_dir, n_shards, metrics)
+
+
+def shard_count(shard_dir: Path) -> int:
+    with open(shard_dir / "shards.json", encoding="utf-8") as f:
+        return json.load(f)["n_shards"]
+
+
+STEPS = {
+    "clean": clean_shard,
+    "aggregate": aggregate_shard,
+}
+
+
+def main(argv: list[str] | None = None) -> int:
+    # Steps of the protocol for running shards on several machines:
+    # partition, clean every shard, exchange, aggregate every shard, combine
+    parser = argparse.ArgumentParser(
+        prog="python -m src.sharded", description="Sharded analysis steps"
+    )
+    parser.add_argument(
+        "step", choices=["partition", *STEPS, "exchange", "combine", "run"]
+    )
+    parser.add_argument("--shard-dir", type=Path, default=SHARD_DIR)
+    parser.add_argument(
+        "--shards", type=int, help="partition and run; later steps read shards.json"
+    )
+    parser.add_argument("--shard", type=int, action="append")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--transactions", type=Path, default=Path("data") / "transactions_data.xlsx"
+    )
+    parser.add_argument(
+        "--clients", type=Path, default=Path("data") / "clients_data.json"
+    )
+    parser.add_argument(
+        "--output", type=Path, default=Path("analysis_output") / "analysis_results.json"
+    )
+    args = parser.parse_args(argv)
+
+    n_shards = args.shards or N_SHARDS
+    if args.step not in ("partition", "run"):
+        n_shards = shard_count(args.shard_dir)
+
+    if args.step in STEPS:
+        for shard in args.shard or range(n_shards):
+            STEPS[args.step](args.shard_dir, shard)
+    elif args.step == "partition":
+        partition(args.transactions, args.clients, args.shard_dir, n_shards)
+    elif args.step == "exchange":
+        exchange(args.shard_dir, n_shards)
+    elif args.step == "combine":
+        save_results(
+            results_from_aggregates(combine(args.shard_dir, n_shards)), args.output
+        )
+    else:
+        aggregates = sharded_aggregates(
+            args.transactions,
+            args.clients,
+            n_shards=n_shards,
+            max_workers=args.workers,
+            shard_dir=args.shard_dir,
+        )
+        save_results(results_from_aggregates(aggregates), args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import math
+import numpy as np
+import pandas as pd
+
+
+def hash_values(values: pd.Series | pd.DataFrame) -> np.ndarray:
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+class HyperLogLog:
+    # Distinct count estimate with relative standard error 1.04 / sqrt(2^precision)
+    def __init__(self, precision: int = 14) -> None:
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def update(self, hashes: np.ndarray) -> None:
+        p = self.precision
+        buckets = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        rest = hashes << np.uint64(p)
+        # Position of the leftmost set bit in the remaining 64 - p bits
+        with np.errstate(divide="ignore"):
+            leading_zeros = 63 - np.floor(np.log2(rest.astype(np.float64)))
+        rank = np.where(rest == 0, 64 - p + 1, leading_zeros + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, rank)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+
+class BottomKSample:
+    # Uniform sample of size k kept as the k rows with the smallest random priority,
+    # so chunk samples merge into a sample of the whole stream
+    def __init__(self, k: int = 10_000, seed: int = 0) -> None:
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.n = 0
+        self.priorities = np.empty(0, dtype=np.float64)
+        self.values = np.empty(0, dtype=np.float64)
+
+    def rank_error(self, confidence: float = 0.99) -> float:
+        # Dvoretzky-Kiefer-Wolfowitz bound on the sample CDF, zero while the
+        # sample still holds every value
+        if self.n <= self.k:
+            return 0.0
+        return math.sqrt(math.log(2 / (1 - confidence)) / (2 * len(self.values)))
+
+    def update(self, values: np.ndarray) -> None:
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        priorities = np.concatenate([self.priorities, self.rng.random(len(values))])
+        values = np.concatenate([self.values, values])
+        if len(values) > self.k:
+            keep = np.argpartition(priorities, self.k)[: self.k]
+            priorities, values = priorities[keep], values[keep]
+        self.priorities, self.values = priorities, values
+
+    def quantile(self, q: float) -> float:
+        return float(np.quantile(self.values, q))
+
+
+class MisraGries:
+    # Top-k value counts, every count is underestimated by at most n / (k + 1)
+    def __init__(self, k: int = 100) -> None:
+        self.k = k
+        self.n = 0
+        self.pruned = False
+        self.counts = pd.Series(dtype="int64")
+
+    @property
+    def max_undercount(self) -> int:
+        return self.n // (self.k + 1) if self.pruned else 0
+
+    def update(self, values: pd.Series) -> None:
+        self.n += len(values)
+        counts = self.counts.add(
+            values.astype(str).value_counts(), fill_value=0
+        ).astype("int64")
+        if len(counts) > self.k:
+            threshold = counts.nlargest(self.k + 1).iloc[-1]
+            counts = counts[counts > threshold] - threshold
+            self.pruned = True
+        self.counts = counts
+
+    def top(self) -> pd.Series:
+        return self.counts.sort_values(ascending=False)
+
+
+class Moments:
+    # Exact count, mean, variance, min and max, merged with Chan's formula
+    def __init__(self) -> None:
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values: np.ndarray) -> None:
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        n, mean = len(values), float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def std(self, ddof: int = 1) -> float:
+        return math.sqrt(self.m2 / (self.n - ddof)) if self.n > ddof else math.nan
+
+
+class GroupedBottomKSample:
+    # BottomKSample per group, updated for every group of a chunk at once: the
+    # chunk and the kept rows are sorted by group and priority and the first k
+    # rows of each group survive
+    def __init__(self, by: list[str], k: int = 1_000, seed: int = 0) -> None:
+        self.by = by
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.n = pd.Series(dtype="int64")
+        self.rows = pd.DataFrame(columns=[*by, "value", "priority"])
+
+    def update(self, keys: pd.DataFrame, values: np.ndarray) -> None:
+        present = ~np.isnan(values)
+        rows = keys.loc[present, self.by].assign(
+            value=values[present], priority=self.rng.random(int(present.sum()))
+        )
+        sizes = rows.groupby(self.by, observed=True).size()
+        if len(self.rows):
+            self.n = self.n.add(sizes, fill_value=0).astype("int64")
+            rows = pd.concat([self.rows, rows], ignore_index=True)
+        else:
+            self.n = sizes
+        rows = rows.sort_values([*self.by, "priority"], ignore_index=True)
+        self.rows = rows.loc[rows.groupby(self.by, observed=True).cumcount() < self.k]
+
+    def quantiles(self, qs: list[float]) -> pd.DataFrame:
+        # One column per quantile, one row per group
+        return self.rows.groupby(self.by, observed=True)["value"].quantile(qs).unstack()
+
+
+class GroupedMoments:
+    # Moments per group, chunk statistics merged with Chan's formula for
+    # every group at once
+    def __init__(self, by: list[str]) -> None:
+        self.by = by
+        self.stats = pd.DataFrame(columns=["n", "mean", "m2"], dtype=float)
+
+    def update(self, keys: pd.DataFrame, values: np.ndarray) -> None:
+        grouped = pd.Series(values, index=keys.index).groupby(
+            [keys[col] for col in self.by], observed=True
+        )
+        new = pd.DataFrame(
+            {"n": grouped.count(), "mean": grouped.mean(), "m2": grouped.var(ddof=0)}
+        )
+        new["m2"] *= new["n"]
+        new = new.loc[new["n"] > 0]
+        if self.stats.empty:
+            self.stats = new
+            return
+
+        old, new = self.stats.align(new, join="outer", fill_value=0.0)
+        n = old["n"] + new["n"]
+        delta = new["mean"] - old["mean"]
+        self.stats = pd.DataFrame(
+            {
+                "n": n,
+                "mean": old["mean"] + delta * new["n"] / n,
+                "m2": old["m2"] + new["m2"] + delta * delta * old["n"] * new["n"] / n,
+            }
+        )
+
+    def std(self, ddof: int = 1) -> pd.Series:
+        n = self.stats["n"]
+        return np.sqrt(self.stats["m2"] / (n - ddof)).where(n > ddof)
@@ -0,0 +1,233 @@
+from pathlib import Path
+from typing import Optional, Sequence
+import pandas as pd
+
+from .analysis import run_analysis
+from .backends import run_backend_analysis
+from .cache import cache_stats, cached_read
+from .clean_data import clean_clients, clean_transactions, merge_tables
+from .compact import compact_frame, memory_report
+from .cube import CUBE_FILE, materialize_cube, tail_file
+from .dimension import ClientIndex, build_client_index
+from .features import FEATURES_FILE, counts_files, materialize_features
+from .generate_md_report import generate_md_report
+from .instrument import enable_profiling, save_run_metrics
+from .memo import STAGE_CACHE_DIR
+from .outliers import TRANSACTION_OUTLIER_GROUPS
+from .pipeline import Stage, explain, run_pipeline
+from .readers import read_excel_streaming, read_json_streaming
+from .segment_reports import SEGMENTS_DIR_NAME, generate_segment_reports
+from .utils import audit_df
+from .validation import rejection_counts
+
+TRANSACTIONS_FILE = Path("data") / "transactions_data.xlsx"
+CLIENTS_FILE = Path("data") / "clients_data.json"
+OUTPUT_DIR = Path("analysis_output")
+
+
+def build_stages(
+    transactions_file: Path = TRANSACTIONS_FILE,
+    clients_file: Path = CLIENTS_FILE,
+    output_dir: Path = OUTPUT_DIR,
+    compact: bool = False,
+    backend: str = "pandas",
+    segment_keys: Sequence[str] = (),
+) -> list[Stage]:
+    def audit_clean(df: pd.DataFrame, quarantine_file: Path, **kwargs) -> dict:
+        return audit_df(
+            df, rejected_by_rule=rejection_counts(quarantine_file), **kwargs
+        )
+
+    def index_clients(clients: pd.DataFrame) -> ClientIndex:
+        return build_client_index(compact_frame(clients) if compact else clients)
+
+    def merge(
+        transactions: pd.DataFrame, clients: pd.DataFrame, client_index: ClientIndex
+    ) -> pd.DataFrame:
+        if compact:
+            compact_transactions = compact_frame(transactions)
+            memory_report(
+                {
+                    "transactions": (transactions, compact_transactions),
+                    "clients": (clients, compact_frame(clients)),
+                },
+                save_file_name=output_dir / "memory_report.json",
+            )
+            return compact_frame(merge_tables(compact_transactions, client_index))
+        return merge_tables(transactions, client_index)
+
+    transactions_quarantine = output_dir / "quarantine_transactions.parquet"
+    clients_quarantine = output_dir / "quarantine_clients.parquet"
+
+    # Audits are side outputs: only cleaning, merge, analysis and report
+    # are on the path to the results, everything else runs alongside it
+    stages = [
+        # Load tables
+        Stage(
+            "load_transactions",
+            cached_read,
+            kwargs={"path": transactions_file, "reader": read_excel_streaming},
+            files=(transactions_file,),
+        ),
+        Stage(
+            "load_clients",
+            cached_read,
+            kwargs={"path": clients_file, "reader": read_json_streaming},
+            files=(clients_file,),
+        ),
+        # Audit raw data
+        Stage(
+            "audit_raw_transactions",
+            audit_df,
+            deps=("load_transactions",),
+            kwargs={
+                "save_file_name": output_dir / "audit_raw_transactions.json",
+                "str_value_counts_exclude_col": ["transaction_id", "client_id"],
+            },
+            outputs=(output_dir / "audit_raw_transactions.json",),
+        ),
+        Stage(
+            "audit_raw_clients",
+            audit_df,
+            deps=("load_clients",),
+            kwargs={
+                "save_file_name": output_dir / "audit_raw_clients.json",
+                "str_value_counts_exclude_col": ["id"],
+            },
+            outputs=(output_dir / "audit_raw_clients.json",),
+        ),
+        # Clean data; rejected rows go to the quarantine files
+        Stage(
+            "clean_transactions",
+            clean_transactions,
+            deps=("load_transactions",),
+            kwargs={"quarantine_file": transactions_quarantine},
+            outputs=(transactions_quarantine,),
+        ),
+        Stage(
+            "clean_clients",
+            clean_clients,
+            deps=("load_clients",),
+            kwargs={"quarantine_file": clients_quarantine},
+            outputs=(clients_quarantine,),
+        ),
+        # Audit clean data
+        Stage(
+            "audit_transactions",
+            audit_clean,
+            deps=("clean_transactions",),
+            kwargs={
+                "quarantine_file": transactions_quarantine,
+                "save_file_name": output_dir / "audit_transactions.json",
+                "str_value_counts_exclude_col": ["transaction_id", "client_id"],
+                "outlier_groups": TRANSACTION_OUTLIER_GROUPS,
+            },
+            files=(transactions_quarantine,),
+            outputs=(output_dir / "audit_transactions.json",),
+        ),
+        Stage(
+            "audit_clients",
+            audit_clean,
+            deps=("clean_clients",),
+            kwargs={
+                "quarantine_file": clients_quarantine,
+                "save_file_name": output_dir / "audit_clients.json",
+                "str_value_counts_exclude_col": ["id"],
+            },
+            files=(clients_quarantine,),
+            outputs=(output_dir / "audit_clients.json",),
+        ),
+        Stage("index_clients", index_clients, ("clean_clients",)),
+        Stage(
+            "merge_tables",
+            merge,
+            ("clean_transactions", "clean_clients", "index_clients"),
+            outputs=(output_dir / "memory_report.json",) if compact else (),
+        ),
+        Stage(
+            "build_cube",
+            materialize_cube,
+            deps=("merge_tables",),
+            kwargs={"save_file_name": CUBE_FILE},
+            outputs=(CUBE_FILE, tail_file(CUBE_FILE)),
+        ),
+        Stage(
+            "build_features",
+            materialize_features,
+            deps=("merge_tables",),
+            kwargs={"save_file_name": FEATURES_FILE},
+            outputs=(FEATURES_FILE, *counts_files(FEATURES_FILE)),
+        ),
+        # Other backends clean, join and aggregate the source files in their
+        # own engine; the report still plots the amounts of the pandas table
+        (
+            Stage(
+                "run_analysis",
+                run_analysis,
+                deps=("merge_tables", "build_cube", "build_features"),
+                kwargs={"save_file_name": output_dir / "analysis_results.json"},
+                outputs=(output_dir / "analysis_results.json",),
+            )
+            if backend == "pandas"
+            else Stage(
+                "run_analysis",
+                run_backend_analysis,
+                kwargs={
+                    "transactions_file": transactions_file,
+                    "clients_file": clients_file,
+                    "backend": backend,
+                    "save_file_name": output_dir / "analysis_results.json",
+                },
+                files=(transactions_file, clients_file),
+                outputs=(output_dir / "analysis_results.json",),
+            )
+        ),
+        Stage(
+            "generate_md_report",
+            generate_md_report,
+            deps=("run_analysis", "merge_tables"),
+            kwargs={"save_file_path": output_dir / "report.md"},
+            outputs=(output_dir / "report.md", output_dir / "plots"),
+        ),
+    ]
+    # Reports per segment are built on request, from the same merged table
+    if segment_keys:
+        stages.append(
+            Stage(
+                "generate_segment_reports",
+                generate_segment_reports,
+                deps=("merge_tables",),
+                kwargs={"output_dir": output_dir, "keys": tuple(segment_keys)},
+                outputs=(output_dir / SEGMENTS_DIR_NAME,),
+            )
+        )
+    return stages
+
+
+def run_stages(
+    stages: list[Stage],
+    output_dir: Path = OUTPUT_DIR,
+    targets: Optional[Sequence[str]] = None,
+    max_workers: Optional[int] = None,
+    profile: bool = False,
+    use_cache: bool = True,
+    dry_run: bool = False,
+) -> None:
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Stage outputs are memoized on disk, so a rerun only recomputes stages
+    # whose code, parameters or inputs changed
+    cache_dir = STAGE_CACHE_DIR if use_cache else None
+    if dry_run:
+        for name, reason in explain(stages, STAGE_CACHE_DIR, targets).items():
+            print(f"{name}: {'cached' if reason is None else f'rerun, {reason}'}")
+        return
+
+    # Profilers can't run concurrently, so profiled stages run one at a time
+    if profile:
+        enable_profiling(output_dir / "profiles")
+        max_workers = 1
+
+    run_pipeline(stages, max_workers=max_workers, cache_dir=cache_dir, targets=targets)
+    save_run_metrics(output_dir / "run_metrics.json")
+    print(cache_stats())
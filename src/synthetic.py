@@ -0,0 +1,195 @@
+from pathlib import Path
+from typing import Iterator, Literal
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .compact import format_uuids
+
+SERVICES = {
+    "Инвестиционное консультирование": 0.24,
+    "Управление активами": 0.20,
+    "Финансовое планирование": 0.155,
+    "Налоговое планирование": 0.155,
+    "Структурирование капитала": 0.15,
+    "Неизвестная услуга": 0.10,
+}
+PAYMENT_METHODS = {
+    "Кредитная карта": 0.40,
+    "Банковский перевод": 0.345,
+    "Неизвестно": 0.10,
+    "Наличные": 0.10,
+    "Криптовалюта": 0.055,
+}
+GENDERS = ["Мужчина", "Женщина"]
+
+_PLACE_PREFIXES = ["North", "South", "East", "West", "Port", "Lake", "New"]
+_PLACE_ROOTS = ["Emily", "Tina", "James", "Jordan", "Karen", "Andrew", "Zachary"]
+_FIRST_NAMES = [
+    "Cheryl",
+    "Frank",
+    "Alexandra",
+    "Patricia",
+    "Melissa",
+    "Ronald",
+    "Deborah",
+]
+_LAST_NAMES = ["Waller", "Pollard", "Meyer", "Haas", "Pena", "Shepherd", "Stone"]
+
+CITIES = [f"{p} {r}" for p in _PLACE_PREFIXES for r in _PLACE_ROOTS] + [
+    "Неизвестный город"
+]
+CONSULTANTS = [f"{f} {l}" for f in _FIRST_NAMES for l in _LAST_NAMES] + [
+    "Неизвестный консультант"
+]
+
+# Share of rows with each defect, close to the sample data
+DEFECT_RATES = {
+    "missing_transaction_id": 0.047,
+    "duplicate_transaction_id": 0.01,
+    "missing_client_id": 0.02,
+    "missing_amount": 0.046,
+    "invalid_date": 0.10,
+    "missing_id": 0.0001,
+    "missing_age": 0.10,
+    "missing_gender": 0.34,
+    "missing_net_worth": 0.048,
+}
+
+# Excel sheets are limited to 1,048,576 rows including the header
+XLSX_MAX_ROWS = 1_048_575
+
+
+def random_uuids(rng: np.random.Generator, n: int) -> np.ndarray:
+    packed = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    # Version 4, RFC 4122 variant
+    packed[:, 6] = (packed[:, 6] & 0x0F) | 0x40
+    packed[:, 8] = (packed[:, 8] & 0x3F) | 0x80
+    return format_uuids(packed)
+
+
+def _with_missing(
+    rng: np.random.Generator, values: np.ndarray, rate: float
+) -> np.ndarray:
+    values = values.astype(object) if values.dtype.kind in "US" else values.copy()
+    values[rng.random(len(values)) < rate] = None if values.dtype == object else np.nan
+    return values
+
+
+def _choice(rng: np.random.Generator, weights: dict[str, float], n: int) -> np.ndarray:
+    p = np.array(list(weights.values()))
+    return np.array(list(weights))[rng.choice(len(p), size=n, p=p / p.sum())]
+
+
+def generate_clients(n_clients: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rates = DEFECT_RATES
+    return pd.DataFrame(
+        {
+            "id": _with_missing(rng, random_uuids(rng, n_clients), rates["missing_id"]),
+            "age": _with_missing(
+                rng, rng.integers(20, 61, n_clients).astype(float), rates["missing_age"]
+            ),
+            "gender": _with_missing(
+                rng, rng.choice(GENDERS, n_clients), rates["missing_gender"]
+            ),
+            "net_worth": _with_missing(
+                rng,
+                rng.uniform(10_000, 5_000_000, n_clients).round(2),
+                rates["missing_net_worth"],
+            ),
+        }
+    )
+
+
+def generate_transactions(
+    n_rows: int,
+    client_ids: np.ndarray,
+    seed: int = 0,
+    start: str = "2025-01-01",
+    end: str = "2025-03-20",
+    chunk_size: int = 1_000_000,
+) -> Iterator[pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    rates = DEFECT_RATES
+    start_s = np.datetime64(start, "s").astype(np.int64)
+    end_s = np.datetime64(end, "s").astype(np.int64)
+
+    for offset in range(0, n_rows, chunk_size):
+        n = min(chunk_size, n_rows - offset)
+
+        transaction_ids = random_uuids(rng, n).astype(object)
+        # Re-deliver some ids of earlier rows of the same chunk
+        duplicates = np.flatnonzero(rng.random(n) < rates["duplicate_transaction_id"])
+        duplicates = duplicates[duplicates > 0]
+        transaction_ids[duplicates] = transaction_ids[
+            rng.integers(0, duplicates, dtype=np.int64)
+        ]
+
+        # ISO strings, with garbage in place of some dates like in the xlsx feed
+        dates = (
+            rng.integers(start_s, end_s, n).astype("datetime64[s]").astype(str)
+        ).astype(object)
+        dates[rng.random(n) < rates["invalid_date"]] = "INVALID_DATE"
+
+        yield pd.DataFrame(
+            {
+                "transaction_id": _with_missing(
+                    rng, transaction_ids, rates["missing_transaction_id"]
+                ),
+                "client_id": _with_missing(
+                    rng, rng.choice(client_ids, n), rates["missing_client_id"]
+                ),
+                "transaction_date": dates,
+                "service": _choice(rng, SERVICES, n),
+                "amount": _with_missing(
+                    rng, rng.gamma(1.7, 29_000, n), rates["missing_amount"]
+                ),
+                "payment_method": _choice(rng, PAYMENT_METHODS, n),
+                "city": rng.choice(CITIES, n),
+                "consultant": rng.choice(CONSULTANTS, n),
+            }
+        ).astype(
+            {"transaction_id": "str", "client_id": "str", "transaction_date": "str"}
+        )
+
+
+def write_dataset(
+    n_rows: int,
+    save_dir_path: Path,
+    transactions_per_client: float = 5.0,
+    fmt: Literal["parquet", "xlsx"] = "parquet",
+    seed: int = 0,
+    chunk_size: int = 1_000_000,
+) -> tuple[Path, Path]:
+    save_dir_path.mkdir(parents=True, exist_ok=True)
+
+    clients = generate_clients(max(int(n_rows / transactions_per_client), 1), seed)
+    clients_file = save_dir_path / f"clients_{n_rows}.json"
+    clients.to_json(clients_file, orient="records", force_ascii=False)
+
+    client_ids = clients["id"].dropna().to_numpy()
+    chunks = generate_transactions(n_rows, client_ids, seed + 1, chunk_size=chunk_size)
+
+    if fmt == "xlsx":
+        if n_rows > XLSX_MAX_ROWS:
+            raise ValueError(f"xlsx holds at most {XLSX_MAX_ROWS} rows")
+        transactions_file = save_dir_path / f"transactions_{n_rows}.xlsx"
+        pd.concat(chunks, ignore_index=True).to_excel(transactions_file, index=False)
+        return transactions_file, clients_file
+
+    # Parquet is written chunk by chunk, so memory stays bounded by chunk_size
+    transactions_file = save_dir_path / f"transactions_{n_rows}.parquet"
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(transactions_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return transactions_file, clients_file
@@ -1,9 +1,72 @@
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Literal
+from typing import Iterable, Optional, Literal, Sequence
 import json
+import math
+from statistics import NormalDist
 import pandas as pd
 import numpy as np
 
+from .outliers import (
+    grouped_outliers,
+    grouped_outliers_from_sketches,
+    outlier_summary,
+)
+from .sketches import (
+    BottomKSample,
+    GroupedBottomKSample,
+    GroupedMoments,
+    HyperLogLog,
+    Moments,
+    MisraGries,
+    hash_values,
+)
+
+# audit_df(mode="auto") switches to the sketch-based audit above this size
+APPROX_AUDIT_MIN_ROWS = 1_000_000
+
+
+@dataclass(frozen=True)
+class Bands:
+    # Ascending band edges, len(labels) == len(edges) + 1
+    edges: tuple[float, ...]
+    labels: tuple[str, ...]
+    # For each edge, whether a value equal to it belongs to the lower band
+    edge_in_lower: tuple[bool, ...] | None = None
+
+
+NET_WORTH_BANDS = Bands(
+    edges=(100_000, 1_000_000),
+    labels=("Низкий капитал", "Средний капитал", "Высокий капитал"),
+    edge_in_lower=(False, True),
+)
+
+
+def bucketize(series: pd.Series, bands: Bands) -> pd.Series:
+    values = series.to_numpy(dtype=float)
+    edge_in_lower = bands.edge_in_lower or (False,) * len(bands.edges)
+
+    # Band code is the number of edges the value has passed, one comparison per edge
+    codes = np.zeros(len(values), dtype=np.int8)
+    for edge, in_lower in zip(bands.edges, edge_in_lower):
+        codes += (values > edge) if in_lower else (values >= edge)
+    codes[np.isnan(values)] = -1
+
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=bands.labels, ordered=True),
+        index=series.index,
+        name=series.name,
+    )
+
+
+def key_column(df: pd.DataFrame, key: str) -> pd.Series:
+    # Keys that are not stored in the merged table are derived once per run
+    if key in df.columns:
+        return df[key]
+    if key == "net_worth_category":
+        return bucketize(df["net_worth"], NET_WORTH_BANDS)
+    raise KeyError(key)
+
 
 def detect_outliers(
     series: pd.Series,
@@ -59,12 +122,225 @@ def detect_outliers(
     }
 
 
+def _save_audit(audit: dict, save_file_name: Optional[Path]) -> None:
+    if save_file_name is not None:
+        with open(save_file_name, "w", encoding="utf-8") as f:
+            json_str = json.dumps(audit, indent=2, ensure_ascii=False)
+            f.write(json_str)
+        print(f"Audit saved: {save_file_name}")
+
+
+def _duplicates(rows: int, hll: HyperLogLog, z: float) -> tuple[Optional[int], int]:
+    # Rows minus the distinct estimate, with the estimate's error as margin.
+    # A count within the margin can't be told from no duplicates at all, so
+    # it is None rather than HLL noise (thousands of "duplicates" of a unique
+    # id column at a million rows)
+    distinct = hll.estimate()
+    margin = z * hll.relative_error * distinct
+    count = rows - distinct
+    return (round(count) if count > margin else None), round(margin)
+
+
+def audit_stream(
+    chunks: Iterable[pd.DataFrame],
+    outlier_method: Literal["iqr", "zscore"] = "iqr",
+    str_value_counts_exclude_col: Optional[list[str]] = None,
+    zscore_threshold: float = 3.0,
+    sample_size: int = 10_000,
+    top_values: int = 100,
+    confidence: float = 0.99,
+    outlier_groups: Sequence[Sequence[str]] = (),
+) -> dict:
+    exclude = str_value_counts_exclude_col or []
+    rows = 0
+    column_types: dict = {}
+    missing: pd.Series | None = None
+    row_distinct = HyperLogLog()
+    col_distinct: dict[str, HyperLogLog] = {}
+    first_values: dict = {}
+    constant: dict[str, bool] = {}
+    moments: dict[str, Moments] = {}
+    samples: dict[str, BottomKSample] = {}
+    heavy_hitters: dict[str, MisraGries] = {}
+    group_sketches: dict[
+        tuple[str, tuple[str, ...]], tuple[GroupedBottomKSample, GroupedMoments]
+    ] = {}
+
+    # One pass: every statistic is a mergeable per-chunk summary
+    for chunk in chunks:
+        if not column_types:
+            column_types = chunk.dtypes.astype(str).to_dict()
+            col_distinct = {col: HyperLogLog() for col in chunk.columns}
+            for col in chunk.select_dtypes(include=np.number).columns:
+                moments[col] = Moments()
+                samples[col] = BottomKSample(sample_size)
+            for col in chunk.select_dtypes(include="str").columns:
+                if col not in exclude:
+                    heavy_hitters[col] = MisraGries(top_values)
+            for col in moments:
+                for by in outlier_groups:
+                    if set(by) <= set(chunk.columns):
+                        group_sketches[(col, tuple(by))] = (
+                            GroupedBottomKSample(list(by)),
+                            GroupedMoments(list(by)),
+                        )
+        if chunk.empty:
+            continue
+
+        rows += len(chunk)
+        chunk_missing = chunk.isna().sum()
+        missing = chunk_missing if missing is None else missing + chunk_missing
+        row_distinct.update(hash_values(chunk))
+
+        for col, series in chunk.items():
+            col_distinct[col].update(hash_values(series))
+
+            first = first_values.setdefault(col, series.iloc[0])
+            if constant.get(col, True):
+                same = series.isna() if pd.isna(first) else series == first
+                constant[col] = bool(same.all())
+
+            if col in moments:
+                values = series.to_numpy(dtype=float, na_value=np.nan)
+                moments[col].update(values)
+                samples[col].update(values)
+            if col in heavy_hitters:
+                heavy_hitters[col].update(series)
+
+        for (col, _), sketches in group_sketches.items():
+            values = chunk[col].to_numpy(dtype=float, na_value=np.nan)
+            for sketch in sketches:
+                sketch.update(chunk, values)
+
+    if missing is None:
+        missing = pd.Series(0, index=list(column_types), dtype="int64")
+
+    audit: dict = {}
+    audit["rows"] = rows
+    audit["columns"] = len(column_types)
+    audit["column_types"] = column_types
+    audit["missing_total"] = int(missing.sum())
+    audit["missing_by_col"] = missing.to_dict()
+    audit["missing_ratio_by_col"] = (missing / rows).to_dict() if rows > 0 else {}
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    # Duplicates are rows minus the estimated number of distinct values
+    audit["duplicate_rows"], duplicate_rows_margin = _duplicates(rows, row_distinct, z)
+    audit["duplicate_rows_all"] = None
+    duplicates = {col: _duplicates(rows, hll, z) for col, hll in col_distinct.items()}
+    audit["duplicate_by_col"] = {col: count for col, (count, _) in duplicates.items()}
+    audit["constant_cols"] = [col for col in column_types if constant.get(col, True)]
+
+    audit["numeric_outliers_by_col"] = {}
+    audit["numeric_summary_by_col"] = {}
+    outlier_margin = {}
+    for col, stats in moments.items():
+        sample = samples[col]
+        if stats.n == 0:
+            audit["numeric_summary_by_col"][col] = {}
+            audit["numeric_outliers_by_col"][col] = detect_outliers(
+                pd.Series(dtype=float)
+            )
+            continue
+
+        audit["numeric_summary_by_col"][col] = {
+            "count": float(stats.n),
+            "mean": stats.mean,
+            "std": stats.std(ddof=1),
+            "min": stats.min,
+            "25%": sample.quantile(0.25),
+            "50%": sample.quantile(0.5),
+            "75%": sample.quantile(0.75),
+            "max": stats.max,
+        }
+
+        lower: float | None = None
+        upper: float | None = None
+        if outlier_method == "iqr":
+            q1, q3 = sample.quantile(0.25), sample.quantile(0.75)
+            lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+            share = float(np.mean((sample.values < lower) | (sample.values > upper)))
+        else:
+            std = stats.std(ddof=0)
+            z_scores = np.abs(sample.values - stats.mean) / std if std > 0 else None
+            share = (
+                float(np.mean(z_scores > zscore_threshold))
+                if z_scores is not None
+                else 0.0
+            )
+        audit["numeric_outliers_by_col"][col] = {
+            "count": round(share * stats.n),
+            "percentage": share,
+            "lower_bound": lower,
+            "upper_bound": upper,
+        }
+        outlier_margin[col] = (
+            z * math.sqrt(share * (1 - share) / len(sample.values))
+            if sample.n > sample.k
+            else 0.0
+        )
+
+    if outlier_groups:
+        audit["grouped_outliers_by_col"] = {col: {} for col in moments}
+    for (col, by), (group_sample, group_moments) in group_sketches.items():
+        audit["grouped_outliers_by_col"][col][", ".join(by)] = outlier_summary(
+            grouped_outliers_from_sketches(
+                group_sample,
+                group_moments,
+                outlier_method,
+                zscore_threshold=zscore_threshold,
+            )
+        )
+
+    audit["str_summary_by_col"] = {
+        col: {str(value): int(count) for value, count in mg.top().items()}
+        for col, mg in heavy_hitters.items()
+    }
+
+    audit["approximation"] = {
+        "confidence": confidence,
+        "distinct_relative_std_error": row_distinct.relative_error,
+        "duplicate_rows_margin": duplicate_rows_margin,
+        "duplicate_margin_by_col": {
+            col: margin for col, (_, margin) in duplicates.items()
+        },
+        "quantile_rank_error_by_col": {
+            col: sample.rank_error(confidence) for col, sample in samples.items()
+        },
+        "outlier_percentage_margin_by_col": outlier_margin,
+        "str_count_max_undercount_by_col": {
+            col: mg.max_undercount for col, mg in heavy_hitters.items()
+        },
+        "str_top_values": top_values,
+    }
+
+    return audit
+
+
 def audit_df(
     df: pd.DataFrame,
     outlier_method: Literal["iqr", "zscore"] = "iqr",
     save_file_name: Optional[Path] = None,
     str_value_counts_exclude_col: Optional[list[str]] = None,
+    mode: Literal["exact", "approx", "auto"] = "auto",
+    chunk_size: int = 1_000_000,
+    rejected_by_rule: Optional[dict[str, int]] = None,
+    outlier_groups: Sequence[Sequence[str]] = (),
 ) -> dict:
+    if mode == "approx" or (mode == "auto" and len(df) > APPROX_AUDIT_MIN_ROWS):
+        chunks = (df.iloc[i : i + chunk_size] for i in range(0, len(df), chunk_size))
+        audit = audit_stream(
+            chunks,
+            outlier_method=outlier_method,
+            str_value_counts_exclude_col=str_value_counts_exclude_col,
+            outlier_groups=outlier_groups,
+        )
+        if rejected_by_rule is not None:
+            audit["rejected_by_rule"] = rejected_by_rule
+        _save_audit(audit, save_file_name)
+        return audit
+
     audit = {}
 
     audit["rows"] = len(df)
@@ -104,19 +380,32 @@ def audit_df(
             method=outlier_method,
         )
 
+    # Outliers within groups, e.g. amounts unusual for their service
+    if outlier_groups:
+        audit["grouped_outliers_by_col"] = {
+            col: {
+                ", ".join(by): outlier_summary(
+                    grouped_outliers(df, col, by, method=outlier_method)
+                )
+                for by in outlier_groups
+                if set(by) <= set(df.columns)
+            }
+            for col in numeric_df.columns
+        }
+
     audit["str_summary_by_col"] = {}
     for col in df.select_dtypes(include="str").columns:
-        if col in str_value_counts_exclude_col:
+        if col in (str_value_counts_exclude_col or []):
             continue
         counts = df[col].value_counts(dropna=False)
         audit["str_summary_by_col"][col] = {
             str(value): int(count) for value, count in counts.items()
         }
 
-    if save_file_name is not None:
-        with open(save_file_name, "w", encoding="utf-8") as f:
-            json_str = json.dumps(audit, indent=2, ensure_ascii=False)
-            f.write(json_str)
-        print(f"Audit saved: {save_file_name}")
+    # Rows the cleaning rejected, per violated rule; a row can break several
+    if rejected_by_rule is not None:
+        audit["rejected_by_rule"] = rejected_by_rule
+
+    _save_audit(audit, save_file_name)
 
     return audit
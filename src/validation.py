@@ -0,0 +1,91 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal, Sequence
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    column: str
+    # not_null: the value is present; positive: the value is > 0 where present;
+    # unique: the first of equal values among rows passing the other rules
+    check: Literal["not_null", "positive", "unique"]
+
+
+# Rules are checked on the table with transaction_date already coerced, so an
+# invalid date is a missing one
+TRANSACTION_RULES = (
+    Rule("missing_client_id", "client_id", "not_null"),
+    Rule("missing_amount", "amount", "not_null"),
+    Rule("invalid_date", "transaction_date", "not_null"),
+    Rule("non_positive_amount", "amount", "positive"),
+    Rule("duplicate_transaction_id", "transaction_id", "unique"),
+)
+CLIENT_RULES = (Rule("missing_id", "id", "not_null"),)
+
+# Column of the quarantine file with the bits of the violated rules; bit i
+# stands for the i-th rule, the rule names are in the file metadata
+QUARANTINE_COLUMN = "rejected_rules"
+
+
+def row_rules(rules: Sequence[Rule]) -> tuple[Rule, ...]:
+    # Rules that look at a row alone, e.g. for chunks deduplicated elsewhere
+    return tuple(rule for rule in rules if rule.check != "unique")
+
+
+def violations(df: pd.DataFrame, rules: Sequence[Rule]) -> np.ndarray:
+    # One bitmask per row; rows with 0 pass every rule
+    if len(rules) > 16:
+        raise ValueError(f"Validation: at most 16 rules, got {len(rules)}")
+    bits = np.zeros(len(df), dtype=np.uint16)
+    for bit, rule in enumerate(rules):
+        if rule.check == "not_null":
+            broken = df[rule.column].isna().to_numpy()
+        elif rule.check == "positive":
+            broken = (df[rule.column] <= 0).to_numpy()
+        else:
+            continue
+        bits |= broken.astype(np.uint16) << bit
+
+    # Uniqueness is judged among the rows that pass the row rules, as
+    # drop_duplicates after the filters would
+    valid = bits == 0
+    for bit, rule in enumerate(rules):
+        if rule.check == "unique":
+            repeated = np.zeros(len(df), dtype=bool)
+            repeated[valid] = df.loc[valid, rule.column].duplicated().to_numpy()
+            bits |= repeated.astype(np.uint16) << bit
+    return bits
+
+
+def write_quarantine(
+    raw_df: pd.DataFrame, bits: np.ndarray, rules: Sequence[Rule], path: Path
+) -> None:
+    # Rejected rows as they came in, so they can be fixed and cleaned again.
+    # Mixed columns (Excel dates next to garbage strings) are kept as text
+    rejected = raw_df.loc[bits != 0]
+    rejected = rejected.astype(
+        {col: "str" for col in rejected.columns if rejected[col].dtype == object}
+    ).assign(**{QUARANTINE_COLUMN: bits[bits != 0]})
+
+    table = pa.Table.from_pandas(rejected, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"rules"] = json.dumps([rule.name for rule in rules]).encode()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+    print(f"Quarantine saved: {path} ({len(rejected)} rows)")
+
+
+def rejection_counts(path: Path) -> dict[str, int]:
+    # Only the bitmask column is read
+    table = pq.read_table(path, columns=[QUARANTINE_COLUMN])
+    names = json.loads(pq.read_schema(path).metadata[b"rules"])
+    bits = table.column(QUARANTINE_COLUMN).to_numpy()
+    return {
+        name: int(np.count_nonzero(bits & (1 << bit))) for bit, name in enumerate(names)
+    }